@@ -1,10 +1,19 @@
 import os
+import json
+import atexit
+import time
+import queue
+import asyncio
 import hashlib
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from datetime import datetime
-from typing import Dict, Any, List, Optional, Set
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Set, Tuple, FrozenSet
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
@@ -12,14 +21,24 @@ from dotenv import load_dotenv
 # --- Your existing modules ---
 from processing import PDFProcessor, VectorStore
 from document_cache import DocumentCache
+from storage import IndexStorage, RegistryStorage
+from answer_cache import SemanticAnswerCache
+from chunking import TextChunker
+from reranker import CrossEncoderReranker
+from ingestion import IngestionQueue, TERMINAL_STATUSES
+from coordination import InterProcessLock, ProcessLease
+from session_store import SessionHistory, SessionStore
 
 # --- LangChain / Agentic bits ---
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.documents import Document
 from langchain_core.retrievers import BaseRetriever
-from langchain_core.callbacks import CallbackManagerForRetrieverRun
-from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    BaseCallbackHandler,
+    CallbackManagerForRetrieverRun,
+)
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain.tools.retriever import create_retriever_tool
 from langchain.agents import AgentExecutor, create_tool_calling_agent
@@ -37,47 +56,223 @@ app.config["UPLOAD_FOLDER"] = "./uploads"
 app.config["MAX_CONTENT_LENGTH"] = 2000 * 1024 * 1024  # 2 GB
 os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
 
+# FAISS index, vector metadata and KB/document registries are persisted here
+app.config["DATA_FOLDER"] = os.environ.get("DATA_DIR", "./data")
+os.makedirs(app.config["DATA_FOLDER"], exist_ok=True)
+
 # -----------------------------------------------------------------------------
-# Global state (in-memory)
+# Global state (in-memory, backed by DATA_FOLDER)
 # -----------------------------------------------------------------------------
 
-# Single global vector DB (your VectorStore using FastEmbed + BGE-small-en-v1.5 + FAISS)
-vector_store = VectorStore()
+index_storage = IndexStorage(
+    os.path.join(app.config["DATA_FOLDER"], "index"),
+    snapshot_every=int(os.environ.get("INDEX_SNAPSHOT_EVERY", "5000")),
+)
+registry_storage = RegistryStorage(
+    os.path.join(app.config["DATA_FOLDER"], "registry.json")
+)
+
+
+
+def _new_vector_store() -> VectorStore:
+    """
+    VectorStore backed by index_storage.
+
+    VECTOR_INDEX_TYPE: flat | hnsw | ivf_flat | ivf_pq (default flat)
+    VECTOR_INDEX_PARAMS: JSON overrides for processing.DEFAULT_INDEX_PARAMS
+    HYBRID_SEARCH: 1 (default) fuses BM25 keyword hits into every search, 0 = FAISS only
+    """
+    return VectorStore(
+        storage=index_storage,
+        index_type=os.environ.get("VECTOR_INDEX_TYPE", "flat"),
+        index_params=json.loads(os.environ.get("VECTOR_INDEX_PARAMS") or "{}"),
+        hybrid=os.environ.get("HYBRID_SEARCH", "1") == "1",
+    )
 
-# PDF processor + page cache
-pdf_processor = PDFProcessor()
-document_cache = DocumentCache(ttl=3600)
 
-# Simple in-memory KB + documents registry
-knowledge_bases: Dict[str, Dict[str, Any]] = {}
-documents: Dict[str, Dict[str, Any]] = {}
+# Several server processes (see gunicorn.conf.py) may share DATA_FOLDER. Writes to
+# the index and to the registry each happen under an inter-process lock; every
+# process reads on from the same append-only index files when the writer bumps
+# the index generation (reloading only after a compaction or reset), and reloads
+# the registry when registry.json is replaced.
+_index_write_lock = InterProcessLock(os.path.join(app.config["DATA_FOLDER"], "index.lock"))
+
+# Single global vector DB (your VectorStore using FastEmbed + BGE-small-en-v1.5 + FAISS),
+# reloaded from the last snapshot + append log instead of re-embedding by start()
+vector_store: Optional[VectorStore] = None
+_index_generation = 0
+
+# PDF processor (PDF_WORKERS processes for page extraction/OCR; 0 = CPU count)
+pdf_processor = PDFProcessor(
+    max_workers=int(os.environ.get("PDF_WORKERS", "0")) or None,
+    ocr_dpi=int(os.environ.get("OCR_DPI", "200")),
+)
+# Pages served by GET /documents/<doc_id>: LRU bounded to DOCUMENT_CACHE_MB of text
+# (expiry sweeper started by start())
+document_cache = DocumentCache(
+    ttl=int(os.environ.get("DOCUMENT_CACHE_TTL", "3600")),
+    max_bytes=int(float(os.environ.get("DOCUMENT_CACHE_MB", "64")) * 1024 * 1024),
+    sweep_interval=0,
+)
+
+# Pages are indexed as overlapping sentence-aligned chunks of CHUNK_TOKENS tokens;
+# the agent sees each hit expanded by RETRIEVAL_NEIGHBORS chunks on either side
+text_chunker = TextChunker(
+    chunk_tokens=int(os.environ.get("CHUNK_TOKENS", "256")),
+    overlap_tokens=int(os.environ.get("CHUNK_OVERLAP", "48")),
+)
+RETRIEVAL_NEIGHBORS = int(os.environ.get("RETRIEVAL_NEIGHBORS", "0"))
+
+# Optional cross-encoder rerank (RERANK=1): retrievers fetch RERANK_CANDIDATES hits,
+# rescore them locally and keep the best top_k; vector order if over RERANK_BUDGET_MS
+reranker: Optional[CrossEncoderReranker] = None
+if os.environ.get("RERANK") == "1":
+    reranker = CrossEncoderReranker(
+        model_name=os.environ.get("RERANK_MODEL", "Xenova/ms-marco-MiniLM-L-6-v2"),
+        candidates=int(os.environ.get("RERANK_CANDIDATES", "20")),
+        batch_size=int(os.environ.get("RERANK_BATCH_SIZE", "16")),
+        budget=int(os.environ.get("RERANK_BUDGET_MS", "300")) / 1000,
+    )
 
-# Per-conversation chat histories for the agent
-_session_histories: Dict[str, ChatMessageHistory] = {}
+# KB + documents registry (persisted with _save_registry() after every change)
+knowledge_bases: Dict[str, Dict[str, Any]]
+documents: Dict[str, Dict[str, Any]]
+knowledge_bases, documents = registry_storage.load()
+_registry_stamp = registry_storage.stamp()
 
 # Cached LLM instance
 _llm: Optional[ChatGoogleGenerativeAI] = None
 
+# Answers of earlier questions, matched by question embedding within the same KB set
+# (ANSWER_CACHE_SIZE=0 disables it)
+answer_cache = SemanticAnswerCache(
+    VectorStore._embed_texts,
+    threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.92")),
+    ttl=int(os.environ.get("ANSWER_CACHE_TTL", "86400")),
+    max_entries=int(os.environ.get("ANSWER_CACHE_SIZE", "1000")),
+)
+
+# Embedding + FAISS work of async requests (asgi.py) runs on these threads, so the
+# event loop only waits on I/O (CPU_WORKERS, default CPU count)
+cpu_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("CPU_WORKERS", "0")) or os.cpu_count() or 1,
+    thread_name_prefix="cpu",
+)
+
+
+async def run_cpu_bound(fn, *args, **kwargs):
+    """Await fn(*args, **kwargs) run on cpu_executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(cpu_executor, partial(fn, *args, **kwargs))
+
+
+# Built agents keyed by (kb_ids, top_k), least recently used first
+AGENT_CACHE_SIZE = int(os.environ.get("AGENT_CACHE_SIZE", "32"))
+_agent_cache: "OrderedDict[Tuple[FrozenSet[str], int], RunnableWithMessageHistory]" = OrderedDict()
+_agent_cache_lock = threading.Lock()
+
 
 def _now_iso() -> str:
     """Return current UTC time in ISO-8601 format."""
     return datetime.utcnow().isoformat() + "Z"
 
 
+def _sync_registry():
+    """Reload the registries in place if another process saved them."""
+    global _registry_stamp
+    stamp = registry_storage.stamp()
+    if stamp == _registry_stamp:
+        return
+    kbs, docs = registry_storage.load()
+    knowledge_bases.clear()
+    knowledge_bases.update(kbs)
+    documents.clear()
+    documents.update(docs)
+    _registry_stamp = stamp
+
+
+def _sync_vector_store(repair: bool = False):
+    """
+    Catch up with index changes of another process, or with `repair`
+    (writers) make a store last loaded read-only writable. Cached answers of
+    the KBs that changed are dropped (all of them after a full reload).
+    """
+    global _index_generation
+    if vector_store is None:
+        return  # start() is loading it
+    generation = index_storage.generation()
+    if generation == _index_generation and not (repair and vector_store.read_only):
+        return
+    changed_kbs = vector_store.sync(repair=repair)
+    if changed_kbs is None:
+        answer_cache.clear()
+    elif changed_kbs:
+        answer_cache.invalidate_kbs(changed_kbs)
+    _index_generation = generation
+
+
+def _index_changed():
+    """Publish a change to the index to the other processes (call under _index_write_lock)."""
+    global _index_generation
+    _index_generation = index_storage.bump_generation()
+
+
+# Registries are changed from request handlers, ingestion worker threads and
+# other processes; holding the lock always means working on the latest copy
+_registry_lock = InterProcessLock(
+    os.path.join(app.config["DATA_FOLDER"], "registry.lock"), on_acquire=_sync_registry
+)
+# Writers start from the latest index (repairing torn appends of a crashed writer)
+_index_write_lock.on_acquire = lambda: _sync_vector_store(repair=True)
+
+
+def _save_registry():
+    """Persist the KB + documents registries."""
+    global _registry_stamp
+    with _registry_lock:
+        registry_storage.save(knowledge_bases, documents)
+        _registry_stamp = registry_storage.stamp()
+
+
+@app.before_request
+def _sync_shared_state():
+    """Pick up registry and index changes made by other server processes."""
+    if vector_store is None:
+        start()  # entry points that did not call it (e.g. `flask run`)
+    if registry_storage.stamp() != _registry_stamp:
+        with _registry_lock:
+            pass  # acquiring reloads
+    if index_storage.generation() != _index_generation:
+        _sync_vector_store()
+
+
+def _snapshot_index():
+    """Flush a final FAISS snapshot so the next start has nothing to replay."""
+    if not _ingest_lease.held or vector_store is None:
+        return  # left to the ingestion process, which does nearly all writes
+    with _index_write_lock:
+        vector_store.save()
+
+
+atexit.register(_snapshot_index)
+
+
 def _ensure_default_kb() -> str:
     """Create a 'default' KB if it doesn't exist and return its ID."""
     kb_id = "default"
-    if kb_id not in knowledge_bases:
-        now = _now_iso()
-        knowledge_bases[kb_id] = {
-            "id": kb_id,
-            "name": "Default",
-            "description": "Default Knowledge Base",
-            "visibility": "private",
-            "created_at": now,
-            "updated_at": now,
-            "document_ids": [],
-        }
+    with _registry_lock:
+        if kb_id not in knowledge_bases:
+            now = _now_iso()
+            knowledge_bases[kb_id] = {
+                "id": kb_id,
+                "name": "Default",
+                "description": "Default Knowledge Base",
+                "visibility": "private",
+                "created_at": now,
+                "updated_at": now,
+                "document_ids": [],
+            }
+            _save_registry()
     return kb_id
 
 
@@ -92,15 +287,27 @@ class KBVectorRetriever(BaseRetriever):
     LangChain retriever wrapper around your custom VectorStore.
 
     It:
-    - Uses vector_store.search(query, k)
-    - Optionally filters by kb_ids
+    - Uses vector_store.search(query, k) (FAISS, fused with BM25 keyword hits
+      when the store is hybrid)
+    - Optionally scopes the search to kb_ids / doc_ids / tags (filtered inside
+      FAISS, so k in-scope hits come back)
+    - With a reranker, over-fetches reranker.candidates hits and keeps the k
+      best by cross-encoder score (vector order if reranking is skipped)
     - Returns LangChain Document objects with your metadata attached
     """
 
     # These are Pydantic model fields now
     vector_store: VectorStore
     kb_ids: Optional[Set[str]] = None
+    doc_ids: Optional[Set[str]] = None
+    tags: Optional[Set[str]] = None
     k: int = 5
+    # ANN knobs forwarded to vector_store.search (nprobe / ef_search). A run can
+    # override them with config={"metadata": {"search_params": {...}}}.
+    search_params: Optional[Dict[str, int]] = None
+    # Neighbouring chunks on each side merged into every hit's text
+    neighbors: int = 0
+    reranker: Optional[CrossEncoderReranker] = None
 
     class Config:
         # Allow VectorStore (a non-pydantic type) as a field
@@ -112,30 +319,56 @@ class KBVectorRetriever(BaseRetriever):
         *,
         run_manager: Optional[CallbackManagerForRetrieverRun] = None,
     ) -> List[Document]:
-        # Convert to a real set once, for quick membership checks
-        kb_id_set = self.kb_ids if self.kb_ids else None
-
-        results = self.vector_store.search(query, k=self.k)
-        docs: List[Document] = []
-
-        for meta, dist in results:
-            kb_id = meta.get("kb_id")
+        search_params = dict(self.search_params or {})
+        if run_manager is not None:
+            search_params.update((run_manager.metadata or {}).get("search_params") or {})
+
+        fetch_k = self.k
+        if self.reranker is not None:
+            fetch_k = max(self.k, self.reranker.candidates)
+        results = self.vector_store.search(
+            query,
+            k=fetch_k,
+            kb_ids=self.kb_ids,
+            doc_ids=self.doc_ids,
+            tags=self.tags,
+            **search_params,
+        )
 
-            # Optional KB filtering
-            if kb_id_set and kb_id not in kb_id_set:
-                continue
+        rerank_scores: List[Optional[float]] = [None] * len(results)
+        if self.reranker is not None and len(results) > 1:
+            ranked = self.reranker.rerank(query, [meta.get("doc_text", "") for meta, _ in results], self.k)
+            if ranked is not None:
+                results = [results[i] for i, _ in ranked]
+                rerank_scores = [score for _, score in ranked]
+        results = results[:self.k]
 
+        docs: List[Document] = []
+        for (meta, dist), rerank_score in zip(results, rerank_scores):
             rich_meta = dict(meta)
             rich_meta["score"] = dist
+            if rerank_score is not None:
+                rich_meta["rerank_score"] = rerank_score
 
             docs.append(
                 Document(
-                    page_content=meta.get("doc_text", ""),
+                    page_content=self.vector_store.expand_with_neighbors(meta, self.neighbors),
                     metadata=rich_meta,
                 )
             )
         return docs
 
+    async def _aget_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+    ) -> List[Document]:
+        # Embedding + FAISS search on cpu_executor (agent.ainvoke path)
+        return await run_cpu_bound(
+            self._get_relevant_documents, query, run_manager=run_manager.get_sync()
+        )
+
 def _get_gemini_api_key() -> str:
     """
     Priority:
@@ -172,11 +405,93 @@ def _get_llm() -> ChatGoogleGenerativeAI:
     return _llm
 
 
-def _get_session_history(session_id: str) -> ChatMessageHistory:
-    """Return (and lazily create) a ChatMessageHistory for a given conversation."""
-    if session_id not in _session_histories:
-        _session_histories[session_id] = ChatMessageHistory()
-    return _session_histories[session_id]
+def _summarize_history(summary: str, messages: List[Any]) -> str:
+    """Fold turns leaving the history window into the conversation's rolling summary."""
+    transcript = "\n".join(
+        f"{'User' if m.type == 'human' else 'Assistant'}: {m.content}" for m in messages
+    )
+    prompt = (
+        "Update the summary of a conversation between a user and an HR documents "
+        "assistant with the new turns below. Keep facts, names, numbers and open "
+        "questions the user may refer back to; at most 150 words.\n\n"
+        f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}\n\n"
+        "Updated summary:"
+    )
+    return str(_get_llm().invoke(prompt).content).strip()
+
+
+# Per-conversation chat histories for the agent: at most SESSION_MAX conversations,
+# idle ones expire after SESSION_TTL seconds. The agent sees the last
+# HISTORY_MAX_TURNS turns (within HISTORY_MAX_TOKENS, 0 = no limit); with
+# HISTORY_SUMMARY=1 older turns are summarized instead of dropped.
+# SESSION_STORE=sqlite (default) keeps them in DATA_FOLDER/sessions.sqlite3, shared
+# by every worker process and kept across restarts; "memory" keeps them per process.
+session_store = SessionStore(
+    max_sessions=int(os.environ.get("SESSION_MAX", "1000")),
+    ttl=int(os.environ.get("SESSION_TTL", "86400")),
+    max_turns=int(os.environ.get("HISTORY_MAX_TURNS", "10")),
+    max_tokens=int(os.environ.get("HISTORY_MAX_TOKENS", "0")),
+    summarizer=_summarize_history if os.environ.get("HISTORY_SUMMARY") == "1" else None,
+    db_path=(
+        os.path.join(app.config["DATA_FOLDER"], "sessions.sqlite3")
+        if os.environ.get("SESSION_STORE", "sqlite") == "sqlite"
+        else None
+    ),
+)
+
+
+def _get_session_history(session_id: str) -> SessionHistory:
+    """History of one conversation, backed by session_store."""
+    return session_store.get_history(session_id)
+
+
+def _parse_search_params(data: Dict[str, Any]) -> Dict[str, int]:
+    """
+    Read the optional ANN search knobs from a request body.
+
+    - nprobe: IVF cells to visit (ivf_flat / ivf_pq indexes)
+    - ef_search: HNSW candidate list size (hnsw index)
+
+    Raises ValueError if a value is not a positive integer.
+    """
+    params: Dict[str, int] = {}
+    for key in ("nprobe", "ef_search"):
+        if data.get(key) is None:
+            continue
+        try:
+            value = int(data[key])
+        except (TypeError, ValueError):
+            raise ValueError(f"{key} must be an integer")
+        if value < 1:
+            raise ValueError(f"{key} must be >= 1")
+        params[key] = value
+    return params
+
+
+# Agent prompt, compiled once and shared by every cached agent
+_AGENT_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            (
+                "You are a helpful company knowledge base assistant. "
+                "You have access to internal documents via the tool "
+                "`company_knowledge_search`. "
+                "Always call that tool before answering, and base your answer "
+                "only on retrieved content when possible.\n\n"
+                "When you respond:\n"
+                "1. Give a clear, concise answer.\n"
+                "2. At the end, add a 'Sources:' section listing each cited "
+                "document as 'Filename (Page X)'.\n"
+                "3. If the answer is not in the documents, say you don't know "
+                "rather than guessing."
+            ),
+        ),
+        MessagesPlaceholder("chat_history"),
+        ("human", "{input}"),
+        MessagesPlaceholder("agent_scratchpad"),
+    ]
+)
 
 
 def _build_kb_agent_with_history(
@@ -188,9 +503,18 @@ def _build_kb_agent_with_history(
     - Uses a retriever tool over your vector store
     - Has chat history per conversation_id
     - Returns answers grounded to retrieved docs
+
+    Per-request settings are passed through the runnable config when invoking:
+    configurable.session_id (conversation) and metadata.search_params (ANN knobs).
     """
     # 1. Retriever & tool
-    retriever = KBVectorRetriever(vector_store=vector_store, kb_ids=kb_ids, k=top_k)
+    retriever = KBVectorRetriever(
+        vector_store=vector_store,
+        kb_ids=kb_ids,
+        k=top_k,
+        neighbors=RETRIEVAL_NEIGHBORS,
+        reranker=reranker,
+    )
     retriever_tool = create_retriever_tool(
         retriever=retriever,
         name="company_knowledge_search",
@@ -204,36 +528,11 @@ def _build_kb_agent_with_history(
     # 2. LLM
     llm = _get_llm()
 
-    # 3. Prompt for the agent
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                (
-                    "You are a helpful company knowledge base assistant. "
-                    "You have access to internal documents via the tool "
-                    "`company_knowledge_search`. "
-                    "Always call that tool before answering, and base your answer "
-                    "only on retrieved content when possible.\n\n"
-                    "When you respond:\n"
-                    "1. Give a clear, concise answer.\n"
-                    "2. At the end, add a 'Sources:' section listing each cited "
-                    "document as 'Filename (Page X)'.\n"
-                    "3. If the answer is not in the documents, say you don't know "
-                    "rather than guessing."
-                ),
-            ),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}"),
-            MessagesPlaceholder("agent_scratchpad"),
-        ]
-    )
-
-    # 4. Build the agent + executor
-    agent = create_tool_calling_agent(llm=llm, tools=tools, prompt=prompt)
+    # 3. Build the agent + executor
+    agent = create_tool_calling_agent(llm=llm, tools=tools, prompt=_AGENT_PROMPT)
     executor = AgentExecutor(agent=agent, tools=tools, verbose=False)
 
-    # 5. Attach memory
+    # 4. Attach memory
     agent_with_history = RunnableWithMessageHistory(
         executor,
         _get_session_history,
@@ -243,29 +542,273 @@ def _build_kb_agent_with_history(
     return agent_with_history
 
 
-def _build_sources_for_question(
-    question: str, kb_ids: List[str], top_k: int = 5
-) -> List[Dict[str, Any]]:
+def _get_kb_agent(kb_ids: List[str], top_k: int = 5) -> RunnableWithMessageHistory:
+    """Return a cached agent for (kb_ids, top_k), building it on a miss (LRU)."""
+    key = (frozenset(kb_ids), top_k)
+    with _agent_cache_lock:
+        agent = _agent_cache.get(key)
+        if agent is not None:
+            _agent_cache.move_to_end(key)
+            return agent
+
+    agent = _build_kb_agent_with_history(kb_ids=kb_ids, top_k=top_k)
+    with _agent_cache_lock:
+        _agent_cache[key] = agent
+        _agent_cache.move_to_end(key)
+        while len(_agent_cache) > AGENT_CACHE_SIZE:
+            _agent_cache.popitem(last=False)
+    return agent
+
+
+def _invalidate_agents(kb_ids: Optional[List[str]] = None):
+    """Drop cached agents that cover any of `kb_ids` (all agents if None)."""
+    with _agent_cache_lock:
+        if kb_ids is None:
+            _agent_cache.clear()
+            return
+        changed = set(kb_ids)
+        for key in [key for key in _agent_cache if key[0] & changed]:
+            del _agent_cache[key]
+
+
+class RetrievalLogHandler(BaseCallbackHandler):
+    """
+    Request-scoped callback that records every document the agent's retriever
+    tool returned, so /ask can cite exactly what the agent saw without running
+    a second search.
+    """
+
+    def __init__(self):
+        self.documents: List[Document] = []
+
+    def on_retriever_end(self, documents, *, run_id, parent_run_id=None, **kwargs):
+        self.documents.extend(documents)
+
+
+def _sources_from_documents(docs: List[Document]) -> List[Dict[str, Any]]:
+    """
+    Build the `sources` JSON for the /ask response from retrieved documents.
+
+    A page retrieved by several tool calls is listed once, with its best score;
+    sources are ordered best first (lower distance = more similar).
+    """
+    best: Dict[Any, Dict[str, Any]] = {}
+    for doc in docs:
+        meta = doc.metadata or {}
+        key = (meta.get("doc_id"), meta.get("page"))
+        score = meta.get("score")
+        if key in best and (score is None or best[key]["score"] <= score):
+            continue
+        best[key] = {
+            "kb_id": meta.get("kb_id"),
+            "document_id": meta.get("doc_id"),
+            "filename": meta.get("filename"),
+            "page": meta.get("page"),
+            "score": score,
+        }
+
+    return sorted(
+        best.values(),
+        key=lambda s: s["score"] if s["score"] is not None else float("inf"),
+    )
+
+def _parse_ask_request(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Validate an /ask body and fill in defaults.
+
+    Returns {question, kb_ids, top_k, search_params, conversation_id};
+    raises ValueError with a client-facing message on bad input.
+    """
+    question = (data.get("question") or "").strip()
+    if not question:
+        raise ValueError("Field 'question' is required")
+
+    if not documents:
+        raise ValueError("No documents indexed yet")
+
+    kb_ids_in_req = data.get("kb_ids") or []
+    if kb_ids_in_req:
+        # Validate provided KBs
+        invalid = [kb for kb in kb_ids_in_req if kb not in knowledge_bases]
+        if invalid:
+            raise ValueError(f"Unknown KB IDs: {invalid}")
+        kb_ids = kb_ids_in_req
+    else:
+        # Default: all KBs
+        kb_ids = list(knowledge_bases.keys())
+
+    if not kb_ids:
+        raise ValueError("No knowledge bases available")
+
+    try:
+        top_k_raw = data.get("top_k", 5)
+        top_k = max(1, int(top_k_raw))
+    except (TypeError, ValueError):
+        raise ValueError("top_k must be an integer")
+
+    return {
+        "question": question,
+        "kb_ids": kb_ids,
+        "top_k": top_k,
+        "search_params": _parse_search_params(data),
+        "conversation_id": data.get("conversation_id") or str(uuid4()),
+    }
+
+
+def _parse_search_request(data: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Simple 'side' retrieval used to build the `sources` JSON for the /ask response.
-    This runs separately from the agent's tool calls but uses the same retriever.
+    Validate a /search body and fill in defaults.
+
+    Returns {query, kb_ids, doc_ids, tags, top_k, search_params};
+    raises ValueError with a client-facing message on bad input.
     """
-    retriever = KBVectorRetriever(vector_store=vector_store, kb_ids=kb_ids, k=top_k)
-    docs = retriever.get_relevant_documents(question)
+    query = (data.get("query") or "").strip()
+    if not query:
+        raise ValueError("Field 'query' is required")
+
+    if not documents:
+        raise ValueError("No documents indexed yet")
+
+    kb_ids_in_req = data.get("kb_ids") or []
+    if kb_ids_in_req:
+        invalid = [kb for kb in kb_ids_in_req if kb not in knowledge_bases]
+        if invalid:
+            raise ValueError(f"Unknown KB IDs: {invalid}")
+        kb_ids = kb_ids_in_req
+    else:
+        kb_ids = list(knowledge_bases.keys())
+
+    try:
+        top_k_raw = data.get("top_k", 10)
+        top_k = max(1, int(top_k_raw))
+    except (TypeError, ValueError):
+        raise ValueError("top_k must be an integer")
+
+    return {
+        "query": query,
+        "kb_ids": kb_ids,
+        "doc_ids": data.get("document_ids") or None,
+        "tags": data.get("tags") or None,
+        "top_k": top_k,
+        "search_params": _parse_search_params(data),
+    }
 
-    sources: List[Dict[str, Any]] = []
+
+def _search_results(params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Run a parsed /search request (embedding + FAISS; CPU-bound)."""
+    retriever = KBVectorRetriever(
+        vector_store=vector_store,
+        kb_ids=params["kb_ids"],
+        doc_ids=params["doc_ids"],
+        tags=params["tags"],
+        k=params["top_k"],
+        search_params=params["search_params"],
+        reranker=reranker,
+    )
+    docs = retriever.get_relevant_documents(params["query"])
+
+    results: List[Dict[str, Any]] = []
     for doc in docs:
         meta = doc.metadata or {}
-        sources.append(
+        results.append(
             {
                 "kb_id": meta.get("kb_id"),
                 "document_id": meta.get("doc_id"),
                 "filename": meta.get("filename"),
                 "page": meta.get("page"),
                 "score": meta.get("score"),
+                "rerank_score": meta.get("rerank_score"),
+                "snippet": doc.page_content,
             }
         )
-    return sources
+    return results
+
+
+def _ask_config(params: Dict[str, Any], callbacks: List[BaseCallbackHandler]) -> Dict[str, Any]:
+    """Runnable config carrying the per-request settings into a cached agent."""
+    return {
+        "configurable": {"session_id": params["conversation_id"]},
+        "metadata": {"search_params": params["search_params"]},
+        "callbacks": callbacks,
+    }
+
+
+def _answer_text(result: Any) -> str:
+    """AgentExecutor returns a dict; "output" contains the final reply."""
+    if isinstance(result, dict):
+        return result.get("output", "")
+    return str(result)
+
+
+def _lookup_cached_answer(params: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Any]:
+    """
+    Check the semantic answer cache for a new conversation's first question.
+
+    Returns (cached entry or None, question embedding or None). The embedding
+    is None when the cache doesn't apply (disabled, or a follow-up question
+    whose answer depends on the chat history). On a hit the turn is appended
+    to the conversation so follow-ups keep their context.
+    """
+    history = _get_session_history(params["conversation_id"])
+    if not answer_cache.enabled or history.messages:
+        return None, None
+
+    question_vec = answer_cache.embed(params["question"])
+    cached = answer_cache.lookup(question_vec, params["kb_ids"])
+    if cached is not None:
+        history.add_user_message(params["question"])
+        history.add_ai_message(cached["answer"])
+    return cached, question_vec
+
+
+def _store_cached_answer(
+    params: Dict[str, Any], question_vec: Any, answer: str, sources: List[Dict[str, Any]]
+):
+    """Remember a freshly generated answer (no-op if the cache didn't apply)."""
+    if question_vec is not None and answer:
+        answer_cache.store(question_vec, params["kb_ids"], answer, sources)
+
+
+def _ask_response(
+    params: Dict[str, Any], result: Any, retrieval_log: RetrievalLogHandler, question_vec: Any
+) -> Dict[str, Any]:
+    """/ask response body for an agent result; also fills the answer cache."""
+    answer_text = _answer_text(result)
+
+    # Sources = exactly the passages the agent's tool calls retrieved
+    sources = _sources_from_documents(retrieval_log.documents)
+    _store_cached_answer(params, question_vec, answer_text, sources)
+
+    return {
+        "answer": answer_text,
+        "sources": sources,
+        "conversation_id": params["conversation_id"],
+    }
+
+
+class StreamEventHandler(RetrievalLogHandler):
+    """
+    RetrievalLogHandler that also publishes /ask/stream events to a queue:
+    - ("sources", [...]) as soon as each retriever tool call finishes
+    - ("token", {"text": ...}) for every generated answer token
+    """
+
+    def __init__(self, events: "queue.Queue[Optional[Tuple[str, Any]]]"):
+        super().__init__()
+        self.events = events
+
+    def on_retriever_end(self, documents, *, run_id, parent_run_id=None, **kwargs):
+        super().on_retriever_end(documents, run_id=run_id, parent_run_id=parent_run_id, **kwargs)
+        self.events.put(("sources", _sources_from_documents(self.documents)))
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        if token:  # tool-call chunks carry no text
+            self.events.put(("token", {"text": token}))
+
+
+def _sse(event: str, data: Any) -> str:
+    """Format one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 # -----------------------------------------------------------------------------
 # KB endpoints
@@ -291,15 +834,17 @@ def handle_kb_collection():
 
     kb_id = str(uuid4())
     now = _now_iso()
-    knowledge_bases[kb_id] = {
-        "id": kb_id,
-        "name": name,
-        "description": description,
-        "visibility": visibility,
-        "created_at": now,
-        "updated_at": now,
-        "document_ids": [],
-    }
+    with _registry_lock:
+        knowledge_bases[kb_id] = {
+            "id": kb_id,
+            "name": name,
+            "description": description,
+            "visibility": visibility,
+            "created_at": now,
+            "updated_at": now,
+            "document_ids": [],
+        }
+        _save_registry()
 
     return jsonify(knowledge_bases[kb_id]), 201
 
@@ -323,10 +868,345 @@ def handle_single_kb(kb_id: str):
 # Document upload & management
 # -----------------------------------------------------------------------------
 
+SUPPORTED_EXTENSIONS = (".pdf", ".txt", ".docx")
+
+
+def _extract_pages(stored_path: str, filename: str, progress=None) -> List[Dict[str, Any]]:
+    """
+    Extract text pages ({"text", "metadata"}) from a stored upload.
+
+    `progress(pages_done, pages_total)` is forwarded to the PDF processor.
+    """
+    _, ext = os.path.splitext(stored_path)
+    ext = ext.lower()
+    if ext == ".pdf":
+        return pdf_processor.process_pdf(stored_path, progress=progress)
+    if ext == ".txt":
+        with open(stored_path, "r", encoding="utf-8", errors="ignore") as f:
+            text = f.read()
+    elif ext == ".docx":
+        # Lazy import; only needed if DOCX is actually used
+        from docx import Document as DocxDocument
+
+        docx_obj = DocxDocument(stored_path)
+        text = "\n".join(p.text for p in docx_obj.paragraphs)
+    else:
+        return []
+    if progress is not None:
+        progress(1, 1)
+    return [{"text": text, "metadata": {"filename": filename, "page": 1}}]
+
+
+# Uploads are copied to disk (and hashed) in blocks of this size
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _save_upload(file) -> Tuple[str, str, int]:
+    """
+    Stream an uploaded file to a temporary path in UPLOAD_FOLDER, hashing it
+    on the way, so memory use stays bounded by UPLOAD_CHUNK_SIZE.
+
+    Returns (temp_path, sha256 hex digest, size in bytes).
+    """
+    digest = hashlib.sha256()
+    size = 0
+    tmp_path = os.path.join(app.config["UPLOAD_FOLDER"], f".upload-{uuid4()}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            while True:
+                block = file.stream.read(UPLOAD_CHUNK_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+                f.write(block)
+                size += len(block)
+    except Exception:
+        # e.g. the client disconnected mid-upload
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size
+
+
+def _unsupported_type_error(filename: str) -> Optional[str]:
+    """Client-facing error if `filename` is not a supported document type."""
+    _, ext = os.path.splitext(secure_filename(filename))
+    if ext.lower() in SUPPORTED_EXTENSIONS:
+        return None
+    return f"Unsupported file type '{ext.lower()}'. Currently supported: .pdf, .txt, .docx"
+
+
+def _store_upload(tmp_path: str, content_hash: str, stored_filename: str) -> str:
+    """
+    Move a saved upload to its permanent path in UPLOAD_FOLDER, or reuse the
+    stored file of a document with the same content hash. Returns the path.
+    """
+    source = _find_document_by_hash(content_hash)
+    if source is not None and os.path.exists(source["path"]):
+        os.remove(tmp_path)
+        return source["path"]
+    # Keep the original file for later viewing and for the ingestion worker
+    stored_path = os.path.join(app.config["UPLOAD_FOLDER"], stored_filename)
+    os.replace(tmp_path, stored_path)
+    return stored_path
+
+
+def _remove_stored_file(path: Optional[str]):
+    """Delete an uploaded file unless another document still uses it (dedup copies share files)."""
+    with _registry_lock:
+        if not path or any(d.get("path") == path for d in documents.values()):
+            return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _find_document_by_hash(
+    content_hash: str,
+    kb_id: Optional[str] = None,
+    statuses: Optional[Tuple[str, ...]] = None,
+) -> Optional[Dict[str, Any]]:
+    """First document with this content hash (optionally in `kb_id` / with one of `statuses`)."""
+    for doc in list(documents.values()):
+        if (
+            doc.get("content_hash") == content_hash
+            and (kb_id is None or doc.get("kb_id") == kb_id)
+            and (statuses is None or doc.get("status") in statuses)
+        ):
+            return doc
+    return None
+
+
+# Statuses of a document that make a same-KB upload of the same bytes a duplicate;
+# one that failed (or was cancelled) is retried instead
+DEDUP_STATUSES = ("queued", "processing", "ready", "empty")
+
+
+def _retry_document(doc: Dict[str, Any], tmp_path: str) -> Dict[str, Any]:
+    """
+    Queue a failed document again (same record and tags), restoring its stored
+    file from `tmp_path`, a fresh upload of the same bytes, if it is gone.
+    """
+    if doc.get("path") and not os.path.exists(doc["path"]):
+        os.replace(tmp_path, doc["path"])
+    else:
+        os.remove(tmp_path)
+    return _update_document(doc["id"], status="queued", job_id=None, error=None) or doc
+
+
+def _update_document(doc_id: str, **fields) -> Optional[Dict[str, Any]]:
+    """Update and persist a document record; None if it no longer exists."""
+    with _registry_lock:
+        doc = documents.get(doc_id)
+        if doc is None:
+            return None
+        doc.update(fields, updated_at=_now_iso())
+        _save_registry()
+        return doc
+
+
+def _copy_indexed_document(doc: Dict[str, Any]) -> Optional[str]:
+    """
+    Index `doc` by reusing the pages and embeddings of an already ingested
+    document with the same content hash. Returns the resulting status, or
+    None if there is nothing to reuse. Call with _index_write_lock held.
+    """
+    with _registry_lock:
+        if doc["id"] not in documents:
+            return "cancelled"  # deleted meanwhile
+        src = _find_document_by_hash(doc["content_hash"], statuses=("ready", "empty"))
+    if src is None or src["id"] == doc["id"]:
+        return None
+    _drop_replaced_version(doc)
+    total = vector_store.copy_document(src["id"], doc["id"], doc["kb_id"], doc["filename"], doc["tags"])
+    _index_changed()
+    _update_document(doc["id"], page_count=src.get("page_count"), replacing=False)
+    return "ready" if total > 0 else "empty"
+
+
+def _drop_replaced_version(doc: Dict[str, Any]):
+    """
+    Remove the previous content of a document replaced in place (PUT), right
+    before its new content is indexed. Call with _index_write_lock held.
+    """
+    if doc.get("replacing"):
+        vector_store.delete_document(doc["id"])
+
+
+def _ingest_document(job: Dict[str, Any], report) -> str:
+    """
+    IngestionQueue worker: extract, chunk and index one uploaded document.
+
+    Progress is published through `report` as stage "extracting"
+    (pages_done/pages_total) then "indexing" (chunks_done/chunks_total).
+    """
+    doc_id = job["doc_id"]
+    with _registry_lock:
+        doc = documents.get(doc_id)
+    if doc is None:
+        return "cancelled"
+
+    if doc.get("content_hash"):
+        with _index_write_lock:
+            # An identical upload may have finished while this one was queued
+            status = _copy_indexed_document(doc)
+        if status is not None:
+            return status
+
+    report(stage="extracting")
+    pages = _extract_pages(
+        doc["path"],
+        doc["filename"],
+        progress=lambda done, total: report(pages_done=done, pages_total=total),
+    )
+    report(stage="indexing", pages_done=len(pages), pages_total=len(pages))
+
+    # Split pages into overlapping chunks and index them in one batch
+    chunks = text_chunker.chunk_pages(pages)
+    chunk_texts: List[str] = [chunk["text"] for chunk in chunks]
+    chunk_metas: List[Dict[str, Any]] = [
+        {
+            "kb_id": doc["kb_id"],
+            "doc_id": doc_id,
+            "filename": doc["filename"],
+            "page": chunk["page"],
+            "chunk": chunk["chunk"],
+            "char_start": chunk["char_start"],
+            "char_end": chunk["char_end"],
+            "tags": doc["tags"],
+        }
+        for chunk in chunks
+    ]
+    report(chunks_total=len(chunks))
+
+    with _index_write_lock:
+        with _registry_lock:
+            if doc_id not in documents:
+                return "cancelled"  # deleted or reset while extracting
+        if not doc.get("replacing") and vector_store.has_document(doc_id):
+            # Already indexed before an interrupted run could record it
+            return "ready"
+        _drop_replaced_version(doc)
+        # Store page text once (chunks and the /documents/<doc_id> viewer read it)
+        vector_store.add_pages(doc_id, doc["kb_id"], doc["filename"], doc["tags"], pages)
+        total_indexed = vector_store.add_documents(
+            chunk_texts,
+            chunk_metas,
+            progress=lambda done, total: report(chunks_done=done),
+        )
+        _index_changed()
+
+    _update_document(doc_id, page_count=len(pages), replacing=False)
+    _maybe_compact_index()
+    return "ready" if total_indexed > 0 else "empty"
+
+
+def _on_ingest_change(job: Dict[str, Any]):
+    """Mirror job status transitions onto the document record."""
+    doc = _update_document(job["doc_id"], status=job["status"], job_id=job["id"], error=job["error"])
+    if doc is None:
+        return
+    if job["status"] == "failed":
+        app.logger.error(f"Ingestion of {doc['filename']} failed: {job['error']}")
+    if job["status"] in ("ready", "empty"):
+        _invalidate_agents([doc["kb_id"]])
+        answer_cache.invalidate_kbs([doc["kb_id"]])
+
+
+# Uploads are ingested in the background by INGEST_WORKERS threads
+# (PDF pages additionally fan out to the PDF processor's process pool).
+# Only one server process, the holder of ingest.lock, runs ingestion jobs;
+# job progress is shared with the others through DATA_FOLDER/jobs.
+ingest_queue = IngestionQueue(
+    _ingest_document,
+    max_workers=int(os.environ.get("INGEST_WORKERS", "2")),
+    on_change=_on_ingest_change,
+    state_dir=os.path.join(app.config["DATA_FOLDER"], "jobs"),
+)
+_ingest_lease = ProcessLease(os.path.join(app.config["DATA_FOLDER"], "ingest.lock"))
+INGEST_POLL_INTERVAL = float(os.environ.get("INGEST_POLL_INTERVAL", "1.0"))
+
+
+def _claim_queued_documents():
+    """
+    In the ingestion process, start jobs for queued documents: new uploads
+    registered by any process, and jobs interrupted by a restart or by the
+    previous ingestion process exiting.
+    """
+    if not _ingest_lease.try_acquire():
+        return
+    active = ingest_queue.active_doc_ids()
+    with _registry_lock:
+        pending = [
+            d for d in documents.values()
+            if d.get("status") in ("queued", "processing") and d["id"] not in active
+        ]
+    # Also called from request handlers; submit() ignores documents that got a job meanwhile
+    for doc in pending:
+        ingest_queue.submit(doc["id"], kb_id=doc["kb_id"], filename=doc["filename"])
+
+
+def _ingest_poll_loop():
+    while True:
+        try:
+            _claim_queued_documents()
+        except Exception as e:
+            app.logger.error(f"Failed to claim queued documents: {e}")
+        time.sleep(INGEST_POLL_INTERVAL)
+
+
+
+# Deleted and replaced documents are tombstoned in the index; once enough vectors
+# are dead (compact_min / compact_ratio index params), a background thread
+# rewrites the index without them while searches keep running.
+_compaction_lock = threading.Lock()
+
+
+def _compact_index():
+    if not _compaction_lock.acquire(blocking=False):
+        return  # already running
+    try:
+        with _index_write_lock:
+            if vector_store.needs_compaction() and vector_store.compact():
+                _index_changed()
+    except Exception as e:
+        app.logger.error(f"Index compaction failed: {e}")
+    finally:
+        _compaction_lock.release()
+
+
+def _maybe_compact_index():
+    if vector_store.needs_compaction():
+        threading.Thread(target=_compact_index, name="index-compact", daemon=True).start()
+
+
+def _document_with_progress(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Document record plus live job progress while it is being ingested."""
+    if doc.get("status") in TERMINAL_STATUSES or not doc.get("job_id"):
+        return doc
+    job = ingest_queue.get(doc["job_id"])
+    if job is None:
+        return doc
+    doc = dict(doc)
+    doc["progress"] = {
+        key: job[key]
+        for key in ("stage", "pages_done", "pages_total", "chunks_done", "chunks_total")
+    }
+    return doc
+
+
 @app.route("/upload", methods=["POST"])
 def handle_upload():
     """
-    Upload one or more documents into a KB and index them into the vector DB.
+    Upload one or more documents into a KB and queue them for indexing.
+
+    Files are stored and registered with status "queued", then extracted,
+    chunked and embedded in the background (queued -> processing ->
+    ready | empty | failed). Poll /jobs/<job_id> or /documents for progress.
+
+    Uploads are identified by the SHA-256 of their bytes: a file already in
+    the target KB returns the existing document, and a file already ingested
+    elsewhere reuses its stored copy, pages and embeddings (ready at once).
 
     Form fields (multipart/form-data):
     - files: file(s)
@@ -343,112 +1223,75 @@ def handle_upload():
     tags_raw = request.form.get("tags") or ""
     tags = [t.strip() for t in tags_raw.split(",") if t.strip()]
 
-    uploaded_files = request.files.getlist("files")
-    new_docs: List[Dict[str, Any]] = []
+    uploaded_files = [f for f in request.files.getlist("files") if f and f.filename]
 
+    # Reject the whole request before storing anything if a type is unsupported
     for file in uploaded_files:
-        if not file or file.filename == "":
-            continue
+        error = _unsupported_type_error(file.filename)
+        if error is not None:
+            return jsonify({"error": error}), 400
 
+    new_docs: List[Dict[str, Any]] = []
+
+    for file in uploaded_files:
         orig_filename = secure_filename(file.filename)
-        file_bytes = file.read()
-        if not file_bytes:
+        tmp_path, content_hash, size = _save_upload(file)
+        if size == 0:
+            os.remove(tmp_path)
             continue
 
-        # Basic type detection
         _, ext = os.path.splitext(orig_filename)
         ext = ext.lower()
 
-        # Give every uploaded doc a fresh ID (no dedup for now)
-        doc_id = str(uuid4())
-        stored_filename = f"{doc_id}_{orig_filename}"
-        stored_path = os.path.join(app.config["UPLOAD_FOLDER"], stored_filename)
-
-        # Persist original file for later viewing
-        with open(stored_path, "wb") as f:
-            f.write(file_bytes)
-
-        # Extract text pages
-        try:
-            if ext == ".pdf":
-                pages = pdf_processor.process_pdf(stored_path)
-            elif ext == ".txt":
-                text = file_bytes.decode("utf-8", errors="ignore")
-                pages = [
-                    {
-                        "text": text,
-                        "metadata": {"filename": orig_filename, "page": 1},
-                    }
-                ]
-            elif ext == ".docx":
-                # Lazy import; only needed if DOCX is actually used
-                from io import BytesIO
-                from docx import Document as DocxDocument
-
-                docx_obj = DocxDocument(BytesIO(file_bytes))
-                text = "\n".join(p.text for p in docx_obj.paragraphs)
-                pages = [
-                    {
-                        "text": text,
-                        "metadata": {"filename": orig_filename, "page": 1},
-                    }
-                ]
-            else:
-                return (
-                    jsonify(
-                        {
-                            "error": f"Unsupported file type '{ext}'. "
-                                     "Currently supported: .pdf, .txt, .docx"
-                        }
-                    ),
-                    400,
-                )
-        except Exception as e:
-            app.logger.error(f"Error parsing file {orig_filename}: {e}")
-            return jsonify({"error": f"Failed to process {orig_filename}"}), 500
-
-        # Cache full pages by doc_id (for /documents/<doc_id> viewer)
-        document_cache.add_document(doc_id, pages)
+        existing = _find_document_by_hash(content_hash, kb_id=kb_id, statuses=DEDUP_STATUSES)
+        if existing is not None:
+            # Same bytes already in this KB (indexed or on their way)
+            os.remove(tmp_path)
+            new_docs.append({**existing, "deduplicated": True})
+            continue
 
-        # Index each page into the vector DB
-        total_indexed = 0
-        for page in pages:
-            page_text = (page.get("text") or "").strip()
-            if not page_text:
-                continue
+        failed = _find_document_by_hash(content_hash, kb_id=kb_id)
+        if failed is not None:
+            # An earlier ingestion of these bytes failed: retry it with this upload
+            new_docs.append({**_retry_document(failed, tmp_path), "retried": True})
+            continue
 
-            page_meta = page.get("metadata") or {}
-            page_num = page_meta.get("page", 1)
+        doc_id = str(uuid4())
+        stored_path = _store_upload(tmp_path, content_hash, f"{doc_id}_{orig_filename}")
 
-            metadata = {
+        now = _now_iso()
+        with _registry_lock:
+            documents[doc_id] = {
+                "id": doc_id,
                 "kb_id": kb_id,
-                "doc_id": doc_id,
                 "filename": orig_filename,
-                "page": page_num,
-                "doc_text": page_text,
+                "file_type": ext.lstrip("."),
+                "path": stored_path,
+                "content_hash": content_hash,
+                "status": "queued",
+                "job_id": None,
+                "error": None,
+                "tags": tags,
+                "page_count": None,
+                "created_at": now,
+                "updated_at": now,
             }
-            vector_store.add_document(page_text, metadata)
-            total_indexed += 1
-
-        now = _now_iso()
-        documents[doc_id] = {
-            "id": doc_id,
-            "kb_id": kb_id,
-            "filename": orig_filename,
-            "file_type": ext.lstrip("."),
-            "path": stored_path,
-            "status": "ready" if total_indexed > 0 else "empty",
-            "tags": tags,
-            "page_count": len(pages),
-            "created_at": now,
-            "updated_at": now,
-        }
-
-        kb = knowledge_bases[kb_id]
-        kb["document_ids"].append(doc_id)
-        kb["updated_at"] = now
-
-        new_docs.append(documents[doc_id])
+            doc = documents[doc_id]
+            kb = knowledge_bases[kb_id]
+            kb["document_ids"].append(doc_id)
+            kb["updated_at"] = now
+            _save_registry()
+
+        with _index_write_lock:
+            status = _copy_indexed_document(doc)
+        if status is not None:
+            doc = _update_document(doc_id, status=status) or doc
+            _invalidate_agents([kb_id])
+            answer_cache.invalidate_kbs([kb_id])
+        new_docs.append(dict(doc))
+
+    # The ingestion process picks up the queued documents
+    _claim_queued_documents()
 
     if not new_docs:
         return jsonify({"message": "No files processed", "documents": []}), 400
@@ -456,14 +1299,29 @@ def handle_upload():
     return (
         jsonify(
             {
-                "message": f"Uploaded {len(new_docs)} document(s) to KB '{kb_id}'",
+                "message": f"Queued {len(new_docs)} document(s) for KB '{kb_id}'",
                 "documents": new_docs,
             }
         ),
-        201,
+        202,
     )
 
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id: str):
+    """
+    GET /jobs/<job_id>
+
+    Status of an ingestion job: status (queued | processing | ready | empty |
+    failed | cancelled), stage (extracting | indexing), pages_done/pages_total,
+    chunks_done/chunks_total and error.
+    """
+    job = ingest_queue.get(job_id)
+    if not job:
+        return jsonify({"error": f"Job '{job_id}' not found"}), 404
+    return jsonify(job)
+
+
 @app.route("/documents", methods=["GET"])
 def list_documents():
     """
@@ -476,75 +1334,174 @@ def list_documents():
     if kb_id:
         docs = [d for d in docs if d.get("kb_id") == kb_id]
 
-    return jsonify({"documents": docs})
+    return jsonify({"documents": [_document_with_progress(d) for d in docs]})
 
 
 @app.route("/documents/<doc_id>", methods=["GET"])
 def get_document(doc_id: str):
     """
-    GET /documents/<doc_id>
+    GET /documents/<doc_id>?page=<n>&limit=<count>
+
+    Query (optional):
+    - page: 1-based position of the first page to return (default 1)
+    - limit: number of pages to return (default: all remaining)
 
     Returns:
     - document metadata
     - pages: list[{ text, metadata }]
+    - total_pages, page, limit
+
+    Pages are read from the page text stored at ingest; nothing is re-parsed.
     """
     doc = documents.get(doc_id)
     if not doc:
         return jsonify({"error": f"Document '{doc_id}' not found"}), 404
 
-    pages = document_cache.get_document(doc_id)
+    try:
+        page = int(request.args.get("page", 1))
+        limit = request.args.get("limit")
+        limit = int(limit) if limit is not None else None
+    except ValueError:
+        return jsonify({"error": "page and limit must be integers"}), 400
+    if page < 1 or (limit is not None and limit < 1):
+        return jsonify({"error": "page and limit must be >= 1"}), 400
+
+    # Empty while the document is still being ingested (or if nothing was extracted);
+    # the previous version's pages while a replacement is
+    cache_key = (doc_id, doc.get("content_hash"))
+    pages = document_cache.get_document(cache_key)
     if pages is None:
-        # Try to recompute from stored file as a fallback
-        stored_path = doc.get("path")
-        if stored_path and os.path.exists(stored_path):
-            _, ext = os.path.splitext(stored_path)
-            ext = ext.lower()
-            try:
-                if ext == ".pdf":
-                    pages = pdf_processor.process_pdf(stored_path)
-                elif ext == ".txt":
-                    with open(stored_path, "r", encoding="utf-8", errors="ignore") as f:
-                        text = f.read()
-                    pages = [
-                        {
-                            "text": text,
-                            "metadata": {
-                                "filename": doc.get("filename"),
-                                "page": 1,
-                            },
-                        }
-                    ]
-                elif ext == ".docx":
-                    from docx import Document as DocxDocument
-
-                    docx_obj = DocxDocument(stored_path)
-                    text = "\n".join(p.text for p in docx_obj.paragraphs)
-                    pages = [
-                        {
-                            "text": text,
-                            "metadata": {
-                                "filename": doc.get("filename"),
-                                "page": 1,
-                            },
-                        }
-                    ]
-                else:
-                    pages = []
-            except Exception as e:
-                app.logger.error(f"Failed to reprocess {stored_path}: {e}")
-                pages = []
-
-            document_cache.add_document(doc_id, pages)
-        else:
-            pages = []
+        pages = vector_store.get_pages(doc_id)
+        if pages and doc.get("status") in TERMINAL_STATUSES:
+            document_cache.add_document(cache_key, pages)
 
+    start = page - 1
+    end = len(pages) if limit is None else start + limit
     return jsonify(
         {
-            "document": doc,
-            "pages": pages,
+            "document": _document_with_progress(doc),
+            "pages": pages[start:end],
+            "total_pages": len(pages),
+            "page": page,
+            "limit": limit,
         }
     )
 
+@app.route("/documents/<doc_id>", methods=["DELETE"])
+def delete_document(doc_id: str):
+    """
+    DELETE /documents/<doc_id>
+
+    Removes a document from its KB and from search results. Its vectors are
+    tombstoned (dropped from the index files by the next background
+    compaction), and the stored file is deleted unless another document
+    shares it. A running ingestion job for it is cancelled.
+    """
+    with _registry_lock:
+        doc = documents.pop(doc_id, None)
+        if doc is None:
+            return jsonify({"error": f"Document '{doc_id}' not found"}), 404
+        kb = knowledge_bases.get(doc["kb_id"])
+        if kb is not None and doc_id in kb["document_ids"]:
+            kb["document_ids"].remove(doc_id)
+            kb["updated_at"] = _now_iso()
+        _save_registry()
+
+    with _index_write_lock:
+        removed = vector_store.delete_document(doc_id)
+        _index_changed()
+
+    _remove_stored_file(doc.get("path"))
+    document_cache.invalidate((doc_id, doc.get("content_hash")))
+    _invalidate_agents([doc["kb_id"]])
+    answer_cache.invalidate_kbs([doc["kb_id"]])
+    _maybe_compact_index()
+
+    return jsonify({"message": f"Document '{doc_id}' deleted", "vectors_removed": removed})
+
+
+@app.route("/documents/<doc_id>", methods=["PUT"])
+def replace_document(doc_id: str):
+    """
+    PUT /documents/<doc_id>
+
+    Replace a document's content in place (e.g. a revised policy), keeping
+    its id and KB. The new file is ingested in the background like an
+    upload; the previous version stays searchable until then and is removed
+    right before the new one is indexed.
+
+    Form fields (multipart/form-data):
+    - file: the new version
+    - tags: optional; comma-separated string (default: keep the current tags)
+    """
+    file = request.files.get("file")
+    if not file or not file.filename:
+        return jsonify({"error": "No file uploaded"}), 400
+    error = _unsupported_type_error(file.filename)
+    if error is not None:
+        return jsonify({"error": error}), 400
+
+    doc = documents.get(doc_id)
+    if doc is None:
+        return jsonify({"error": f"Document '{doc_id}' not found"}), 404
+    if doc.get("status") not in TERMINAL_STATUSES:
+        return jsonify({"error": f"Document '{doc_id}' is still being ingested"}), 409
+
+    tags = doc.get("tags") or []
+    if request.form.get("tags") is not None:
+        tags = [t.strip() for t in request.form["tags"].split(",") if t.strip()]
+
+    tmp_path, content_hash, size = _save_upload(file)
+    if size == 0:
+        os.remove(tmp_path)
+        return jsonify({"error": "Uploaded file is empty"}), 400
+    if content_hash == doc.get("content_hash") and tags == doc.get("tags"):
+        os.remove(tmp_path)
+        return jsonify({"message": "Document unchanged", "document": doc})
+
+    orig_filename = secure_filename(file.filename)
+    stored_path = _store_upload(tmp_path, content_hash, f"{doc_id}_{content_hash[:12]}_{orig_filename}")
+
+    with _registry_lock:
+        doc = documents.get(doc_id)
+        # Deleted or replaced by another request while the file was uploading
+        conflict = doc is None or doc.get("status") not in TERMINAL_STATUSES
+        if not conflict:
+            old_path = doc.get("path")
+            doc.update(
+                filename=orig_filename,
+                file_type=os.path.splitext(orig_filename)[1].lower().lstrip("."),
+                path=stored_path,
+                content_hash=content_hash,
+                tags=tags,
+                status="queued",
+                job_id=None,
+                error=None,
+                page_count=None,
+                replacing=True,
+                updated_at=_now_iso(),
+            )
+            _save_registry()
+    if conflict:
+        _remove_stored_file(stored_path)
+        return jsonify({"error": f"Document '{doc_id}' was changed by another request"}), 409
+
+    _remove_stored_file(old_path)
+
+    with _index_write_lock:
+        status = _copy_indexed_document(doc)
+    if status is not None:
+        doc = _update_document(doc_id, status=status) or doc
+        _invalidate_agents([doc["kb_id"]])
+        answer_cache.invalidate_kbs([doc["kb_id"]])
+        _maybe_compact_index()
+
+    # The ingestion process picks up the queued document
+    _claim_queued_documents()
+
+    return jsonify({"message": f"Replacing document '{doc_id}'", "document": dict(doc)}), 202
+
+
 # -----------------------------------------------------------------------------
 # ASK endpoint – Agentic KB Q&A
 # -----------------------------------------------------------------------------
@@ -559,7 +1516,9 @@ def handle_ask():
       "question": "string",          # required
       "kb_ids": ["kb1", "kb2"],      # optional; defaults to all KBs
       "conversation_id": "uuid",     # optional; new one created if missing
-      "top_k": 5                     # optional; default 5
+      "top_k": 5,                    # optional; default 5
+      "nprobe": 16,                  # optional; IVF recall/latency knob
+      "ef_search": 64                # optional; HNSW recall/latency knob
     }
 
     Response:
@@ -575,66 +1534,126 @@ def handle_ask():
         },
         ...
       ],
-      "conversation_id": "uuid"
+      "conversation_id": "uuid",
+      "cached": true                 # only present when served from the answer cache
     }
     """
-    data = request.json or {}
-    question = (data.get("question") or "").strip()
-    if not question:
-        return jsonify({"error": "Field 'question' is required"}), 400
-
-    if not documents:
-        return jsonify({"error": "No documents indexed yet"}), 400
-
-    kb_ids_in_req = data.get("kb_ids") or []
-    if kb_ids_in_req:
-        # Validate provided KBs
-        invalid = [kb for kb in kb_ids_in_req if kb not in knowledge_bases]
-        if invalid:
-            return jsonify({"error": f"Unknown KB IDs: {invalid}"}), 400
-        kb_ids = kb_ids_in_req
-    else:
-        # Default: all KBs
-        kb_ids = list(knowledge_bases.keys())
-
-    if not kb_ids:
-        return jsonify({"error": "No knowledge bases available"}), 400
-
     try:
-        top_k_raw = data.get("top_k", 5)
-        top_k = max(1, int(top_k_raw))
-    except (TypeError, ValueError):
-        return jsonify({"error": "top_k must be an integer"}), 400
+        params = _parse_ask_request(request.json or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    conversation_id = params["conversation_id"]
+
+    cached, question_vec = _lookup_cached_answer(params)
+    if cached is not None:
+        return jsonify(
+            {
+                "answer": cached["answer"],
+                "sources": cached["sources"],
+                "conversation_id": conversation_id,
+                "cached": True,
+            }
+        )
 
-    conversation_id = data.get("conversation_id") or str(uuid4())
+    # Cached agent for this KB scope (memory bound to conversation_id at invoke time)
+    agent = _get_kb_agent(kb_ids=params["kb_ids"], top_k=params["top_k"])
 
-    # Build agent (with memory bound to conversation_id)
-    agent = _build_kb_agent_with_history(kb_ids=kb_ids, top_k=top_k)
+    # Captures the agent's own retrievals for the `sources` list
+    retrieval_log = RetrievalLogHandler()
 
     try:
         result = agent.invoke(
-            {"input": question},
-            config={"configurable": {"session_id": conversation_id}},
+            {"input": params["question"]},
+            config=_ask_config(params, [retrieval_log]),
         )
     except Exception as e:
         app.logger.error(f"/ask agent error: {e}")
         return jsonify({"error": "Agent failed to answer"}), 500
 
-    # AgentExecutor returns a dict; "output" contains the final reply
-    if isinstance(result, dict):
-        answer_text = result.get("output", "")
-    else:
-        answer_text = str(result)
+    return jsonify(_ask_response(params, result, retrieval_log, question_vec))
 
-    # Build structured sources using the same KB filter
-    sources = _build_sources_for_question(question, kb_ids=kb_ids, top_k=top_k)
 
-    return jsonify(
-        {
-            "answer": answer_text,
-            "sources": sources,
-            "conversation_id": conversation_id,
-        }
+@app.route("/ask/stream", methods=["POST"])
+def handle_ask_stream():
+    """
+    POST /ask/stream
+
+    Same JSON body as /ask. Responds with Server-Sent Events:
+    - event: sources  data: [ {kb_id, document_id, filename, page, score}, ... ]
+                      (sent after every retrieval; the latest one wins)
+    - event: token    data: {"text": "..."}   incremental answer text
+    - event: done     data: {"answer": "...", "sources": [...], "conversation_id": "uuid"}
+    - event: error    data: {"error": "..."}
+
+    Answers served from the answer cache arrive as one sources/token/done burst
+    with "cached": true in the done event.
+    """
+    try:
+        params = _parse_ask_request(request.json or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    conversation_id = params["conversation_id"]
+    stream_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    cached, question_vec = _lookup_cached_answer(params)
+    if cached is not None:
+        body = (
+            _sse("sources", cached["sources"])
+            + _sse("token", {"text": cached["answer"]})
+            + _sse(
+                "done",
+                {
+                    "answer": cached["answer"],
+                    "sources": cached["sources"],
+                    "conversation_id": conversation_id,
+                    "cached": True,
+                },
+            )
+        )
+        return Response(body, mimetype="text/event-stream", headers=stream_headers)
+
+    agent = _get_kb_agent(kb_ids=params["kb_ids"], top_k=params["top_k"])
+    events: "queue.Queue[Optional[Tuple[str, Any]]]" = queue.Queue()
+    handler = StreamEventHandler(events)
+
+    def run_agent():
+        try:
+            result = agent.invoke(
+                {"input": params["question"]},
+                config=_ask_config(params, [handler]),
+            )
+            answer_text = _answer_text(result)
+            sources = _sources_from_documents(handler.documents)
+            _store_cached_answer(params, question_vec, answer_text, sources)
+            events.put(
+                (
+                    "done",
+                    {
+                        "answer": answer_text,
+                        "sources": sources,
+                        "conversation_id": conversation_id,
+                    },
+                )
+            )
+        except Exception as e:
+            app.logger.error(f"/ask/stream agent error: {e}")
+            events.put(("error", {"error": "Agent failed to answer"}))
+        finally:
+            events.put(None)
+
+    threading.Thread(target=run_agent, daemon=True).start()
+
+    def generate():
+        while True:
+            item = events.get()
+            if item is None:
+                return
+            yield _sse(*item)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers=stream_headers,
     )
 
 # -----------------------------------------------------------------------------
@@ -650,7 +1669,11 @@ def handle_search():
     {
       "query": "string",          # required
       "kb_ids": ["kb1", "kb2"],   # optional; default all
-      "top_k": 10                 # optional; default 10
+      "document_ids": ["doc1"],   # optional; restrict to these documents
+      "tags": ["benefits"],       # optional; restrict to documents with any of these tags
+      "top_k": 10,                # optional; default 10
+      "nprobe": 16,               # optional; IVF recall/latency knob
+      "ef_search": 64             # optional; HNSW recall/latency knob
     }
 
     Response:
@@ -668,47 +1691,25 @@ def handle_search():
       ]
     }
     """
-    data = request.json or {}
-    query = (data.get("query") or "").strip()
-    if not query:
-        return jsonify({"error": "Field 'query' is required"}), 400
-
-    if not documents:
-        return jsonify({"error": "No documents indexed yet"}), 400
-
-    kb_ids_in_req = data.get("kb_ids") or []
-    if kb_ids_in_req:
-        invalid = [kb for kb in kb_ids_in_req if kb not in knowledge_bases]
-        if invalid:
-            return jsonify({"error": f"Unknown KB IDs: {invalid}"}), 400
-        kb_ids = kb_ids_in_req
-    else:
-        kb_ids = list(knowledge_bases.keys())
-
     try:
-        top_k_raw = data.get("top_k", 10)
-        top_k = max(1, int(top_k_raw))
-    except (TypeError, ValueError):
-        return jsonify({"error": "top_k must be an integer"}), 400
+        params = _parse_search_request(request.json or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    retriever = KBVectorRetriever(vector_store=vector_store, kb_ids=kb_ids, k=top_k)
-    docs = retriever.get_relevant_documents(query)
+    return jsonify({"results": _search_results(params)})
 
-    results: List[Dict[str, Any]] = []
-    for doc in docs:
-        meta = doc.metadata or {}
-        results.append(
-            {
-                "kb_id": meta.get("kb_id"),
-                "document_id": meta.get("doc_id"),
-                "filename": meta.get("filename"),
-                "page": meta.get("page"),
-                "score": meta.get("score"),
-                "snippet": doc.page_content,
-            }
-        )
+# -----------------------------------------------------------------------------
+# STATS endpoint – cache counters for monitoring
+# -----------------------------------------------------------------------------
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    """
+    GET /stats
 
-    return jsonify({"results": results})
+    Cache counters of this worker process, for monitoring.
+    """
+    return jsonify({"document_cache": document_cache.stats()})
 
 # -----------------------------------------------------------------------------
 # RESET endpoint – wipe in-memory state
@@ -717,21 +1718,25 @@ def handle_search():
 @app.route("/reset", methods=["POST"])
 def handle_reset():
     """
-    Reset in-memory state:
-    - vector_store
+    Reset in-memory and persisted state:
+    - vector_store (and its on-disk index)
     - knowledge_bases (recreates default)
-    - documents
+    - documents and ingestion jobs (running jobs are cancelled)
     - document_cache
     - session histories
     """
-    global vector_store, document_cache, _session_histories
-
-    vector_store = VectorStore()
-    document_cache = DocumentCache(ttl=3600)
-    documents.clear()
-    knowledge_bases.clear()
-    _session_histories.clear()
-    _ensure_default_kb()
+    ingest_queue.clear()
+    with _index_write_lock, _registry_lock:
+        index_storage.clear()
+        vector_store.reload(repair=True)
+        _index_changed()
+        documents.clear()
+        knowledge_bases.clear()
+        _ensure_default_kb()
+    document_cache.clear()
+    session_store.clear()
+    _invalidate_agents()
+    answer_cache.clear()
 
     return jsonify({"message": "System reset successfully"})
 
@@ -740,7 +1745,33 @@ def handle_reset():
 # Entrypoint
 # -----------------------------------------------------------------------------
 
+_start_lock = threading.Lock()
+
+
+def start():
+    """
+    Load the index and start the background threads (ingestion polling, cache
+    expiry). Called once per server process before it serves requests: from
+    __main__, asgi.py and gunicorn.conf.py. Importing this module does neither,
+    so processes that only import it (e.g. the PDF processor's pool workers,
+    which re-import __main__) stay light and thread-free.
+    """
+    global vector_store, _index_generation
+    with _start_lock:
+        if vector_store is not None:
+            return
+        with _index_write_lock:
+            store = _new_vector_store()
+            _index_generation = index_storage.generation()
+            vector_store = store
+        document_cache.start_sweeper()
+        threading.Thread(target=_ingest_poll_loop, name="ingest-poll", daemon=True).start()
+
+
 if __name__ == "__main__":
     # Ensure upload folder exists
     os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+    # With the debug reloader, only the child process that serves requests starts up
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start()
     app.run(host="0.0.0.0", port=5000, debug=True)
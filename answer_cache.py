@@ -0,0 +1,84 @@
+from collections import OrderedDict
+import threading
+import time
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """
+    Cache of /ask answers keyed by question embedding + KB scope.
+
+    A lookup returns a stored answer when a previous question over the same
+    set of KBs has cosine similarity >= `threshold`. Entries expire after
+    `ttl` seconds, at most `max_entries` are kept (least recently used are
+    evicted first), and entries are invalidated when any of their KBs change.
+    """
+
+    def __init__(self, embed_fn, threshold=0.92, ttl=86400, max_entries=1000):
+        self.embed_fn = embed_fn  # list[str] -> 2D float32 array
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # entry id -> entry dict
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def embed(self, question):
+        """Unit-length embedding of a question (shared by lookup and store)."""
+        vec = self.embed_fn([question])[0].astype(np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def lookup(self, question_vec, kb_ids):
+        """Return the best cached entry for this KB scope above the threshold, or None."""
+        kb_key = frozenset(kb_ids)
+        now = time.time()
+        with self._lock:
+            expired = [eid for eid, e in self.entries.items() if now - e['timestamp'] >= self.ttl]
+            for eid in expired:
+                del self.entries[eid]
+
+            candidates = [(eid, e) for eid, e in self.entries.items() if e['kb_key'] == kb_key]
+            if not candidates:
+                return None
+
+            sims = np.stack([e['vector'] for _, e in candidates]) @ question_vec
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+
+            eid, entry = candidates[best]
+            self.entries.move_to_end(eid)
+            return entry
+
+    def store(self, question_vec, kb_ids, answer, sources):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.entries[self._next_id] = {
+                'kb_key': frozenset(kb_ids),
+                'vector': question_vec,
+                'answer': answer,
+                'sources': sources,
+                'timestamp': time.time(),
+            }
+            self._next_id += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate_kbs(self, kb_ids):
+        """Drop every entry whose KB scope includes one of `kb_ids`."""
+        changed = set(kb_ids)
+        with self._lock:
+            stale = [eid for eid, e in self.entries.items() if e['kb_key'] & changed]
+            for eid in stale:
+                del self.entries[eid]
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
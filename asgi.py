@@ -0,0 +1,104 @@
+# ASGI entrypoint: uvicorn asgi:app
+#
+# /ask and /search are served by async handlers: the agent runs with
+# `ainvoke`, so a question waiting on Gemini holds no thread, and embedding +
+# FAISS work goes to Api.cpu_executor. Blocking setup (syncing with other
+# processes, which may wait on the index lock and reload the index, and
+# building agents) runs on Starlette's thread pool. Every other route is the
+# Flask app, run on a bounded thread pool.
+
+import os
+
+import faiss
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+import Api
+
+# Split FAISS's OpenMP threads between uvicorn worker processes (WEB_CONCURRENCY)
+faiss.omp_set_num_threads(
+    max(1, (os.cpu_count() or 1) // int(os.environ.get("WEB_CONCURRENCY", "1")))
+)
+Api.start()
+
+
+async def _json_body(request: Request) -> dict:
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def ask(request: Request):
+    """Async POST /ask; same request and response body as Api.handle_ask."""
+    await run_in_threadpool(Api._sync_shared_state)
+    try:
+        params = Api._parse_ask_request(await _json_body(request))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    cached, question_vec = await Api.run_cpu_bound(Api._lookup_cached_answer, params)
+    if cached is not None:
+        return JSONResponse(
+            {
+                "answer": cached["answer"],
+                "sources": cached["sources"],
+                "conversation_id": params["conversation_id"],
+                "cached": True,
+            }
+        )
+
+    agent = await run_in_threadpool(Api._get_kb_agent, kb_ids=params["kb_ids"], top_k=params["top_k"])
+    retrieval_log = Api.RetrievalLogHandler()
+    try:
+        result = await agent.ainvoke(
+            {"input": params["question"]},
+            config=Api._ask_config(params, [retrieval_log]),
+        )
+    except Exception as e:
+        Api.app.logger.error(f"/ask agent error: {e}")
+        return JSONResponse({"error": "Agent failed to answer"}, status_code=500)
+
+    return JSONResponse(Api._ask_response(params, result, retrieval_log, question_vec))
+
+
+async def search(request: Request):
+    """Async POST /search; same request and response body as Api.handle_search."""
+    await run_in_threadpool(Api._sync_shared_state)
+    try:
+        params = Api._parse_search_request(await _json_body(request))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    results = await Api.run_cpu_bound(Api._search_results, params)
+    return JSONResponse({"results": results})
+
+
+_async_app = CORSMiddleware(
+    Starlette(
+        routes=[
+            Route("/ask", ask, methods=["POST"]),
+            Route("/search", search, methods=["POST"]),
+        ]
+    ),
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+ASYNC_PATHS = {"/ask", "/search"}
+
+# Threads for the synchronous Flask routes (uploads, documents, /ask/stream, ...)
+_flask_app = WSGIMiddleware(Api.app, workers=int(os.environ.get("WSGI_THREADS", "16")))
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] not in ASYNC_PATHS:
+        await _flask_app(scope, receive, send)
+    else:
+        await _async_app(scope, receive, send)
@@ -0,0 +1,119 @@
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Sentence = run of text up to (and including) terminal punctuation or a line break
+_SENTENCE_RE = re.compile(r"[^.!?\n]+(?:[.!?]+[\"')\]]*|\n+|$)|[.!?\n]+")
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_WORD_RE = re.compile(r"\S+")
+
+
+def approx_token_count(text: str) -> int:
+    """
+    Cheap token estimate: words and punctuation marks, plus a third for
+    WordPiece splitting of longer words. Errs on the high side.
+    """
+    tokens = _TOKEN_RE.findall(text)
+    return len(tokens) + sum(1 for t in tokens if len(t) > 6) // 3
+
+
+class TextChunker:
+    """
+    Splits page text into overlapping, sentence-aligned chunks for indexing.
+
+    Chunks hold at most `chunk_tokens` tokens (BGE-small truncates at 512),
+    consecutive chunks share roughly `overlap_tokens` tokens of trailing
+    sentences, and every chunk records the character span it covers in its
+    page so hits can be mapped back and expanded to their neighbours.
+    """
+
+    def __init__(
+        self,
+        chunk_tokens: int = 256,
+        overlap_tokens: int = 48,
+        count_tokens: Optional[Callable[[str], int]] = None,
+    ):
+        if overlap_tokens >= chunk_tokens:
+            raise ValueError("overlap_tokens must be smaller than chunk_tokens")
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.count_tokens = count_tokens or approx_token_count
+
+    def _units(self, text: str) -> List[Tuple[int, int, int]]:
+        """
+        (start, end, tokens) spans of sentences; sentences longer than a whole
+        chunk are broken up at word boundaries.
+        """
+        units: List[Tuple[int, int, int]] = []
+        for match in _SENTENCE_RE.finditer(text):
+            start, end = match.span()
+            if not text[start:end].strip():
+                continue
+            tokens = self.count_tokens(text[start:end])
+            if tokens <= self.chunk_tokens:
+                units.append((start, end, tokens))
+                continue
+
+            piece_start, piece_tokens = None, 0
+            for word in _WORD_RE.finditer(text, start, end):
+                word_tokens = self.count_tokens(word.group())
+                if piece_start is not None and piece_tokens + word_tokens > self.chunk_tokens:
+                    units.append((piece_start, word.start(), piece_tokens))
+                    piece_start, piece_tokens = None, 0
+                if piece_start is None:
+                    piece_start = word.start()
+                piece_tokens += word_tokens
+            if piece_start is not None:
+                units.append((piece_start, end, piece_tokens))
+        return units
+
+    def split(self, text: str) -> List[Tuple[int, int]]:
+        """Character spans (start, end) of the chunks of `text`."""
+        units = self._units(text)
+        spans: List[Tuple[int, int]] = []
+        i = 0
+        while i < len(units):
+            j, tokens = i, 0
+            while j < len(units) and (j == i or tokens + units[j][2] <= self.chunk_tokens):
+                tokens += units[j][2]
+                j += 1
+            spans.append((units[i][0], units[j - 1][1]))
+            if j == len(units):
+                break
+
+            # Step back over trailing sentences for the overlap, but always advance
+            next_i, overlap = j, 0
+            while next_i - 1 > i and overlap + units[next_i - 1][2] <= self.overlap_tokens:
+                next_i -= 1
+                overlap += units[next_i][2]
+            i = next_i
+        return spans
+
+    def chunk_pages(self, pages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Chunk extracted pages ({"text", "metadata": {"page"}}) of one document.
+
+        Returns [{"text", "page", "chunk", "char_start", "char_end"}, ...] where
+        `chunk` numbers the chunks of the whole document consecutively and the
+        char span is relative to the page text.
+        """
+        chunks: List[Dict[str, Any]] = []
+        for page in pages:
+            text = page.get("text") or ""
+            page_num = (page.get("metadata") or {}).get("page", 1)
+            for start, end in self.split(text):
+                raw = text[start:end]
+                chunk_text = raw.strip()
+                if not chunk_text:
+                    continue
+                start += len(raw) - len(raw.lstrip())
+                end = start + len(chunk_text)
+                chunks.append(
+                    {
+                        "text": chunk_text,
+                        "page": page_num,
+                        "chunk": len(chunks),
+                        "char_start": start,
+                        "char_end": end,
+                    }
+                )
+        return chunks
@@ -0,0 +1,141 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks only cover threads of one process
+    fcntl = None
+
+
+class InterProcessLock:
+    """
+    Reentrant lock shared by the threads of this process and by every other
+    process opening the same `path` (threading.RLock + fcntl.flock).
+
+    Used so several server workers can write the shared data directory one
+    at a time. `on_acquire` runs each time the lock is first taken by a
+    thread, e.g. to reload state another process changed.
+    """
+
+    def __init__(self, path, on_acquire=None):
+        self.path = path
+        self.on_acquire = on_acquire
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def _open(self):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        return self._fd
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._depth += 1
+        if self._depth == 1:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(self._open(), fcntl.LOCK_EX)
+                if self.on_acquire is not None:
+                    self.on_acquire()
+            except BaseException:
+                self._release()
+                raise
+        return self
+
+    def __exit__(self, *exc):
+        self._release()
+
+    def _release(self):
+        self._depth -= 1
+        if self._depth == 0 and fcntl is not None and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+
+class ReadWriteLock:
+    """
+    Thread lock with a shared side, held by any number of threads at once,
+    and an exclusive side, held by one thread while no one holds the shared
+    side. A thread waiting for the exclusive side holds off new shared
+    holders, so a steady stream of them can't starve it. Not reentrant.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            while self._exclusive or self._waiting:
+                self._cond.wait()
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                if self._shared == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._waiting += 1
+            try:
+                while self._exclusive or self._shared:
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+class ProcessLease:
+    """
+    Non-blocking exclusive flock on `path`, held for the life of the process
+    once acquired. Elects one process (e.g. the ingestion writer) among
+    several server workers; when it exits, another worker can take over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.held = False
+        self._fd = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.held:
+                return True
+            if fcntl is None:
+                self.held = True
+                return True
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            self.held = True
+            return True
+
+
+def file_stamp(path):
+    """(mtime_ns, size, inode) of `path`, or None; changes whenever the file is rewritten."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
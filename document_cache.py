@@ -1,33 +1,121 @@
-from collections import defaultdict
-import hashlib
+from collections import OrderedDict
+import threading
 import time
 
+# Rough per-page overhead (dicts, metadata, list slot) on top of the text itself
+PAGE_OVERHEAD_BYTES = 256
+
+
+def estimate_size(contents):
+    """Approximate memory held by a list of pages ({text, metadata} dicts)."""
+    size = 0
+    for page in contents:
+        text = page.get('text', '') if isinstance(page, dict) else str(page)
+        size += len(text) + PAGE_OVERHEAD_BYTES
+    return size
+
+
 class DocumentCache:
-    """Cache for processed PDF documents"""
-    
-    def __init__(self, ttl=3600):
-        self.cache = defaultdict(dict)
-        self.ttl = ttl  # 1 hour expiration
-
-    def _get_key(self, file_path):
-        return hashlib.md5(file_path.encode()).hexdigest()
-
-    def add_document(self, file_path, contents):
-        key = self._get_key(file_path)
-        self.cache[key] = {
-            'contents': contents,
-            'timestamp': time.time()
-        }
-
-    def get_document(self, file_path):
-        key = self._get_key(file_path)
-        entry = self.cache.get(key)
-        if entry and (time.time() - entry['timestamp']) < self.ttl:
-            return entry['contents']
-        return None
+    """
+    LRU cache of processed documents (page lists), keyed by doc_id.
+
+    The total estimated size (page text length) is kept under `max_bytes`:
+    least recently used documents are evicted first, and a document larger
+    than the whole budget is not cached. Entries expire after `ttl` seconds;
+    a background thread drops expired ones every `sweep_interval` seconds
+    (0 = not started; see start_sweeper()).
+    `stats()` reports hits, misses, evictions and current size.
+    """
+
+    def __init__(self, ttl=3600, max_bytes=64 * 1024 * 1024, sweep_interval=60):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()  # key -> (contents, size, timestamp)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+        self._sweeper = None
+        if sweep_interval:
+            self.start_sweeper(sweep_interval)
+
+    def start_sweeper(self, interval=60):
+        """Drop expired entries every `interval` seconds from a daemon thread (started once)."""
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(
+                target=self._sweep_loop, args=(interval,),
+                name="document-cache-sweep", daemon=True,
+            )
+            self._sweeper.start()
+
+    def add_document(self, key, contents):
+        size = estimate_size(contents)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self.cache[key] = (contents, size, time.time())
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.cache)))
+                self.evictions += 1
+
+    def get_document(self, key):
+        with self._lock:
+            entry = self.cache.get(key)
+            if entry is not None and time.time() - entry[2] >= self.ttl:
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
 
     def clear_expired(self):
         now = time.time()
-        expired = [k for k, v in self.cache.items() if (now - v['timestamp']) > self.ttl]
-        for k in expired:
-            del self.cache[k]
\ No newline at end of file
+        with self._lock:
+            # Insertion order is not timestamp order after move_to_end, so scan all
+            expired = [k for k, (_, _, ts) in self.cache.items() if now - ts >= self.ttl]
+            for k in expired:
+                self._remove(k)
+            self.expirations += len(expired)
+
+    def clear(self):
+        with self._lock:
+            self.cache.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.cache),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def _remove(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def _sweep_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            self.clear_expired()
@@ -3,15 +3,36 @@
 import Link from "next/link";
 import { StatusBadge } from "../shared/StatusBadge";
 
+interface IngestProgress {
+  stage: "extracting" | "indexing" | null;
+  pages_done: number;
+  pages_total: number | null;
+  chunks_done: number;
+  chunks_total: number | null;
+}
+
 interface Document {
   id: string;
   filename: string;
   kb_id: string;
   file_type: string;
   status: string;
+  error?: string | null;
+  progress?: IngestProgress;
   created_at: string;
 }
 
+function progressLabel(progress?: IngestProgress): string | null {
+  if (!progress || !progress.stage) return null;
+  if (progress.stage === "indexing" && progress.chunks_total) {
+    return `Indexing ${progress.chunks_done}/${progress.chunks_total} chunks`;
+  }
+  if (progress.pages_total) {
+    return `Page ${progress.pages_done}/${progress.pages_total}`;
+  }
+  return progress.stage === "indexing" ? "Indexing" : "Extracting";
+}
+
 interface DocumentsTableProps {
   documents: Document[];
 }
@@ -59,6 +80,14 @@ export function DocumentsTable({ documents }: DocumentsTableProps) {
                     doc.status as "Ready" | "Processing" | "Failed"
                   }
                 />
+                {progressLabel(doc.progress) && (
+                  <div className="text-xs text-gray-500 mt-1">
+                    {progressLabel(doc.progress)}
+                  </div>
+                )}
+                {doc.error && (
+                  <div className="text-xs text-red-500 mt-1">{doc.error}</div>
+                )}
               </td>
               <td className="px-6 py-4 whitespace-nowrap">
                 {new Date(doc.created_at).toLocaleDateString()}
@@ -10,6 +10,8 @@ export function StatusBadge({ status }: StatusBadgeProps) {
     colorClasses = "bg-green-100 text-green-800";
   } else if (lowerStatus === "processing") {
     colorClasses = "bg-yellow-100 text-yellow-800";
+  } else if (lowerStatus === "queued") {
+    colorClasses = "bg-blue-100 text-blue-800";
   } else if (lowerStatus === "failed" || lowerStatus === "error") {
     colorClasses = "bg-red-100 text-red-800";
   }
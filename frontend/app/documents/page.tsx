@@ -6,8 +6,18 @@ import { PageHeader } from "../components/shared/PageHeader";
 import useSWR from "swr";
 import { fetcher } from "@/lib/api";
 
+const PENDING_STATUSES = ["queued", "processing"];
+
 export default function DocumentsPage() {
-  const { data, error, isLoading } = useSWR("/documents", fetcher);
+  // Poll while any document is still being ingested
+  const { data, error, isLoading } = useSWR("/documents", fetcher, {
+    refreshInterval: (latest: any) =>
+      latest?.documents?.some((doc: any) =>
+        PENDING_STATUSES.includes(doc.status)
+      )
+        ? 2000
+        : 0,
+  });
   const [filter, setFilter] = useState("");
 
   const filteredDocuments = data?.documents?.filter((doc: any) =>
@@ -34,6 +44,7 @@ export default function DocumentsPage() {
           </select>
           <select className="mt-1 block w-full pl-3 pr-10 py-2 text-base border-gray-300 focus:outline-none focus:ring-indigo-500 focus:border-indigo-500 sm:text-sm rounded-md">
             <option>Filter by Status</option>
+            <option>Queued</option>
             <option>Ready</option>
             <option>Processing</option>
             <option>Failed</option>
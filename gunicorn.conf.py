@@ -0,0 +1,35 @@
+import os
+
+# Production server: gunicorn -c gunicorn.conf.py Api:app
+#
+# Every worker process serves /ask and /search from the same index files in
+# DATA_DIR; one of them (whichever holds data/ingest.lock) also runs
+# the ingestion jobs. See "Production mode" in readme.md.
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+
+# Threads per worker; /ask/stream holds one for the whole answer
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "8"))
+
+# /ask waits on the LLM, /upload may stream a large file
+timeout = int(os.environ.get("WEB_TIMEOUT", "300"))
+
+# Each worker loads the app itself: the ingestion and polling threads it
+# starts would not survive a fork from a preloaded master
+preload_app = False
+
+
+def post_fork(server, worker):
+    # Split FAISS's OpenMP threads between the workers instead of oversubscribing
+    import faiss
+
+    faiss.omp_set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+
+
+def post_worker_init(worker):
+    # Load the index and start the background threads in each worker
+    import Api
+
+    Api.start()
@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from uuid import uuid4
+
+# Job lifecycle: queued -> processing -> ready | empty | failed | cancelled
+TERMINAL_STATUSES = ("ready", "empty", "failed", "cancelled")
+
+
+def _now_iso():
+    return datetime.utcnow().isoformat() + "Z"
+
+
+class IngestionQueue:
+    """
+    Runs document ingestion jobs on a bounded pool of background threads.
+
+    `worker(job, report)` does the actual parsing/indexing. It calls
+    `report(**fields)` to publish progress (stage, pages_done, ...) and
+    returns the final status ("ready", "empty", "cancelled"); an exception
+    marks the job "failed". `on_change(job)` is called on every status
+    transition (not on progress updates) with a copy of the job.
+
+    Finished jobs are kept for polling; beyond `max_finished` the oldest
+    ones are forgotten. With `state_dir`, every job is also written there as
+    <job id>.json (progress at most every `persist_interval` seconds), so
+    other server processes can report jobs this one runs.
+    """
+
+    def __init__(self, worker, max_workers=2, on_change=None, max_finished=1000,
+                 state_dir=None, persist_interval=0.5):
+        self.worker = worker
+        self.on_change = on_change
+        self.max_finished = max_finished
+        self.state_dir = state_dir
+        self.persist_interval = persist_interval
+        self.jobs = OrderedDict()  # job id -> job dict
+        self._persisted_at = {}    # job id -> time of the last write to state_dir
+        self._finishing = set()    # job ids whose final status is not yet delivered to on_change
+        self._lock = threading.Lock()
+        if self.state_dir is not None:
+            os.makedirs(self.state_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ingest"
+        )
+
+    def submit(self, doc_id, **info):
+        """
+        Queue ingestion of `doc_id`; extra `info` (kb_id, filename, ...) is kept on the job.
+
+        If `doc_id` already has a queued or running job, that job is returned
+        and nothing new is started.
+        """
+        now = _now_iso()
+        job = {
+            **info,
+            "id": str(uuid4()),
+            "doc_id": doc_id,
+            "status": "queued",
+            "stage": None,
+            "pages_done": 0,
+            "pages_total": None,
+            "chunks_done": 0,
+            "chunks_total": None,
+            "error": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        with self._lock:
+            for existing in self.jobs.values():
+                if existing["doc_id"] == doc_id and self._is_active(existing):
+                    return dict(existing)
+            self.jobs[job["id"]] = job
+            self._persist(job, force=True)
+        self._notify(job)
+        self._executor.submit(self._run, job["id"])
+        return dict(job)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job:
+                return dict(job)
+        return self._read_persisted(job_id)
+
+    def active_doc_ids(self):
+        """Documents with a queued or running job in this process."""
+        with self._lock:
+            return {j["doc_id"] for j in self.jobs.values() if self._is_active(j)}
+
+    def _is_active(self, job):
+        return job["status"] not in TERMINAL_STATUSES or job["id"] in self._finishing
+
+    def list(self, status=None):
+        with self._lock:
+            return [dict(j) for j in self.jobs.values() if status is None or j["status"] == status]
+
+    def _update(self, job_id, **fields):
+        """Update a job in place; returns a copy, or None if it was cleared meanwhile."""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job.update(fields, updated_at=_now_iso())
+            self._persist(job, force="status" in fields)
+            return dict(job)
+
+    def _notify(self, job):
+        if job is not None and self.on_change is not None:
+            self.on_change(dict(job))
+
+    def _run(self, job_id):
+        job = self._update(job_id, status="processing")
+        if job is None:
+            return
+        self._notify(job)
+
+        # Still active until on_change has seen the final status, so the
+        # document is not queued again in between
+        with self._lock:
+            self._finishing.add(job_id)
+        try:
+            try:
+                status = self.worker(job, lambda **fields: self._update(job_id, **fields))
+                job = self._update(job_id, status=status or "ready", stage=None)
+            except Exception as e:
+                job = self._update(job_id, status="failed", stage=None, error=str(e) or type(e).__name__)
+            self._notify(job)
+        finally:
+            with self._lock:
+                self._finishing.discard(job_id)
+        self._forget_finished()
+
+    def _forget_finished(self):
+        with self._lock:
+            finished = [jid for jid, j in self.jobs.items() if j["status"] in TERMINAL_STATUSES]
+            for jid in finished[:max(0, len(finished) - self.max_finished)]:
+                del self.jobs[jid]
+                self._persisted_at.pop(jid, None)
+                self._remove_persisted(jid)
+
+    def clear(self):
+        """Forget every job; jobs already running finish but are no longer reported."""
+        with self._lock:
+            self.jobs.clear()
+            self._persisted_at.clear()
+            if self.state_dir is not None:
+                for name in os.listdir(self.state_dir):
+                    if name.endswith(".json"):
+                        self._remove_persisted(name[:-len(".json")])
+
+    # ------------------------------------------------------------------
+    # Job files shared with other processes (state_dir)
+    # ------------------------------------------------------------------
+
+    def _job_path(self, job_id):
+        return os.path.join(self.state_dir, f"{job_id}.json")
+
+    def _persist(self, job, force=False):
+        if self.state_dir is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._persisted_at.get(job["id"], 0) < self.persist_interval:
+            return
+        self._persisted_at[job["id"]] = now
+        path = self._job_path(job["id"])
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(job, f)
+        os.replace(path + ".tmp", path)
+
+    def _read_persisted(self, job_id):
+        if self.state_dir is None or os.path.basename(job_id) != job_id:
+            return None
+        try:
+            with open(self._job_path(job_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _remove_persisted(self, job_id):
+        if self.state_dir is None:
+            return
+        try:
+            os.remove(self._job_path(job_id))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,417 @@
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from metadata_store import GrowableArray
+
+# One row per (term, vector) pair; tf = occurrences of the term in the vector's text
+POSTING_DTYPE = np.dtype([("term", "<i4"), ("vec", "<i4"), ("tf", "<u2")])
+
+# Words, plus compounds like "401(k)", "i-9", "hr-102" or "w.4" (a closing
+# parenthesis is never part of a token, so "(FMLA)" gives "fmla")
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[-./()&]+[a-z0-9]+)*")
+_PART_RE = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from has have how i if in into is it its "
+    "my no not of on or our so that the their then there these they this to was we were "
+    "what when where which who why will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased terms of `text` for BM25.
+
+    Compounds are indexed whole with punctuation removed ("401(k)" -> "401k",
+    "I-9" -> "i9") and by their parts, so both spellings match.
+    """
+    terms: List[str] = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        parts = _PART_RE.findall(token)
+        if len(parts) > 1:
+            terms.append("".join(parts))
+            terms.extend(p for p in parts if len(p) > 1 or p.isdigit())
+        elif token not in STOPWORDS:
+            terms.append(token)
+    return terms
+
+
+class LexicalIndex:
+    """
+    Incremental BM25 inverted index over the vectors of a VectorStore (one
+    BM25 document per vector id, i.e. per chunk).
+
+    Postings are integer NumPy arrays: a compacted CSR part (term offsets ->
+    vector ids / term frequencies) plus a small tail of recent additions that
+    is merged in once it grows. When `data_dir` is given, the vocabulary,
+    postings and document lengths are appended to files there next to the
+    vector log, and reloaded on startup.
+
+    With `read_only`, loading never repairs (truncates) files another process
+    may be appending to, and additions stay in memory. refresh() reads what
+    was appended since, and make_writable() turns such an index into the
+    writer's.
+
+    Files written by an older tokenizer (TOKENIZER_VERSION) are discarded on
+    load; the owning VectorStore re-indexes the stored texts. `rewrote_files`
+    is set whenever the files were rewritten rather than appended to, which
+    readers cannot follow incrementally.
+    """
+
+    VOCAB_FILE = "lexical_vocab.txt"
+    POSTINGS_FILE = "lexical_postings.bin"
+    DOCLEN_FILE = "lexical_doclen.bin"
+    VERSION_FILE = "lexical_version"
+
+    TOKENIZER_VERSION = 2
+
+    MERGE_MIN = 100_000  # tail postings before a merge into the CSR part
+
+    def __init__(self, data_dir: Optional[str] = None, read_only: bool = False,
+                 k1: float = 1.2, b: float = 0.75):
+        self.data_dir = data_dir
+        self.read_only = read_only
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+
+        self._terms: List[str] = []
+        self._vocab: Dict[str, int] = {}
+        self._doclen = GrowableArray(np.int32)
+        self._total_len = 0
+
+        # Compacted postings: term t -> rows [_offsets[t], _offsets[t + 1])
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._post_vec = np.empty(0, dtype=np.int32)
+        self._post_tf = np.empty(0, dtype=np.uint16)
+        self._tail = GrowableArray(POSTING_DTYPE)
+
+        # How far the files have been read (a prefix of each)
+        self._vocab_bytes = 0
+        self._postings_rows = 0
+        self._unordered = False   # postings file holds orphans amid live rows (needs a rewrite)
+        self._stale = False       # files of an older tokenizer, ignored
+        self.rewrote_files = False
+
+        if self.data_dir is not None:
+            os.makedirs(self.data_dir, exist_ok=True)
+            self._load()
+
+    def __len__(self):
+        return len(self._doclen)
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.data_dir, name)
+
+    def _stored_version(self) -> Optional[int]:
+        """Tokenizer version of the files in data_dir; None when there are none yet."""
+        try:
+            with open(self._path(self.VERSION_FILE), "r", encoding="utf-8") as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            if os.path.exists(self._path(self.VOCAB_FILE)):
+                return 1  # written before the version was recorded
+            return None
+
+    def _write_version(self, data_dir: str):
+        with open(os.path.join(data_dir, self.VERSION_FILE), "w", encoding="utf-8") as f:
+            f.write(str(self.TOKENIZER_VERSION))
+
+    def _load(self):
+        version = self._stored_version()
+        if version not in (None, self.TOKENIZER_VERSION):
+            if self.read_only:
+                self._stale = True
+            else:
+                for name in (self.VOCAB_FILE, self.POSTINGS_FILE, self.DOCLEN_FILE):
+                    if os.path.exists(self._path(name)):
+                        os.remove(self._path(name))
+                self._write_version(self.data_dir)
+                self.rewrote_files = True
+            return  # empty: re-indexed from the stored texts
+        if version is None and not self.read_only:
+            self._write_version(self.data_dir)
+
+        self._read_appended()
+        self._compact()
+        if not self.read_only:
+            self._repair_files()
+
+    def _read_appended(self) -> int:
+        """
+        Read the vocabulary, lengths and postings appended past what is already
+        loaded; returns the number of new vectors.
+
+        Lengths are read first: add() writes them last, so every posting of a
+        vector with a recorded length (and every term it uses) is on disk by then.
+        """
+        doclen = np.empty(0, dtype=np.int32)
+        doclen_path = self._path(self.DOCLEN_FILE)
+        if os.path.exists(doclen_path):
+            count = os.path.getsize(doclen_path) // 4 - len(self)
+            if count > 0:
+                doclen = np.fromfile(doclen_path, dtype=np.int32, count=count, offset=len(self) * 4)
+
+        vocab_path = self._path(self.VOCAB_FILE)
+        if os.path.exists(vocab_path):
+            with open(vocab_path, "rb") as f:
+                f.seek(self._vocab_bytes)
+                data = f.read()
+            complete = data[:data.rfind(b"\n") + 1]  # drop a torn last line
+            self._vocab_bytes += len(complete)
+            for term in complete.decode("utf-8").splitlines():
+                self._vocab[term] = len(self._terms)
+                self._terms.append(term)
+
+        postings = np.empty(0, dtype=POSTING_DTYPE)
+        postings_path = self._path(self.POSTINGS_FILE)
+        if os.path.exists(postings_path):
+            count = os.path.getsize(postings_path) // POSTING_DTYPE.itemsize - self._postings_rows
+            if count > 0:
+                postings = np.fromfile(postings_path, dtype=POSTING_DTYPE, count=count,
+                                       offset=self._postings_rows * POSTING_DTYPE.itemsize)
+        # Postings of vectors whose length is not recorded yet (append in progress or interrupted)
+        keep = (postings["vec"] < len(self) + len(doclen)) & (postings["term"] < len(self._terms))
+        cut = int(np.argmin(keep)) if not keep.all() else len(keep)
+        if keep[cut:].any():
+            # Appends are in vector order, so the orphans are a suffix; a file
+            # rewritten by truncate()/compact_into() is term-ordered instead
+            postings = postings[keep]
+            self._postings_rows += len(keep)
+            self._unordered = True
+        else:
+            postings = postings[:cut]
+            self._postings_rows += cut
+
+        self._tail.extend(postings)
+        self._doclen.extend(doclen)
+        self._total_len += int(doclen.sum())
+        return len(doclen)
+
+    def _repair_files(self):
+        """Cut what an interrupted append left past the loaded prefix of each file."""
+        self._truncate_file(self.VOCAB_FILE, self._vocab_bytes)
+        if self._unordered:
+            self._rewrite_postings()
+        else:
+            self._truncate_file(self.POSTINGS_FILE, self._postings_rows * POSTING_DTYPE.itemsize)
+        self._truncate_file(self.DOCLEN_FILE, len(self) * 4)
+
+    def refresh(self) -> int:
+        """Catch up with what the writer appended since; returns the number of new vectors."""
+        if self.data_dir is None or self._stale:
+            return 0
+        with self._lock:
+            added = self._read_appended()
+            if len(self._tail) >= max(self.MERGE_MIN, len(self._post_vec) // 4):
+                self._compact()
+            return added
+
+    def make_writable(self):
+        """Turn a read_only index into the writer's (call while holding the writer's lock)."""
+        with self._lock:
+            if not self.read_only:
+                return
+            self.read_only = False
+            if self._stale:
+                self._stale = False
+                self._load()  # discards the old files
+            elif self.data_dir is not None:
+                self._repair_files()
+
+    def _truncate_file(self, name: str, size: int):
+        path = self._path(name)
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def _append_file(self, name: str, data: bytes):
+        with open(self._path(name), "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @property
+    def _persistent(self) -> bool:
+        return self.data_dir is not None and not self.read_only
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+
+    def add(self, texts: List[str]):
+        """Index the texts of the next len(texts) vector ids."""
+        with self._lock:
+            first_vec = len(self)
+            new_terms: List[str] = []
+            rows = []
+            lengths = np.empty(len(texts), dtype=np.int32)
+            for i, text in enumerate(texts):
+                terms = tokenize(text or "")
+                lengths[i] = len(terms)
+                counts: Dict[int, int] = {}
+                for term in terms:
+                    term_id = self._vocab.get(term)
+                    if term_id is None:
+                        term_id = self._vocab[term] = len(self._terms)
+                        self._terms.append(term)
+                        new_terms.append(term)
+                    counts[term_id] = counts.get(term_id, 0) + 1
+                vec = first_vec + i
+                rows.extend((term_id, vec, min(tf, 65535)) for term_id, tf in counts.items())
+            postings = np.array(rows, dtype=POSTING_DTYPE)
+
+            # Vocabulary, then postings, then lengths: on load, lengths mark what is complete
+            if self._persistent:
+                if new_terms:
+                    self._append_file(self.VOCAB_FILE, "".join(t + "\n" for t in new_terms).encode("utf-8"))
+                self._append_file(self.POSTINGS_FILE, postings.tobytes())
+                self._append_file(self.DOCLEN_FILE, lengths.tobytes())
+
+            self._tail.extend(postings)
+            self._doclen.extend(lengths)
+            self._total_len += int(lengths.sum())
+            if len(self._tail) >= max(self.MERGE_MIN, len(self._post_vec) // 4):
+                self._compact()
+
+    def truncate(self, count: int):
+        """Forget vectors with id >= count (e.g. beyond what the FAISS log holds)."""
+        with self._lock:
+            if count >= len(self):
+                return
+            postings = self._all_postings()
+            keep = postings["vec"] < count
+            self._doclen.truncate(count)
+            self._total_len = int(self._doclen.view().sum())
+            self._tail = GrowableArray(POSTING_DTYPE)
+            self._compact(postings[keep])
+            if self._persistent:
+                self._rewrite_postings()
+                self._truncate_file(self.DOCLEN_FILE, count * 4)
+            else:
+                # The dropped postings were the last ones read; read them again once complete
+                self._postings_rows = max(0, self._postings_rows - int(np.count_nonzero(~keep)))
+
+    def _rewrite_postings(self):
+        postings = self._all_postings()
+        tmp_path = self._path(self.POSTINGS_FILE) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(postings.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path(self.POSTINGS_FILE))
+        self._postings_rows = len(postings)
+        self._unordered = False
+        self.rewrote_files = True
+
+    def _all_postings(self) -> np.ndarray:
+        """Every posting (compacted part, then tail) as POSTING_DTYPE rows."""
+        sealed = np.empty(len(self._post_vec), dtype=POSTING_DTYPE)
+        sealed["term"] = np.repeat(
+            np.arange(len(self._offsets) - 1, dtype=np.int32), np.diff(self._offsets)
+        )
+        sealed["vec"] = self._post_vec
+        sealed["tf"] = self._post_tf
+        return np.concatenate([sealed, self._tail.view()])
+
+    def _compact(self, postings: Optional[np.ndarray] = None):
+        """Rebuild the CSR part from `postings` (default: all current postings), emptying the tail."""
+        if postings is None:
+            postings = self._all_postings()
+        order = np.argsort(postings["term"], kind="stable")
+        postings = postings[order]
+        counts = np.bincount(postings["term"], minlength=len(self._terms))
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        self._offsets = offsets
+        self._post_vec = np.ascontiguousarray(postings["vec"])
+        self._post_tf = np.ascontiguousarray(postings["tf"])
+        self._tail = GrowableArray(POSTING_DTYPE)
+
+    def compact_into(self, dest_dir: str, live_ids: np.ndarray):
+        """Write a copy of the index holding only `live_ids`, renumbered 0..n-1, to `dest_dir`."""
+        with self._lock:
+            os.makedirs(dest_dir, exist_ok=True)
+            remap = np.full(len(self), -1, dtype=np.int64)
+            remap[live_ids] = np.arange(len(live_ids))
+            postings = self._all_postings()
+            new_vecs = remap[postings["vec"]]
+            postings = postings[new_vecs >= 0]
+            postings["vec"] = new_vecs[new_vecs >= 0]
+
+            self._write_version(dest_dir)
+            with open(os.path.join(dest_dir, self.VOCAB_FILE), "wb") as f:
+                f.write("".join(t + "\n" for t in self._terms).encode("utf-8"))
+            postings.tofile(os.path.join(dest_dir, self.POSTINGS_FILE))
+            self._doclen.view()[live_ids].tofile(os.path.join(dest_dir, self.DOCLEN_FILE))
+
+    # ------------------------------------------------------------------
+    # Search
+    # ------------------------------------------------------------------
+
+    def _postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        vecs, tfs = np.empty(0, dtype=np.int32), np.empty(0, dtype=np.uint16)
+        if term_id + 1 < len(self._offsets):
+            start, end = self._offsets[term_id], self._offsets[term_id + 1]
+            vecs, tfs = self._post_vec[start:end], self._post_tf[start:end]
+        tail = self._tail.view()
+        if len(tail):
+            hits = tail[tail["term"] == term_id]
+            if len(hits):
+                vecs = np.concatenate([vecs, hits["vec"]])
+                tfs = np.concatenate([tfs, hits["tf"]])
+        return vecs, tfs
+
+    def search(self, query: str, k: int, allowed: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Top-k vector ids by BM25 score for `query`, as (vector id, score).
+
+        `allowed` (vector ids) restricts the candidates, e.g. to the KBs in scope.
+        """
+        # Only the lookups need the lock: add() and _compact() swap in new
+        # arrays rather than changing these, so scoring runs unlocked
+        with self._lock:
+            n = len(self)
+            term_ids = {self._vocab[t] for t in tokenize(query) if t in self._vocab}
+            if n == 0 or not term_ids:
+                return []
+            doclen = self._doclen.view()
+            avgdl = self._total_len / n or 1.0
+            postings = [self._postings(term_id) for term_id in term_ids]
+
+        mask = None
+        if allowed is not None:
+            mask = np.zeros(n, dtype=bool)
+            mask[allowed[allowed < n]] = True
+
+        all_vecs, all_scores = [], []
+        for vecs, tfs in postings:
+            if len(vecs) == 0:
+                continue
+            idf = np.log(1.0 + (n - len(vecs) + 0.5) / (len(vecs) + 0.5))
+            if mask is not None:
+                keep = mask[vecs]
+                vecs, tfs = vecs[keep], tfs[keep]
+            tf = tfs.astype(np.float32)
+            norm = self.k1 * (1.0 - self.b + self.b * doclen[vecs] / avgdl)
+            all_vecs.append(vecs)
+            all_scores.append(idf * tf * (self.k1 + 1.0) / (tf + norm))
+        if not all_vecs:
+            return []
+
+        vecs, inverse = np.unique(np.concatenate(all_vecs), return_inverse=True)
+        if len(vecs) == 0:
+            return []
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores))
+        k = min(k, len(vecs))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(vecs[i]), float(scores[i])) for i in top]
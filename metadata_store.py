@@ -0,0 +1,607 @@
+import os
+import json
+import mmap
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+from coordination import file_stamp
+
+# One row per extracted page; the page text lives in the text blob at [offset, offset + length)
+PAGE_DTYPE = np.dtype([("doc", "<i4"), ("page", "<i4"), ("offset", "<i8"), ("length", "<i4")])
+
+# One row per vector (vector id = row number); chunk char span is relative to the page text,
+# chunk = -1 / char_end = -1 when the vector covers the whole page
+VECTOR_DTYPE = np.dtype(
+    [("doc", "<i4"), ("page_row", "<i4"), ("chunk", "<i4"), ("char_start", "<i4"), ("char_end", "<i4")]
+)
+
+
+class GrowableArray:
+    """
+    Append-only NumPy array that doubles its buffer when full.
+
+    Readers get a view of the filled prefix; growth swaps in a new buffer, so a
+    view taken by a concurrent reader stays valid.
+    """
+
+    def __init__(self, dtype, data: Optional[np.ndarray] = None):
+        self._buf = np.empty(16, dtype=dtype)
+        self._size = 0
+        if data is not None:
+            self.extend(data)
+
+    def extend(self, rows: np.ndarray):
+        needed = self._size + len(rows)
+        if needed > len(self._buf):
+            buf = np.empty(max(needed, 2 * len(self._buf)), dtype=self._buf.dtype)
+            buf[:self._size] = self._buf[:self._size]
+            self._buf = buf
+        self._buf[self._size:needed] = rows
+        self._size = needed
+
+    def truncate(self, size: int):
+        self._size = min(self._size, size)
+
+    def view(self) -> np.ndarray:
+        return self._buf[:self._size]
+
+    def __len__(self):
+        return self._size
+
+
+class MetadataStore:
+    """
+    Compact, columnar metadata for the vectors of a VectorStore.
+
+    - documents: doc_id / kb_id / filename / tags, one small row per document
+    - pages: NumPy columns (doc row, page number, text offset/length); every
+      page's text is stored once, UTF-8 encoded, in an append-only text blob
+    - vectors: NumPy columns (doc row, page row, chunk number, char span), so a
+      vector costs 20 bytes of metadata instead of a Python dict
+
+    `store[vec_id]` materializes the familiar metadata dict on demand, with the
+    chunk text sliced out of its page. When `data_dir` is given, all tables are
+    appended to files there and the text blob is read through mmap.
+
+    With `read_only`, loading never repairs (truncates) files another process
+    may be appending to; the store only sees the complete rows. refresh()
+    reads the rows appended since, and make_writable() turns such a store
+    into the writer's.
+
+    Deleting a document only marks its row (a tombstone in docs.json): its
+    vectors drop out of every filter_ids() result right away, and
+    compact_into() writes a copy of the store without them.
+    """
+
+    DOCS_FILE = "docs.json"
+    PAGES_FILE = "pages.bin"
+    VECTORS_FILE = "vectors_meta.bin"
+    TEXT_FILE = "text.bin"
+
+    def __init__(self, data_dir: Optional[str] = None, read_only: bool = False):
+        self.data_dir = data_dir
+        self.read_only = read_only
+        self._lock = threading.RLock()
+
+        # Document table
+        self._doc_ids: List[str] = []
+        self._doc_kb: List[str] = []
+        self._doc_filename: List[str] = []
+        self._doc_tags: List[List[str]] = []
+        self._doc_first_vec: List[int] = []
+        self._doc_deleted: List[bool] = []
+        self._doc_rows: Dict[str, int] = {}      # live documents only
+        self.deleted_vectors = 0                 # vectors of deleted documents
+
+        self._pages = GrowableArray(PAGE_DTYPE)
+        self._page_rows: Dict[tuple, int] = {}   # (doc row, page number) -> page row
+        self._vectors = GrowableArray(VECTOR_DTYPE)
+
+        self._text = bytearray()                 # in-memory blob (no data_dir)
+        self._text_size = 0
+        self._text_map: Optional[mmap.mmap] = None
+        self._docs_stamp = None                  # docs.json version the document table was read from
+
+        if self.data_dir is not None:
+            os.makedirs(self.data_dir, exist_ok=True)
+            self._load()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.data_dir, name)
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def _load(self):
+        self._load_docs()
+        self._read_appended()
+        self._count_deleted()
+        if not self.read_only:
+            self._truncate_tails()
+
+    def _load_docs(self) -> bool:
+        """(Re)read the document table if docs.json changed; True if it did."""
+        docs_path = self._path(self.DOCS_FILE)
+        stamp = file_stamp(docs_path)
+        if stamp == self._docs_stamp:
+            return False
+        self._docs_stamp = stamp
+        docs = []
+        if os.path.exists(docs_path):
+            with open(docs_path, "r", encoding="utf-8") as f:
+                docs = json.load(f)
+        # Build the columns first, so concurrent readers never see a partial table;
+        # the table only grows until the next rewrite, and readers walk _doc_ids,
+        # so it goes in last
+        doc_deleted = [doc.get("deleted", False) for doc in docs]
+        doc_rows: Dict[str, int] = {}
+        for row, doc in enumerate(docs):
+            if not doc_deleted[row]:
+                doc_rows.setdefault(doc["doc_id"], row)
+        self._doc_kb = [doc["kb_id"] for doc in docs]
+        self._doc_filename = [doc["filename"] for doc in docs]
+        self._doc_tags = [list(doc["tags"] or []) for doc in docs]
+        self._doc_first_vec = [doc["first_vec"] for doc in docs]
+        self._doc_deleted = doc_deleted
+        self._doc_rows = doc_rows
+        self._doc_ids = [doc["doc_id"] for doc in docs]
+        return True
+
+    def _read_rows(self, name: str, dtype: np.dtype, start: int) -> np.ndarray:
+        """Complete rows of a table file from row `start` on."""
+        path = self._path(name)
+        if not os.path.exists(path):
+            return np.empty(0, dtype=dtype)
+        count = os.path.getsize(path) // dtype.itemsize - start
+        if count <= 0:
+            return np.empty(0, dtype=dtype)
+        return np.fromfile(path, dtype=dtype, count=count, offset=start * dtype.itemsize)
+
+    def _read_appended(self) -> np.ndarray:
+        """
+        Extend the page and vector tables with the complete rows past the ones
+        already loaded; returns the new vector rows.
+
+        Rows are cut at the first one pointing past what is loaded (text not in
+        the blob yet, unknown document or page): an append still in progress,
+        or interrupted.
+        """
+        text_path = self._path(self.TEXT_FILE)
+        self._text_size = os.path.getsize(text_path) if os.path.exists(text_path) else 0
+
+        pages = self._read_rows(self.PAGES_FILE, PAGE_DTYPE, len(self._pages))
+        incomplete = np.flatnonzero(
+            (pages["offset"] + pages["length"] > self._text_size) | (pages["doc"] >= len(self._doc_ids))
+        )
+        pages = pages[:incomplete[0]] if len(incomplete) else pages
+        first_row = len(self._pages)
+        self._pages.extend(pages)
+        for row, (doc, page) in enumerate(zip(pages["doc"].tolist(), pages["page"].tolist()), first_row):
+            self._page_rows.setdefault((doc, page), row)
+
+        vectors = self._read_rows(self.VECTORS_FILE, VECTOR_DTYPE, len(self._vectors))
+        dangling = np.flatnonzero(
+            (vectors["page_row"] >= len(self._pages)) | (vectors["doc"] >= len(self._doc_ids))
+        )
+        vectors = vectors[:dangling[0]] if len(dangling) else vectors
+        self._vectors.extend(vectors)
+        return vectors
+
+    def _truncate_tails(self):
+        """Cut rows left behind by an interrupted append so new rows line up."""
+        self._truncate_file(self.PAGES_FILE, len(self._pages) * PAGE_DTYPE.itemsize)
+        self._truncate_file(self.VECTORS_FILE, len(self._vectors) * VECTOR_DTYPE.itemsize)
+
+    def refresh(self) -> Set[str]:
+        """
+        Catch up with what another process appended (and the document table,
+        if it was rewritten) since this store was loaded, reading only the new
+        rows. Returns the kb_ids of documents whose vectors were added or deleted.
+        """
+        if self.data_dir is None:
+            return set()
+        with self._lock:
+            was_deleted = list(self._doc_deleted)
+            changed: Set[str] = set()
+            if self._load_docs():
+                changed.update(
+                    self._doc_kb[row] for row, deleted in enumerate(self._doc_deleted)
+                    if deleted and (row >= len(was_deleted) or not was_deleted[row])
+                )
+            vectors = self._read_appended()
+            changed.update(self._doc_kb[row] for row in np.unique(vectors["doc"]).tolist())
+            if changed:
+                self._count_deleted()
+            return changed
+
+    def make_writable(self):
+        """Turn a read_only store into the writer's (call while holding the writer's lock)."""
+        with self._lock:
+            if self.read_only and self.data_dir is not None:
+                self._truncate_tails()
+            self.read_only = False
+
+    def _truncate_file(self, name: str, size: int):
+        path = self._path(name)
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def _append_file(self, name: str, data: bytes):
+        with open(self._path(name), "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _save_docs(self):
+        docs = [
+            {
+                "doc_id": doc_id,
+                "kb_id": self._doc_kb[row],
+                "filename": self._doc_filename[row],
+                "tags": self._doc_tags[row],
+                "first_vec": self._doc_first_vec[row],
+                "deleted": self._doc_deleted[row],
+            }
+            for row, doc_id in enumerate(self._doc_ids)
+        ]
+        tmp_path = self._path(self.DOCS_FILE) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(docs, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path(self.DOCS_FILE))
+
+    def truncate(self, count: int):
+        """Forget vectors with id >= count (e.g. beyond what the FAISS log holds)."""
+        with self._lock:
+            if count >= len(self._vectors):
+                return
+            self._vectors.truncate(count)
+            self._count_deleted()
+            if self.data_dir is not None and not self.read_only:
+                self._truncate_file(self.VECTORS_FILE, count * VECTOR_DTYPE.itemsize)
+
+    def _deleted_mask(self) -> np.ndarray:
+        """Boolean per document row: True for deleted documents."""
+        return np.array(self._doc_deleted, dtype=bool)
+
+    def _count_deleted(self):
+        self.deleted_vectors = 0
+        if any(self._doc_deleted):
+            vector_docs = self._vectors.view()["doc"]
+            self.deleted_vectors = int(np.count_nonzero(self._deleted_mask()[vector_docs]))
+
+    # ------------------------------------------------------------------
+    # Text blob
+    # ------------------------------------------------------------------
+
+    def _append_text(self, data: bytes) -> int:
+        """Append encoded page text to the blob; returns its offset."""
+        offset = self._text_size
+        if self.data_dir is not None:
+            self._append_file(self.TEXT_FILE, data)
+        else:
+            self._text.extend(data)
+        self._text_size += len(data)
+        return offset
+
+    def _read_bytes(self, offset: int, length: int) -> bytes:
+        if length == 0:
+            return b""
+        if self.data_dir is None:
+            return bytes(self._text[offset:offset + length])
+        with self._lock:
+            if self._text_map is None or len(self._text_map) < offset + length:
+                if self._text_map is not None:
+                    self._text_map.close()
+                with open(self._path(self.TEXT_FILE), "rb") as f:
+                    self._text_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._text_map[offset:offset + length]
+
+    def _read_text(self, offset: int, length: int) -> str:
+        return self._read_bytes(offset, length).decode("utf-8")
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+
+    def _register_doc(self, doc_id, kb_id, filename, tags, first_vec=-1, persist=True, deleted=False) -> int:
+        row = self._doc_rows.get(doc_id)
+        if row is not None:
+            return row
+        row = len(self._doc_ids)
+        self._doc_ids.append(doc_id)
+        self._doc_kb.append(kb_id)
+        self._doc_filename.append(filename)
+        self._doc_tags.append(list(tags or []))
+        self._doc_first_vec.append(first_vec)
+        self._doc_deleted.append(deleted)
+        if not deleted:
+            self._doc_rows[doc_id] = row
+        if persist and self.data_dir is not None:
+            self._save_docs()
+        return row
+
+    def _add_page(self, doc_row: int, page_num: int, text: str) -> int:
+        data = text.encode("utf-8")
+        return self._add_page_ref(doc_row, page_num, self._append_text(data), len(data))
+
+    def _add_page_ref(self, doc_row: int, page_num: int, offset: int, length: int) -> int:
+        """Add a page row pointing at text already in the blob."""
+        row = len(self._pages)
+        page = np.array([(doc_row, page_num, offset, length)], dtype=PAGE_DTYPE)
+        self._pages.extend(page)
+        self._page_rows.setdefault((doc_row, page_num), row)
+        if self.data_dir is not None:
+            self._append_file(self.PAGES_FILE, page.tobytes())
+        return row
+
+    def add_pages(
+        self,
+        doc_id: str,
+        kb_id: Optional[str],
+        filename: Optional[str],
+        tags: Optional[List[str]],
+        pages: List[Dict[str, Any]],
+    ):
+        """Register a document and store the text of its extracted pages once."""
+        with self._lock:
+            doc_row = self._register_doc(doc_id, kb_id, filename, tags)
+            for page in pages:
+                page_num = (page.get("metadata") or {}).get("page", 1)
+                if (doc_row, page_num) not in self._page_rows:
+                    self._add_page(doc_row, page_num, page.get("text") or "")
+
+    def copy_pages(
+        self,
+        src_doc_id: str,
+        doc_id: str,
+        kb_id: Optional[str],
+        filename: Optional[str],
+        tags: Optional[List[str]],
+    ) -> int:
+        """
+        Register `doc_id` with the pages of `src_doc_id` (same bytes, e.g. a
+        re-upload). The page text is shared, not copied. Returns the page count.
+        """
+        with self._lock:
+            src_row = self._doc_rows.get(src_doc_id)
+            if src_row is None:
+                return 0
+            doc_row = self._register_doc(doc_id, kb_id, filename, tags)
+            pages = self._pages.view()
+            src_pages = sorted(
+                (page_num, row) for (doc, page_num), row in self._page_rows.items() if doc == src_row
+            )
+            for page_num, row in src_pages:
+                if (doc_row, page_num) not in self._page_rows:
+                    self._add_page_ref(doc_row, page_num, int(pages[row]["offset"]), int(pages[row]["length"]))
+            return len(src_pages)
+
+    def delete_doc(self, doc_id: str) -> int:
+        """
+        Tombstone a document: its vectors and pages stop being returned, and
+        `doc_id` can be registered again (e.g. with replaced content).
+        Returns the number of vectors it had.
+        """
+        with self._lock:
+            row = self._doc_rows.pop(doc_id, None)
+            if row is None:
+                return 0
+            self._doc_deleted[row] = True
+            removed = int(np.count_nonzero(self._vectors.view()["doc"] == row))
+            self.deleted_vectors += removed
+            if self.data_dir is not None:
+                self._save_docs()
+            return removed
+
+    def append(self, metadatas: List[dict], texts: Optional[List[str]] = None):
+        """
+        Add one vector row per metadata dict (kb_id, doc_id, filename, tags,
+        page, chunk, char_start, char_end).
+
+        Chunk vectors point into the page text registered with add_pages();
+        any other vector gets its own text (`doc_text`, else texts[i]) stored.
+        """
+        with self._lock:
+            rows = np.empty(len(metadatas), dtype=VECTOR_DTYPE)
+            docs_changed = False
+            first_id = len(self._vectors)
+            for i, meta in enumerate(metadatas):
+                doc_id = meta.get("doc_id")
+                doc_row = self._doc_rows.get(doc_id)
+                if doc_row is None:
+                    doc_row = self._register_doc(doc_id, meta.get("kb_id"), meta.get("filename"),
+                                                 meta.get("tags"), persist=False)
+                    docs_changed = True
+                if self._doc_first_vec[doc_row] < 0:
+                    self._doc_first_vec[doc_row] = first_id + i
+                    docs_changed = True
+
+                page_num = meta.get("page", 1)
+                page_row = self._page_rows.get((doc_row, page_num))
+                chunk = meta.get("chunk")
+                if page_row is None or chunk is None:
+                    # No stored page to point into: keep the vector's own text
+                    text = meta.get("doc_text")
+                    if text is None and texts is not None:
+                        text = texts[i]
+                    page_row = self._add_page(doc_row, page_num, text or "")
+                    chunk = None  # the vector covers its whole stored text
+
+                if chunk is None:
+                    rows[i] = (doc_row, page_row, -1, 0, -1)
+                else:
+                    rows[i] = (doc_row, page_row, chunk,
+                               meta.get("char_start", 0), meta.get("char_end", -1))
+
+            if docs_changed and self.data_dir is not None:
+                self._save_docs()
+            self._vectors.extend(rows)
+            if self.data_dir is not None:
+                self._append_file(self.VECTORS_FILE, rows.tobytes())
+
+    # ------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def _page_text(self, page_row: int) -> str:
+        page = self._pages.view()[page_row]
+        return self._read_text(int(page["offset"]), int(page["length"]))
+
+    def __getitem__(self, vec_id: int) -> dict:
+        """Metadata dict of a vector, including its chunk text as `doc_text`."""
+        vec = self._vectors.view()[vec_id]
+        doc_row, page_row = int(vec["doc"]), int(vec["page_row"])
+        text = self._page_text(page_row)
+        meta = {
+            "kb_id": self._doc_kb[doc_row],
+            "doc_id": self._doc_ids[doc_row],
+            "filename": self._doc_filename[doc_row],
+            "page": int(self._pages.view()[page_row]["page"]),
+            "tags": list(self._doc_tags[doc_row]),
+        }
+        if vec["chunk"] >= 0:
+            start, end = int(vec["char_start"]), int(vec["char_end"])
+            meta.update({"chunk": int(vec["chunk"]), "char_start": start, "char_end": end})
+            text = text[start:end]
+        meta["doc_text"] = text
+        return meta
+
+    def get_pages(self, doc_id: str) -> List[Dict[str, Any]]:
+        """Stored pages of a document as [{"text", "metadata": {...}}], in page order."""
+        doc_row = self._doc_rows.get(doc_id)
+        if doc_row is None:
+            return []
+        pages = self._pages.view()
+        rows = np.flatnonzero(pages["doc"] == doc_row)
+        rows = rows[np.argsort(pages["page"][rows], kind="stable")]
+        return [
+            {
+                "text": self._page_text(int(row)),
+                "metadata": {
+                    "doc_id": doc_id,
+                    "filename": self._doc_filename[doc_row],
+                    "page": int(pages["page"][row]),
+                },
+            }
+            for row in rows
+        ]
+
+    def filter_ids(
+        self,
+        kb_ids: Optional[Iterable[str]] = None,
+        doc_ids: Optional[Iterable[str]] = None,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Optional[np.ndarray]:
+        """
+        Sorted ids of the vectors whose document matches every given filter
+        (any listed value per filter), excluding deleted documents. None when
+        no filter is given and nothing is deleted.
+        """
+        if not (kb_ids or doc_ids or tags or self.deleted_vectors):
+            return None
+        kb_set = {kb_ids} if isinstance(kb_ids, str) else set(kb_ids or [])
+        doc_set = {doc_ids} if isinstance(doc_ids, str) else set(doc_ids or [])
+        tag_set = {tags} if isinstance(tags, str) else set(tags or [])
+
+        doc_rows = [
+            row for row, doc_id in enumerate(self._doc_ids)
+            if not self._doc_deleted[row]
+            and (not kb_set or self._doc_kb[row] in kb_set)
+            and (not doc_set or doc_id in doc_set)
+            and (not tag_set or tag_set.intersection(self._doc_tags[row]))
+        ]
+        return np.flatnonzero(np.isin(self._vectors.view()["doc"], doc_rows))
+
+    def chunk_vector_id(self, doc_id: str, chunk: int) -> Optional[int]:
+        """Vector id of chunk number `chunk` of a document, or None."""
+        doc_row = self._doc_rows.get(doc_id)
+        if doc_row is None or chunk < 0:
+            return None
+        vectors = self._vectors.view()
+        first = self._doc_first_vec[doc_row]
+        if first >= 0:
+            # Chunks of a document are added in order, so this is usually a direct hit
+            guess = first + chunk - int(vectors["chunk"][first])
+            if 0 <= guess < len(vectors) and vectors["doc"][guess] == doc_row and vectors["chunk"][guess] == chunk:
+                return guess
+        hits = np.flatnonzero((vectors["doc"] == doc_row) & (vectors["chunk"] == chunk))
+        return int(hits[0]) if len(hits) else None
+
+    # ------------------------------------------------------------------
+    # Compaction
+    # ------------------------------------------------------------------
+
+    def live_ids(self) -> np.ndarray:
+        """Sorted ids of the vectors of documents that are not deleted."""
+        return np.flatnonzero(~self._deleted_mask()[self._vectors.view()["doc"]])
+
+    def compact_into(self, dest_dir: str, live_ids: np.ndarray):
+        """
+        Write a copy of the store without deleted documents to `dest_dir`.
+
+        Vector `live_ids[i]` becomes vector i; page text shared by several
+        documents stays shared. Call with writes excluded (the index writer lock).
+        """
+        with self._lock:
+            os.makedirs(dest_dir, exist_ok=True)
+            live_docs = ~self._deleted_mask()
+            doc_map = np.cumsum(live_docs) - 1
+
+            pages = self._pages.view()
+            kept_pages = pages[live_docs[pages["doc"]]] if len(pages) else pages
+            page_map = np.cumsum(live_docs[pages["doc"]]) - 1 if len(pages) else pages["doc"]
+
+            # Copy each distinct text span once, in blob order
+            spans, inverse = np.unique(
+                np.stack([kept_pages["offset"], kept_pages["length"].astype(np.int64)], axis=1),
+                axis=0, return_inverse=True,
+            ) if len(kept_pages) else (np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.int64))
+            new_offsets = np.zeros(len(spans), dtype=np.int64)
+            with open(os.path.join(dest_dir, self.TEXT_FILE), "wb") as f:
+                position = 0
+                for i, (offset, length) in enumerate(spans.tolist()):
+                    new_offsets[i] = position
+                    f.write(self._read_bytes(offset, length))
+                    position += length
+                f.flush()
+                os.fsync(f.fileno())
+
+            new_pages = kept_pages.copy()
+            if len(new_pages):
+                new_pages["doc"] = doc_map[kept_pages["doc"]]
+                new_pages["offset"] = new_offsets[inverse.reshape(-1)]
+            new_pages.tofile(os.path.join(dest_dir, self.PAGES_FILE))
+
+            vectors = self._vectors.view()[live_ids].copy()
+            if len(vectors):
+                vectors["doc"] = doc_map[vectors["doc"]]
+                vectors["page_row"] = page_map[vectors["page_row"]]
+            vectors.tofile(os.path.join(dest_dir, self.VECTORS_FILE))
+
+            docs = []
+            for row in np.flatnonzero(live_docs).tolist():
+                first_vec = self._doc_first_vec[row]
+                if first_vec >= 0:
+                    pos = int(np.searchsorted(live_ids, first_vec))
+                    first_vec = pos if pos < len(live_ids) and live_ids[pos] == first_vec else -1
+                docs.append(
+                    {
+                        "doc_id": self._doc_ids[row],
+                        "kb_id": self._doc_kb[row],
+                        "filename": self._doc_filename[row],
+                        "tags": self._doc_tags[row],
+                        "first_vec": first_vec,
+                        "deleted": False,
+                    }
+                )
+            with open(os.path.join(dest_dir, self.DOCS_FILE), "w", encoding="utf-8") as f:
+                json.dump(docs, f)
@@ -1,15 +1,24 @@
 import os
 import time
 import hashlib
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
-import google.generativeai as genai
 from PyPDF2 import PdfReader
 from pdf2image import convert_from_path
 import pytesseract
 import faiss
 
 from fastembed import TextEmbedding  # ⬅️ FastEmbed ONNX backend
-from query import QueryBuilder
+from query import QueryBuilder, get_gemini_model
+from metadata_store import MetadataStore
+from chunking import approx_token_count
+from lexical_index import LexicalIndex
+from storage import is_mapped
+from coordination import ReadWriteLock
 
 
 
@@ -17,17 +26,194 @@ from query import QueryBuilder
 #Langchain
 #flowwise
 
+# Texts per ONNX inference call when embedding in bulk
+DEFAULT_EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "64"))
+
+# Supported FAISS index layouts for VectorStore(index_type=...)
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+DEFAULT_INDEX_PARAMS = {
+    "train_threshold": 10000,  # IVF indexes stay flat until the corpus reaches this size
+    "retrain_growth": 4.0,     # retrain IVF once the corpus grows this much since training
+    "nlist": None,             # IVF cells; None = sqrt(n) at training time
+    "nprobe": 16,              # default IVF cells visited per query
+    "pq_m": None,              # PQ sub-quantizers; None = largest of 48/32/.../1 dividing dim
+    "pq_bits": 8,
+    "hnsw_m": 32,
+    "ef_construction": 80,
+    "ef_search": 64,           # default HNSW candidate list size per query
+    "exact_filter_max": 4096,  # filtered searches over at most this many vectors are brute-forced
+    "compact_min": 1000,       # compact once deleted vectors reach this many ...
+    "compact_ratio": 0.1,      # ... and this fraction of the index
+}
+
+# Hybrid search: each retriever contributes HYBRID_DEPTH * k candidates to
+# reciprocal rank fusion, score(id) = sum over rankings of 1 / (RRF_K + rank)
+HYBRID_DEPTH = 4
+RRF_K = 60
+
 class VectorStore:
     """Handles document embeddings and semantic search using FastEmbed + BGE-small-en-v1.5"""
 
     _model = None  # Singleton embedding model (FastEmbed)
 
-    def __init__(self):
+    def __init__(self, storage=None, index_type: str = "flat", index_params: dict | None = None,
+                 hybrid: bool = True):
+        """
+        `storage` is an optional storage.IndexStorage; when given, the index and
+        metadata are reloaded from it and every new vector is appended to it.
+        Vector metadata lives in a columnar MetadataStore (`self.metadata`).
+
+        With `hybrid`, every vector's text is also indexed in a BM25
+        LexicalIndex (`self.lexical`, persisted next to the vector log) and
+        search() fuses lexical and FAISS rankings, so exact terms ("FMLA",
+        "401(k)", form numbers) are found even when the embedding misses them.
+
+        `index_type` is one of INDEX_TYPES. "flat" is exact brute force, "hnsw"
+        is a graph index, "ivf_flat"/"ivf_pq" are trained once the corpus
+        reaches `train_threshold` vectors (searched flat until then).
+        `index_params` overrides DEFAULT_INDEX_PARAMS.
+        """
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index_type '{index_type}', expected one of {INDEX_TYPES}")
         if VectorStore._model is None:
             # Uses ONNX under the hood, downloads once then cached locally
             VectorStore._model = TextEmbedding(model_name="BAAI/bge-small-en-v1.5")
+        self.index_type = index_type
+        self.index_params = {**DEFAULT_INDEX_PARAMS, **(index_params or {})}
+        self._trained_on = 0       # corpus size the current IVF index was trained on
         self.index = None          # faiss index will be created lazily
-        self.metadata: list[dict] = []
+        self.storage = storage
+        self.hybrid = hybrid
+        # Serializes writers (ingestion runs in background threads); searches never take it
+        self._lock = threading.RLock()
+        # Searches hold the shared side; adding to the index or swapping in a
+        # rebuilt/reloaded one takes the exclusive side, briefly
+        self._index_lock = ReadWriteLock()
+        # Loaded without repair: metadata and lexical additions are not persisted until reload(repair=True)
+        self.read_only = False
+        self._epoch = 0            # storage epoch the loaded files belong to (see sync())
+        if self.storage is None:
+            self.metadata = MetadataStore()
+            self.lexical = LexicalIndex() if hybrid else None
+        else:
+            self._load_from_storage(repair=True)
+
+    def _read_storage(self, repair: bool) -> tuple:
+        """Load (epoch, metadata, index, lexical) from storage, without installing them."""
+        epoch = self.storage.epoch()  # before reading: a rewrite meanwhile shows up in sync()
+        metadata = MetadataStore(self.storage.data_dir, read_only=not repair)
+        if repair:
+            legacy = self.storage.pop_legacy_metadata()
+            if legacy and len(metadata) == 0:
+                metadata.append(legacy)
+        count = min(len(metadata), self.storage.logged_vector_count())
+        index = self.storage.load(count, repair=repair)
+        metadata.truncate(count)
+        lexical = None
+        if self.hybrid:
+            lexical = LexicalIndex(self.storage.data_dir, read_only=not repair)
+            lexical.truncate(count)
+        return epoch, metadata, index, lexical
+
+    def _install(self, epoch: int, metadata: MetadataStore, index, lexical, repair: bool):
+        """Swap in loaded components (call holding the exclusive side of _index_lock)."""
+        self._epoch = epoch
+        self.read_only = not repair
+        self.metadata, self.lexical = metadata, lexical
+        self.index, self._trained_on = index, self._stored_training_size(index)
+
+    def _stored_training_size(self, index) -> int:
+        if index is None:
+            return 0
+        # Stores written before the training size was recorded count from now
+        return self.storage.trained_on or index.ntotal
+
+    def _load_from_storage(self, repair: bool):
+        # Searches keep running on the current copy while the new one is read
+        loaded = self._read_storage(repair)
+        with self._index_lock.exclusive():
+            self._install(*loaded, repair)
+        if repair:
+            self._finish_repair(len(self.metadata))
+
+    def _load_index(self, count: int, repair: bool):
+        index = self.storage.load(count, repair=repair)
+        with self._index_lock.exclusive():
+            self.index, self._trained_on = index, self._stored_training_size(index)
+
+    def _finish_repair(self, count: int):
+        """Writer-side upkeep after loading or syncing the first `count` vectors."""
+        if self.lexical is not None:
+            # Vectors indexed before the lexical index existed (or its last append was cut)
+            for start in range(len(self.lexical), count, 10000):
+                ids = range(start, min(start + 10000, count))
+                self.lexical.add([self.metadata[i]["doc_text"] for i in ids])
+            if self.lexical.rewrote_files:
+                # Readers can't follow a rewrite by reading on; make them reload
+                self.lexical.rewrote_files = False
+                self._epoch = self.storage.bump_epoch()
+        if self.index is not None and self._maybe_rebuild():
+            self.save()
+
+    def reload(self, repair: bool = False):
+        """
+        Re-read index and metadata from storage, e.g. after another process
+        rewrote it. Pass `repair=True` only while holding the writer's lock.
+        """
+        if self.storage is None:
+            return
+        with self._lock:
+            self._load_from_storage(repair)
+
+    def sync(self, repair: bool = False) -> set[str] | None:
+        """
+        Catch up with what other processes wrote to storage. Between rewrites
+        (compaction, reset) every file is append-only, so only the vectors,
+        metadata rows and postings past the loaded ones are read; after a
+        rewrite (a new storage epoch) everything is reloaded. With `repair`
+        (only while holding the writer's lock) the store also becomes writable.
+
+        Returns the kb_ids whose vectors were added or deleted, or None after
+        a full reload.
+        """
+        if self.storage is None:
+            return set()
+        with self._lock:
+            if self.storage.epoch() != self._epoch:
+                self._load_from_storage(repair)
+                return None
+
+            trained_on = self.storage.trained_on
+            self.storage.refresh()
+            changed = self.metadata.refresh()
+            count = min(len(self.metadata), self.storage.logged_vector_count())
+            self.metadata.truncate(count)
+
+            needs_reload = (
+                self.index is None
+                or self.storage.trained_on != trained_on      # retrained: take the new snapshot
+                or (is_mapped(self.index) and (repair or self.index.ntotal < count))
+            )
+            if needs_reload:
+                self._load_index(count, repair)
+            elif self.index is not None and self.index.ntotal < count:
+                with self._index_lock.exclusive():
+                    self.storage.extend(self.index, count)
+
+            if self.lexical is not None:
+                self.lexical.refresh()
+                self.lexical.truncate(count)
+
+            if repair:
+                if self.read_only:
+                    self.metadata.make_writable()
+                    self.storage.truncate_log(count)
+                    if self.lexical is not None:
+                        self.lexical.make_writable()
+                    self.read_only = False
+                self._finish_repair(count)
+            return changed
 
     @staticmethod
     def _normalize_text_input(text):
@@ -37,20 +223,159 @@ class VectorStore:
         return list(text)
 
     @staticmethod
-    def _embed_texts(texts: list[str]) -> np.ndarray:
+    def _embed_texts(texts: list[str], batch_size: int = DEFAULT_EMBED_BATCH_SIZE) -> np.ndarray:
         """
         Use FastEmbed to convert a list of strings into a 2D float32 array.
 
         FastEmbed's TextEmbedding.embed(...) returns a generator of np.ndarray,
-        so we materialize and stack them.
+        so we materialize and stack them. `batch_size` controls how many texts
+        go through the ONNX session per inference call.
         """
-        embeddings_list = list(VectorStore._model.embed(texts))
+        embeddings_list = list(VectorStore._model.embed(texts, batch_size=batch_size))
         if not embeddings_list:
             return np.empty((0, 0), dtype=np.float32)
 
         embeddings = np.vstack(embeddings_list).astype(np.float32)
         return embeddings
 
+    # ------------------------------------------------------------------
+    # Index construction (flat / HNSW / IVF-Flat / IVF-PQ)
+    # ------------------------------------------------------------------
+
+    def _new_index(self, dim: int, vectors: np.ndarray | None = None):
+        """
+        Create an empty index of the configured type.
+
+        IVF indexes are trained on `vectors`; without enough training data a
+        flat index is returned instead (L2 over normalized vectors ~ cosine ranking).
+        """
+        params = self.index_params
+        if self.index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(dim, params["hnsw_m"])
+            index.hnsw.efConstruction = params["ef_construction"]
+            index.hnsw.efSearch = params["ef_search"]
+            return index
+
+        if self.index_type == "flat" or vectors is None or len(vectors) < params["train_threshold"]:
+            return faiss.IndexFlatL2(dim)
+
+        n = len(vectors)
+        nlist = params["nlist"] or int(np.sqrt(n))
+        nlist = max(1, min(nlist, n))
+        quantizer = faiss.IndexFlatL2(dim)
+        if self.index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            pq_m = params["pq_m"] or next(m for m in (48, 32, 24, 16, 8, 4, 2, 1) if dim % m == 0)
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, params["pq_bits"])
+        # Bound training cost on large corpora with a random sample
+        max_train = 64 * max(nlist, 2 ** params["pq_bits"] if self.index_type == "ivf_pq" else 0)
+        if n > max_train:
+            sample = np.random.default_rng(0).choice(n, size=max_train, replace=False)
+            vectors = vectors[np.sort(sample)]
+        index.train(np.ascontiguousarray(vectors))
+        index.nprobe = params["nprobe"]
+        return index
+
+    def _index_matches_type(self) -> bool:
+        if self.index_type == "hnsw":
+            return isinstance(self.index, faiss.IndexHNSWFlat)
+        if self.index_type == "ivf_flat":
+            return isinstance(self.index, faiss.IndexIVFFlat)
+        if self.index_type == "ivf_pq":
+            return isinstance(self.index, faiss.IndexIVFPQ)
+        return isinstance(self.index, faiss.IndexFlat)
+
+    def _all_vectors(self) -> np.ndarray:
+        """All indexed vectors in id order (from the storage log, else reconstructed)."""
+        if self.storage is not None:
+            return np.ascontiguousarray(self.storage.read_vectors(0, self.index.ntotal))
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            ivf.make_direct_map()  # IVF-PQ reconstruction is lossy
+        return self.index.reconstruct_n(0, self.index.ntotal)
+
+    def _vectors_by_id(self, ids: np.ndarray) -> np.ndarray:
+        """Indexed vectors with the given ids (from the storage log, else reconstructed)."""
+        if self.storage is not None:
+            return np.ascontiguousarray(self.storage.read_vectors(0, self.index.ntotal)[ids])
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            ivf.make_direct_map()
+        return np.vstack([self.index.reconstruct(int(i)) for i in ids]).astype(np.float32)
+
+    def rebuild_index(self):
+        """
+        (Re)build the configured index type from every vector currently
+        indexed. The new index is built aside, so searches keep using the
+        current one until it is swapped in.
+        """
+        with self._lock:
+            if self.index is None or self.index.ntotal == 0:
+                return
+            vectors = self._all_vectors()
+            index = self._new_index(vectors.shape[1], vectors)
+            index.add(vectors)
+            with self._index_lock.exclusive():
+                self.index, self._trained_on = index, index.ntotal
+
+    def _maybe_rebuild(self) -> bool:
+        """
+        Rebuild when the index is not of the configured type yet (e.g. an IVF
+        store crossing `train_threshold`), or when a trained IVF index has
+        outgrown its training set by `retrain_growth`. Returns True if rebuilt.
+        """
+        ntotal = self.index.ntotal
+        if not self._index_matches_type():
+            needs_training = self.index_type in ("ivf_flat", "ivf_pq")
+            if needs_training and ntotal < self.index_params["train_threshold"]:
+                return False
+        elif not (faiss.try_extract_index_ivf(self.index) is not None
+                  and ntotal >= self._trained_on * self.index_params["retrain_growth"]):
+            return False
+        self.rebuild_index()
+        return True
+
+    def _add_embeddings(self, embeddings: np.ndarray, metadatas: list[dict], texts: list[str] | None = None):
+        """
+        Add pre-computed embeddings (one metadata dict per row) to FAISS.
+
+        `texts` are the embedded strings; they are stored as page text for
+        vectors whose page was not registered with add_pages().
+        """
+        with self._lock:
+            # Lazily initialize FAISS index with correct dimension
+            index = self.index if self.index is not None else self._new_index(embeddings.shape[1])
+
+            first_id = index.ntotal
+            # Vector log first, metadata second: on reload both are cut to the shorter one
+            if self.storage is not None:
+                self.storage.append(embeddings)
+            self.metadata.append(metadatas, texts)
+            if self.lexical is not None:
+                # Lexical index next; on reload it is cut to, or backfilled up to, the same count
+                if texts is None:
+                    texts = [self.metadata[i]["doc_text"] for i in range(first_id, first_id + len(embeddings))]
+                self.lexical.add(texts)
+            # FAISS last: searches only return ids below index.ntotal, so they see
+            # the new vectors once everything about them is in place
+            with self._index_lock.exclusive():
+                index.add(embeddings)
+                self.index = index
+
+            rebuilt = self._maybe_rebuild()
+            if self.storage is not None:
+                if rebuilt:
+                    self.storage.snapshot(self.index, self._trained_on)
+                else:
+                    self.storage.maybe_snapshot(self.index, self._trained_on)
+
+    def save(self):
+        """Write a FAISS snapshot to storage (no-op for in-memory stores)."""
+        with self._lock:
+            if self.storage is not None and self.index is not None:
+                self.storage.snapshot(self.index, self._trained_on)
+
     def add_document(self, text, metadata: dict):
         """
         Add a document (or list of chunks) to the FAISS index.
@@ -64,94 +389,541 @@ class VectorStore:
         if embeddings.size == 0:
             return  # nothing to index
 
-        # Lazily initialize FAISS index with correct dimension
-        if self.index is None:
-            dim = embeddings.shape[1]
-            self.index = faiss.IndexFlatL2(dim)  # L2 over normalized vectors ~ cosine ranking
-
-        self.index.add(embeddings)
         # One metadata entry per vector
-        self.metadata.extend([metadata] * embeddings.shape[0])
+        self._add_embeddings(embeddings, [metadata] * embeddings.shape[0], texts)
+
+    def add_documents(
+        self,
+        texts: list[str],
+        metadatas: list[dict],
+        batch_size: int = DEFAULT_EMBED_BATCH_SIZE,
+        progress=None,
+    ) -> int:
+        """
+        Bulk-ingest many texts at once (e.g. every page of an uploaded file).
+
+        All texts are embedded in `batch_size` batches by FastEmbed and then
+        added to FAISS with a single `index.add` call. `metadatas[i]` belongs
+        to `texts[i]`. `progress(texts_embedded, len(texts))` is called after
+        each batch. Returns the number of vectors added.
+        """
+        if len(texts) != len(metadatas):
+            raise ValueError(
+                f"texts and metadatas must have the same length "
+                f"({len(texts)} != {len(metadatas)})"
+            )
+        if not texts:
+            return 0
+
+        texts = list(texts)
+        if progress is None:
+            embeddings = self._embed_texts(texts, batch_size=batch_size)
+        else:
+            parts = []
+            for start in range(0, len(texts), batch_size):
+                parts.append(self._embed_texts(texts[start:start + batch_size], batch_size=batch_size))
+                progress(min(start + batch_size, len(texts)), len(texts))
+            embeddings = np.vstack(parts)
+        if embeddings.size == 0:
+            return 0
+
+        self._add_embeddings(embeddings, list(metadatas), texts)
+        return embeddings.shape[0]
+
+    def add_pages(self, doc_id: str, kb_id: str, filename: str, tags: list[str], pages: list[dict]):
+        """
+        Store a document's extracted pages ({"text", "metadata": {"page"}}) once.
+
+        Chunk vectors added afterwards with matching doc_id/page reference this
+        text by char span instead of carrying a copy.
+        """
+        self.metadata.add_pages(doc_id, kb_id, filename, tags, pages)
+
+    def copy_document(self, src_doc_id: str, doc_id: str, kb_id: str, filename: str, tags: list[str]) -> int:
+        """
+        Index `doc_id` with the pages and embeddings of `src_doc_id` (an upload
+        with identical content), without extracting or embedding anything.
+        Returns the number of vectors added.
+        """
+        with self._lock:
+            ids = self.metadata.filter_ids(doc_ids=[src_doc_id])
+            if ids is None or len(ids) == 0:
+                return 0
+            embeddings = self._vectors_by_id(ids)
+            self.metadata.copy_pages(src_doc_id, doc_id, kb_id, filename, tags)
+
+            metadatas = []
+            for vec_id in ids:
+                meta = self.metadata[int(vec_id)]
+                if "chunk" in meta:
+                    del meta["doc_text"]  # sliced from the shared page text instead
+                meta.update({"doc_id": doc_id, "kb_id": kb_id, "filename": filename, "tags": tags})
+                metadatas.append(meta)
+            self._add_embeddings(embeddings, metadatas)
+            return len(metadatas)
+
+    def delete_document(self, doc_id: str) -> int:
+        """
+        Remove a document from search results (tombstone). Its vectors stay in
+        FAISS, filtered out, until compact(). Returns the number of vectors removed.
+        """
+        with self._lock:
+            return self.metadata.delete_doc(doc_id)
+
+    def needs_compaction(self) -> bool:
+        deleted = self.metadata.deleted_vectors
+        return (
+            deleted >= self.index_params["compact_min"]
+            and deleted >= self.index_params["compact_ratio"] * len(self.metadata)
+        )
+
+    def compact(self) -> bool:
+        """
+        Rewrite the stored index without deleted documents: vector log, FAISS
+        snapshot, metadata and lexical index (vector ids are renumbered).
+        Searches keep running on the current data while the copy is written;
+        the caller must hold the writer lock so nothing is added meanwhile.
+        Returns False when there is nothing to compact (or no storage).
+        """
+        if self.storage is None or self.metadata.deleted_vectors == 0:
+            return False
+        live_ids = self.metadata.live_ids()
+        tmp_dir = self.storage.compaction_dir()
+
+        compacted = type(self.storage)(tmp_dir)
+        if len(live_ids):
+            vectors = self._vectors_by_id(live_ids)
+            index = self._new_index(vectors.shape[1], vectors)
+            index.add(vectors)
+            compacted.append(vectors)
+            compacted.snapshot(index, index.ntotal)
+        self.metadata.compact_into(tmp_dir, live_ids)
+        if self.lexical is not None:
+            self.lexical.compact_into(tmp_dir, live_ids)
+
+        with self._lock:
+            # The old files go away here, so searches wait for the compacted copy
+            with self._index_lock.exclusive():
+                self.storage.replace_with(tmp_dir)
+                self._install(*self._read_storage(repair=True), repair=True)
+            self._finish_repair(len(self.metadata))
+        return True
 
-    def search(self, query: str, k: int = 5):
+    def has_document(self, doc_id: str) -> bool:
+        """True if any vector of `doc_id` is indexed."""
+        ids = self.metadata.filter_ids(doc_ids=[doc_id])
+        return ids is not None and len(ids) > 0
+
+    def get_pages(self, doc_id: str) -> list[dict]:
+        """Stored pages of a document, in page order (empty if unknown)."""
+        return self.metadata.get_pages(doc_id)
+
+    def expand_with_neighbors(self, meta: dict, window: int = 1) -> str:
+        """
+        Text of a chunk hit merged with up to `window` chunks on each side of it
+        in the same document. Overlapping spans of consecutive chunks on the
+        same page are only included once.
+        """
+        seq = meta.get("chunk")
+        if window <= 0 or seq is None:
+            return meta.get("doc_text", "")
+
+        text, prev = "", None
+        for neighbor_seq in range(seq - window, seq + window + 1):
+            vec_id = self.metadata.chunk_vector_id(meta.get("doc_id"), neighbor_seq)
+            if vec_id is None:
+                continue
+            neighbor = self.metadata[vec_id]
+            part = neighbor.get("doc_text", "")
+            if (
+                prev is not None
+                and prev.get("page") == neighbor.get("page")
+                and neighbor["char_start"] < prev["char_end"]
+            ):
+                text += part[prev["char_end"] - neighbor["char_start"]:]
+            else:
+                text += ("\n" if text else "") + part
+            prev = neighbor
+        return text.strip()
+
+    def _id_selector(self, ids: np.ndarray):
+        """
+        FAISS IDSelector restricted to `ids`.
+
+        Returns (selector, buffer); the caller must keep `buffer` alive while
+        the selector is in use.
+        """
+        ntotal = self.index.ntotal
+        if len(ids) * 64 < ntotal:
+            ids = np.ascontiguousarray(ids, dtype=np.int64)
+            return faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids)), ids
+        mask = np.zeros(ntotal, dtype=bool)
+        mask[ids] = True
+        bitmap = np.packbits(mask, bitorder="little")
+        return faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap)), bitmap
+
+    def _search_params(self, nprobe: int | None = None, ef_search: int | None = None, sel=None):
+        """Per-query FAISS search parameters (None = index defaults, no filter)."""
+        if faiss.try_extract_index_ivf(self.index) is not None:
+            if nprobe is None and sel is None:
+                return None
+            params = faiss.SearchParametersIVF()
+            params.nprobe = int(nprobe) if nprobe is not None else self.index.nprobe
+        elif isinstance(self.index, faiss.IndexHNSW):
+            if ef_search is None and sel is None:
+                return None
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = int(ef_search) if ef_search is not None else self.index.hnsw.efSearch
+        elif sel is not None:
+            params = faiss.SearchParameters()
+        else:
+            return None
+        if sel is not None:
+            params.sel = sel
+        return params
+
+    def _exact_search(self, query_vecs: np.ndarray, ids: np.ndarray, k: int):
+        """Brute-force L2 search restricted to `ids`, using the logged vectors."""
+        vectors = np.asarray(self.storage.read_vectors(0, self.index.ntotal)[ids])
+        dists = (
+            (query_vecs ** 2).sum(axis=1)[:, None]
+            - 2.0 * query_vecs @ vectors.T
+            + (vectors ** 2).sum(axis=1)[None, :]
+        )
+        order = np.argsort(dists, axis=1)[:, :k]
+        return np.take_along_axis(dists, order, axis=1), ids[order]
+
+    def _dense_search(self, query_vecs: np.ndarray, allowed, k: int, nprobe=None, ef_search=None):
+        """
+        One FAISS search for every row of `query_vecs` (restricted to `allowed`
+        ids, or None for all); returns one (ids, distances) pair per row.
+        """
+        if (
+            allowed is not None
+            and self.storage is not None
+            and not isinstance(self.index, faiss.IndexFlat)
+            and len(allowed) <= self.index_params["exact_filter_max"]
+        ):
+            distances, indices = self._exact_search(query_vecs, allowed, k)
+        elif allowed is not None:
+            sel, _sel_buffer = self._id_selector(allowed)
+            k = min(k, len(allowed))
+            distances, indices = self.index.search(
+                query_vecs, k, params=self._search_params(nprobe, ef_search, sel)
+            )
+        else:
+            k = min(k, self.index.ntotal)
+            distances, indices = self.index.search(
+                query_vecs, k, params=self._search_params(nprobe, ef_search)
+            )
+        hits = []
+        for row_ids, row_dists in zip(indices, distances):
+            found = row_ids >= 0  # ANN indexes may return fewer than k hits
+            hits.append((row_ids[found], row_dists[found]))
+        return hits
+
+    def _fuse_lexical(self, query: str, query_vec: np.ndarray, dense_ids, dense_dists, allowed, k: int):
+        """
+        Reciprocal rank fusion of a FAISS ranking (HYBRID_DEPTH * k hits) with
+        the BM25 ranking of `query`. Returns (ids, distances) of the top k
+        fused hits, with exact distances to the query for hits only BM25 found.
+        """
+        lexical_ids = [
+            vec_id for vec_id, _ in self.lexical.search(query, k * HYBRID_DEPTH, allowed)
+            if vec_id < self.index.ntotal  # not added to FAISS yet
+        ]
+        if not lexical_ids:
+            return dense_ids[:k], dense_dists[:k]
+
+        fused: dict[int, float] = {}
+        for ranking in (dense_ids.tolist(), lexical_ids):
+            for rank, vec_id in enumerate(ranking):
+                fused[vec_id] = fused.get(vec_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+        ids = np.array(sorted(fused, key=fused.get, reverse=True)[:k], dtype=np.int64)
+
+        known = dict(zip(dense_ids.tolist(), dense_dists.tolist()))
+        missing = np.array([i for i in ids.tolist() if i not in known], dtype=np.int64)
+        if len(missing):
+            vectors = self._vectors_by_id(missing)
+            known.update(zip(missing.tolist(), ((vectors - query_vec) ** 2).sum(axis=1).tolist()))
+        return ids, np.array([known[i] for i in ids.tolist()], dtype=np.float32)
+
+    def search(
+        self,
+        query: str,
+        k: int = 5,
+        kb_ids=None,
+        doc_ids=None,
+        tags=None,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+    ):
         """
         Semantic search over indexed documents.
 
+        `kb_ids`, `doc_ids` and `tags` restrict the search to vectors whose
+        metadata matches (any listed value per filter, all filters combined).
+        The filter is applied inside FAISS, so up to k in-scope hits come back
+        regardless of what else is indexed. Small filtered sets on ANN indexes
+        are brute-forced for exact results.
+
+        With `hybrid` stores, FAISS hits are fused with BM25 hits on the query
+        terms (reciprocal rank fusion), under the same filters.
+
+        `nprobe` (IVF) and `ef_search` (HNSW) trade latency for recall on a
+        per-query basis; they are ignored by index types that don't use them.
+
         Returns a list of (metadata, distance) tuples.
         Lower distance = more similar (vectors are L2-normalized).
         """
-        if self.index is None or self.index.ntotal == 0:
-            return []
+        return self.search_batch(
+            [query], k, kb_ids=kb_ids, doc_ids=doc_ids, tags=tags, nprobe=nprobe, ef_search=ef_search
+        )[0]
 
-        query_vec = self._embed_texts([query])
-        if query_vec.size == 0:
+    def search_batch(
+        self,
+        queries: list[str],
+        k: int = 5,
+        kb_ids=None,
+        doc_ids=None,
+        tags=None,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+    ) -> list[list[tuple]]:
+        """
+        search() for several queries at once: one FastEmbed call embeds them
+        all and one multi-row FAISS search serves them all. Returns one result
+        list per query, in order.
+        """
+        if not queries:
             return []
+        query_vecs = self._embed_texts(list(queries))
+        if query_vecs.size == 0:
+            return [[] for _ in queries]
+
+        # Shared with other searches; writers only wait for it to add or swap the index
+        with self._index_lock.shared():
+            if self.index is None or self.index.ntotal == 0:
+                return [[] for _ in queries]
+
+            allowed = self.metadata.filter_ids(kb_ids=kb_ids, doc_ids=doc_ids, tags=tags)
+            if allowed is not None:
+                # Metadata of vectors being added may already be there; FAISS decides what is searchable
+                allowed = allowed[:np.searchsorted(allowed, self.index.ntotal)]
+                if len(allowed) == 0:
+                    return [[] for _ in queries]
+                if len(allowed) == self.index.ntotal:
+                    allowed = None  # filter matches everything
+
+            depth = k * HYBRID_DEPTH if self.lexical is not None else k
+            dense = self._dense_search(query_vecs, allowed, depth, nprobe, ef_search)
+
+            results = []
+            for query, query_vec, (ids, distances) in zip(queries, query_vecs, dense):
+                if self.lexical is not None:
+                    ids, distances = self._fuse_lexical(query, query_vec, ids, distances, allowed, k)
+                results.append(
+                    [(self.metadata[int(idx)], float(dist)) for idx, dist in zip(ids, distances)]
+                )
+            return results
+
+
+def _extract_text_range(pdf_path, page_nums):
+    """
+    Process-pool worker: run PyPDF2 text extraction for a slice of pages.
+
+    Returns [(page_num, text), ...]; text is None when extraction raised, so the
+    page is sent to OCR.
+    """
+    results = []
+    with open(pdf_path, "rb") as f:
+        reader = PdfReader(f)
+        for page_num in page_nums:
+            try:
+                text = reader.pages[page_num].extract_text() or ""
+            except Exception:
+                text = None
+            results.append((page_num, text))
+    return results
+
+
+def _ocr_page_range(pdf_path, first_page, last_page, tesseract_cmd, dpi):
+    """
+    Process-pool worker: OCR the contiguous 0-based page range [first_page, last_page].
 
-        k = min(k, self.index.ntotal)
-        distances, indices = self.index.search(query_vec, k)
+    The range is rasterized with a single pdf2image/poppler call into a temp dir,
+    then every image is passed to tesseract. Returns [(page_num, text), ...].
+    """
+    pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    page_nums = range(first_page, last_page + 1)
+    with tempfile.TemporaryDirectory(prefix="ocr_") as tmp_dir:
+        try:
+            image_paths = convert_from_path(
+                pdf_path,
+                dpi=dpi,
+                first_page=first_page + 1,
+                last_page=last_page + 1,
+                output_folder=tmp_dir,
+                paths_only=True,
+            )
+        except Exception as e:
+            print(f"OCR failed for {pdf_path} pages {first_page}-{last_page}: {str(e)}")
+            return [(page_num, "") for page_num in page_nums]
 
         results = []
-        for rank, idx in enumerate(indices[0]):
-            meta = self.metadata[idx]
-            dist = float(distances[0][rank])
-            results.append((meta, dist))
-        return results
+        for page_num, image_path in zip(page_nums, image_paths):
+            try:
+                results.append((page_num, pytesseract.image_to_string(image_path)))
+            except Exception as e:
+                print(f"OCR failed for {pdf_path} page {page_num}: {str(e)}")
+                results.append((page_num, ""))
+    return results
+
+
+_POOL_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+
+def _contiguous_ranges(page_nums, max_len):
+    """Group sorted page numbers into (first, last) runs of at most `max_len` pages."""
+    ranges = []
+    for page_num in page_nums:
+        if ranges and page_num == ranges[-1][1] + 1 and page_num - ranges[-1][0] < max_len:
+            ranges[-1][1] = page_num
+        else:
+            ranges.append([page_num, page_num])
+    return [tuple(r) for r in ranges]
+
 
 class PDFProcessor:
     """Handles PDF text extraction with OCR fallback"""
     
-    def __init__(self, tesseract_cmd=r'/usr/bin/tesseract'):
+    def __init__(self, tesseract_cmd=r'/usr/bin/tesseract', max_workers=None, min_text_chars=200,
+                 ocr_dpi=200):
+        """
+        `max_workers` is the number of processes used to extract/OCR pages in
+        parallel (defaults to the CPU count; 1 disables the process pool).
+        The pool is created on first use and shared by every later PDF.
+        Pages with fewer than `min_text_chars` extracted characters are OCR'd,
+        rasterized at `ocr_dpi`.
+        """
         pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+        self.tesseract_cmd = tesseract_cmd
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.min_text_chars = min_text_chars
+        self.ocr_dpi = ocr_dpi
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
-    def _extract_with_ocr(self, pdf_path, page_num):
-        try:
-            images = convert_from_path(pdf_path, first_page=page_num+1, last_page=page_num+1)
-            return pytesseract.image_to_string(images[0])
-        except Exception as e:
-            print(f"OCR failed for {pdf_path} page {page_num}: {str(e)}")
-            return ""
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # Not fork: the server's threads (ingestion, sweepers, FAISS/OpenMP) may hold locks
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=_POOL_CONTEXT)
+            return self._pool
+
+    def _discard_pool(self, pool):
+        """Drop a pool whose worker died, so the next PDF starts a new one."""
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _run_tasks(self, pool, worker, tasks):
+        """Run worker(*task) for every task, in `pool` if given; yields (page_num, text)."""
+        if pool is None:
+            for task in tasks:
+                yield from worker(*task)
+            return
+        for future in [pool.submit(worker, *task) for task in tasks]:
+            yield from future.result()
 
-    def process_page(self, page, pdf_path, page_num):
+    def _extract_texts(self, file_path, num_pages, progress=None):
+        """
+        Return the text of every page.
+
+        1. Run text extraction on all pages and decide which ones need OCR.
+        2. Rasterize those pages in contiguous ranges (one poppler call per
+           range) and OCR them.
+        Both phases fan out to a process pool when `max_workers` > 1.
+        `progress(pages_done, num_pages)` is called as pages are finished.
+        """
+        if num_pages == 0:
+            return []
+        workers = min(self.max_workers, num_pages)
+        texts = [""] * num_pages
+        pages_done = 0
+
+        pool = self._get_pool() if workers > 1 else None
         try:
-            text = page.extract_text()
-            if len(text) < 200:  # Heuristic for image-based page
-                return self._extract_with_ocr(pdf_path, page_num)
-            return text
-        except Exception as e:
-            return self._extract_with_ocr(pdf_path, page_num)
+            # Several small slices per worker so a few slow pages don't stall one process
+            slice_size = max(1, -(-num_pages // (workers * 4)))
+            text_tasks = [(file_path, range(start, min(start + slice_size, num_pages)))
+                          for start in range(0, num_pages, slice_size)]
+
+            ocr_pages = []
+            for page_num, text in self._run_tasks(pool, _extract_text_range, text_tasks):
+                if text is None or len(text) < self.min_text_chars:  # Heuristic for image-based page
+                    ocr_pages.append(page_num)
+                else:
+                    texts[page_num] = text
+                    pages_done += 1
+                    if progress is not None:
+                        progress(pages_done, num_pages)
 
-    def process_pdf(self, file_path):
-        """Process a single PDF file"""
+            if ocr_pages:
+                # Split long runs so every worker gets a share of the OCR work
+                max_len = max(1, -(-len(ocr_pages) // workers))
+                ocr_tasks = [(file_path, first, last, self.tesseract_cmd, self.ocr_dpi)
+                             for first, last in _contiguous_ranges(sorted(ocr_pages), max_len)]
+                for page_num, text in self._run_tasks(pool, _ocr_page_range, ocr_tasks):
+                    texts[page_num] = text
+                    pages_done += 1
+                    if progress is not None:
+                        progress(pages_done, num_pages)
+        except BrokenProcessPool:
+            self._discard_pool(pool)
+            raise
+        return texts
+
+    def process_pdf(self, file_path, progress=None):
+        """
+        Process a single PDF file.
+
+        `progress(pages_done, pages_total)` is called as pages are extracted.
+        """
         doc_id = hashlib.md5(os.path.basename(file_path).encode()).hexdigest()[:8]
-        contents = []
-        
+
         with open(file_path, "rb") as f:
-            reader = PdfReader(f)
-            for page_num, page in enumerate(reader.pages):
-                text = self.process_page(page, file_path, page_num)
-                contents.append({
-                    'text': text,
-                    'metadata': {
-                        'doc_id': doc_id,
-                        'filename': os.path.basename(file_path),
-                        'page': page_num + 1
-                    }
-                })
+            num_pages = len(PdfReader(f).pages)
+
+        contents = []
+        for page_num, text in enumerate(self._extract_texts(file_path, num_pages, progress)):
+            contents.append({
+                'text': text,
+                'metadata': {
+                    'doc_id': doc_id,
+                    'filename': os.path.basename(file_path),
+                    'page': page_num + 1
+                }
+            })
         return contents
 
 class NotesGenerator:
     """Handles note generation using Gemini API"""    
     def __init__(self, api_key, all_topics):
         self.all_topics = all_topics
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(
-            model_name="gemini-2.5-flash",
-            generation_config={
+        # Shared model object, bound to this API key
+        self.model = get_gemini_model(
+            api_key,
+            "gemini-2.5-flash",
+            {
                 "temperature": 0.75,
                 "top_p": 0.85,
                 "top_k": 30,
                 "max_output_tokens": 8192,   # ↓ half of 8192
-            }
+            },
         )
 
         self.SYSTEM_PROMPT = f"""Act as an **expert note-taker and tutor**. Your task is to create **self-contained notes** from the provided source material and your own knowledge that:
@@ -174,27 +946,70 @@ class NotesGenerator:
 4. **Answer Readiness**:  
    - If the source does not have complete information for the explaination, then you may use you own knowledge to fill the gaps and also to structure the notes."""  
 
-    def _build_context(self, relevant_passages):
+    def _merge_passages(self, results_per_query):
+        """
+        Merge the hits of every query into one passage per document page, best
+        page first. Chunks of a page found by several queries appear once,
+        in page order, with overlapping spans trimmed.
+        """
+        pages = {}
+        for results in results_per_query:
+            for meta, score in results:
+                key = (meta.get("doc_id"), meta.get("page"))
+                page = pages.setdefault(key, {"meta": meta, "score": score, "chunks": {}})
+                page["score"] = min(page["score"], score)
+                span = (meta.get("char_start", 0), meta.get("char_end", -1))
+                page["chunks"][span] = meta.get("doc_text", "")
+
+        passages = []
+        for page in sorted(pages.values(), key=lambda p: p["score"]):
+            text, prev_end = "", None
+            for (start, end), chunk in sorted(page["chunks"].items()):
+                if prev_end is not None and start < prev_end:
+                    text += chunk[prev_end - start:]  # overlaps the previous chunk
+                else:
+                    text += ("\n" if text else "") + chunk
+                prev_end = end if prev_end is None else max(prev_end, end)
+            passages.append((page["meta"], page["score"], text.strip()))
+        return passages
+
+    def _build_context(self, passages, max_tokens):
+        """Context block of the best passages fitting `max_tokens` (approximate)."""
         context = "RELEVANT PASSAGES:\n"
-        for (meta, score) in relevant_passages:
-            context += f"\nDocument: {meta['filename']} (Page {meta['page']})\n"
-            context += f"Content: {meta['doc_text']}\n"
-            context += f"Relevance Score: {score:.2f}\n{'-'*40}"
+        budget = max_tokens
+        for meta, score, text in passages:
+            block = (
+                f"\nDocument: {meta['filename']} (Page {meta['page']})\n"
+                f"Content: {text}\n"
+                f"Relevance Score: {score:.2f}\n{'-'*40}"
+            )
+            cost = approx_token_count(block)
+            if cost > budget:
+                continue  # a shorter passage further down may still fit
+            context += block
+            budget -= cost
         return context
 
-    def generate_notes(self, vector_store, base_prompt, topics, max_retries: int = 3):
+    def generate_notes(self, vector_store, base_prompt, topics, max_retries: int = 3,
+                       passages_per_query: int = 5, context_tokens: int = 6000):
         """
         Generate notes for multiple topics, retrying if the LLM returns an empty response.
+
+        Every generated query is searched in one batch (`passages_per_query`
+        hits each); the hits are merged per document page and the best pages
+        fill a context of at most `context_tokens` tokens.
         """
         self.max_queries = 10
         queryBuilder = QueryBuilder()
         queries = queryBuilder.get_and_process_query("- " + "- ".join(topics), self.max_queries)
+        if not isinstance(queries, list) or not queries:
+            queries = list(topics)  # the query LLM returned nothing usable
 
-        # Build the overall context
-        context = ""
-        for query in queries[:self.max_queries]:
-            relevant_passages = vector_store.search(query, k=(self.max_queries // len(queries)))
-            context += self._build_context(relevant_passages)
+        # Build the overall context: one embedding pass and one FAISS search for all queries
+        results = vector_store.search_batch(
+            [str(q) for q in queries[:self.max_queries]], k=passages_per_query
+        )
+        context = self._build_context(self._merge_passages(results), context_tokens)
         
         # Prepare the chat
         chat = self.model.start_chat(history=[])
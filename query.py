@@ -1,18 +1,123 @@
 import os
 import google.generativeai as genai
+from google.generativeai import client as genai_client
 import json
 import re
+import threading
+import time
+
+from coordination import InterProcessLock
+
+# GenerativeModel objects are reused across calls, keyed by (api key, model, config)
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_gemini_model(api_key: str, model_name: str, generation_config: dict):
+    """
+    Shared `genai.GenerativeModel` for this key/model/config.
+
+    `genai.configure` is process-wide and a model otherwise picks up the
+    client of whatever key is configured at its first call, so every model
+    is bound to a client for its own key when it is created.
+    """
+    key = (api_key, model_name, json.dumps(generation_config, sort_keys=True))
+    with _models_lock:
+        model = _models.get(key)
+        if model is None:
+            genai.configure(api_key=api_key)
+            model = genai.GenerativeModel(model_name=model_name, generation_config=generation_config)
+            model._client = genai_client.get_default_generative_client()
+            _models[key] = model
+        return model
+
+
+class ExpansionCache:
+    """
+    Persistent cache of topic -> query expansions, as one JSON file.
+
+    Keys are the normalized topic text plus the number of queries asked for;
+    entries expire after `ttl` seconds and at most `max_entries` are kept
+    (oldest dropped first). The file is re-read whenever another server
+    process replaced it, and every store merges into the latest copy under
+    an inter-process lock before rewriting it atomically.
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 86400, max_entries: int = 1000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}    # key -> {"queries": [...], "timestamp": ...}
+        self._file_id = None  # (inode, mtime) of the file _entries was read from
+        self._lock = threading.Lock()
+        self._file_lock = InterProcessLock(f"{path}.lock")
+
+    @staticmethod
+    def key(topic: str, number_of_queries: int) -> str:
+        return f"{number_of_queries}:{' '.join(topic.lower().split())}"
+
+    def _load(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return self._entries
+        file_id = (stat.st_ino, stat.st_mtime_ns)
+        if file_id != self._file_id:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._entries = {}
+            self._file_id = file_id
+        return self._entries
+
+    def get(self, topic: str, number_of_queries: int):
+        with self._lock:
+            entry = self._load().get(self.key(topic, number_of_queries))
+            if entry is None or time.time() - entry["timestamp"] >= self.ttl:
+                return None
+            return entry["queries"]
+
+    def store(self, topic: str, number_of_queries: int, queries: list):
+        # Other workers write the same file: merge into their latest entries
+        with self._file_lock, self._lock:
+            entries = dict(self._load())
+            now = time.time()
+            entries[self.key(topic, number_of_queries)] = {"queries": queries, "timestamp": now}
+            live = sorted(
+                ((k, e) for k, e in entries.items() if now - e["timestamp"] < self.ttl),
+                key=lambda item: item[1]["timestamp"],
+            )
+            entries = dict(live[-self.max_entries:])
+
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+            self._entries = entries
+            stat = os.stat(self.path)
+            self._file_id = (stat.st_ino, stat.st_mtime_ns)
+
+
+# QUERY_CACHE_TTL=0 disables the cache
+_expansion_cache = ExpansionCache(
+    os.environ.get("QUERY_CACHE_PATH")
+    or os.path.join(os.environ.get("DATA_DIR", "./data"), "query_cache.json"),
+    ttl=float(os.environ.get("QUERY_CACHE_TTL", str(7 * 86400))),
+)
+
 
 class QueryBuilder:
     def __init__(self):
         """
-        Initializes the Google Gemini API client using API key from environment variable.
+        Reads the Gemini API key from the environment; the model is shared
+        between QueryBuilder instances.
         """
-        api_key = os.environ.get("GEMINI_API_KEY_QUERY")
-        if not api_key:
+        self.api_key = os.environ.get("GEMINI_API_KEY_QUERY")
+        if not self.api_key:
             raise ValueError("GEMINI_API_KEY_QUERY not set in environment variables.")
-        genai.configure(api_key=api_key)
-    
+        self.cache = _expansion_cache
+
     def convert_query(self, text: str):
         """
         Extracts and parses a JSON array from the LLM's response text.
@@ -33,7 +138,15 @@ class QueryBuilder:
     def get_and_process_query(self, topic: str, number_of_queries: int = 10) -> str:
         """
         Sends the user's query to the Gemini model and returns the processed text response.
+
+        Expansions are cached per (normalized topic, number_of_queries), so a
+        repeated topic skips the LLM call.
         """
+        if self.cache.ttl > 0:
+            cached = self.cache.get(topic, number_of_queries)
+            if cached is not None:
+                return cached
+
         SYSTEM_PROMPT = f"""
     Act as an **expert note-taker and tutor**. You are researching on the topics from a vector database. 
     You are to query the vector database for generating appropriate answers for the given topic.
@@ -48,25 +161,25 @@ class QueryBuilder:
     Remember to not give anything other than this. There should be nothing before or after the code block.
     Do NOT prefix the code block with any language other than `json`.
         """
-        model = genai.GenerativeModel(
-        model_name="gemini-2.5-flash",
-        generation_config={
-            "temperature": 0.65,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 8192,
+        model = get_gemini_model(
+            self.api_key,
+            "gemini-2.5-flash",
+            {
+                "temperature": 0.65,
+                "top_p": 0.95,
+                "top_k": 40,
+                "max_output_tokens": 8192,
             },
         )
-        
-        chat = model.start_chat(history=[])
-        response = chat.send_message([
+
+        response = model.generate_content([
             SYSTEM_PROMPT,
             f"Topic : {topic}, Number of queries: {number_of_queries}"
         ])
 
-        print("\nDEBUG : (Returned response)", response.text)
-
         result_list = self.convert_query(response.text)
+        if isinstance(result_list, list) and result_list and self.cache.ttl > 0:
+            self.cache.store(topic, number_of_queries, result_list)
         return result_list
 
 
@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+from typing import List, Optional
+
+try:
+    from fastembed.rerank.cross_encoder import TextCrossEncoder
+except ImportError:  # fastembed without rerank support
+    TextCrossEncoder = None
+
+logger = logging.getLogger(__name__)
+
+
+class CrossEncoderReranker:
+    """
+    Second retrieval stage: rescore (query, passage) pairs with a local ONNX
+    cross-encoder (FastEmbed, CPU) and keep the best k.
+
+    Retrievers over-fetch `candidates` hits and pass their texts to rerank().
+    Passages are scored in batches of `batch_size`; if scoring takes longer
+    than `budget` seconds (or the model is unavailable), rerank() gives up and
+    the caller keeps the vector order.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "Xenova/ms-marco-MiniLM-L-6-v2",
+        candidates: int = 20,
+        batch_size: int = 16,
+        budget: float = 0.3,
+    ):
+        self.model_name = model_name
+        self.candidates = candidates
+        self.batch_size = batch_size
+        self.budget = budget
+        self._model = None
+        self._failed = TextCrossEncoder is None
+        self._lock = threading.Lock()
+
+    def _get_model(self):
+        if self._model is None and not self._failed:
+            with self._lock:
+                if self._model is None and not self._failed:
+                    try:
+                        # Downloads once, then cached locally like the embedding model
+                        self._model = TextCrossEncoder(model_name=self.model_name)
+                    except Exception as e:
+                        logger.error(f"Reranker disabled, could not load {self.model_name}: {e}")
+                        self._failed = True
+        return self._model
+
+    def rerank(self, query: str, texts: List[str], k: int) -> Optional[List[tuple]]:
+        """
+        Indices of the best `k` texts for `query` with their scores, best first,
+        as [(index, score)]; None when reranking was skipped (keep vector order).
+        """
+        model = self._get_model()
+        if model is None or not texts:
+            return None
+
+        deadline = time.monotonic() + self.budget
+        scores: List[float] = []
+        for start in range(0, len(texts), self.batch_size):
+            if start and time.monotonic() > deadline:
+                logger.warning(f"Rerank over budget after {start}/{len(texts)} passages")
+                return None
+            batch = texts[start:start + self.batch_size]
+            scores.extend(float(s) for s in model.rerank(query, batch, batch_size=len(batch)))
+        if time.monotonic() > deadline:
+            logger.warning(f"Rerank over budget ({len(texts)} passages)")
+            return None
+
+        order = sorted(range(len(texts)), key=lambda i: scores[i], reverse=True)
+        return [(i, scores[i]) for i in order[:k]]
@@ -0,0 +1,248 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    messages_from_dict,
+    messages_to_dict,
+)
+
+from chunking import approx_token_count
+
+# summarizer(previous summary, messages being dropped) -> new summary
+Summarizer = Callable[[str, List[BaseMessage]], str]
+
+
+def _split_turns(messages: List[BaseMessage]) -> List[List[BaseMessage]]:
+    """Group messages into turns, each starting at a human message."""
+    turns: List[List[BaseMessage]] = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _message_tokens(message: BaseMessage) -> int:
+    content = message.content
+    if not isinstance(content, str):
+        content = json.dumps(content)
+    return approx_token_count(content)
+
+
+class SessionHistory(BaseChatMessageHistory):
+    """Chat history of one conversation, read and written through a SessionStore."""
+
+    def __init__(self, store: "SessionStore", session_id: str):
+        self.store = store
+        self.session_id = session_id
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return self.store.window(self.session_id)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.store.append(self.session_id, list(messages))
+
+    def clear(self) -> None:
+        self.store.delete(self.session_id)
+
+
+class SessionStore:
+    """
+    Bounded store of conversation histories for the agent.
+
+    - At most `max_sessions` conversations are kept (least recently used are
+      evicted first), and conversations idle for `ttl` seconds expire.
+    - Only the last `max_turns` turns (question + answer) of a conversation
+      are kept. With a `summarizer`, older turns are folded into a rolling
+      summary instead of being dropped; it runs once `summarize_every` turns
+      have piled up beyond the window, not on every turn.
+    - The history handed to the prompt is further cut to the most recent
+      turns fitting `max_tokens` (0 = no limit), summary first.
+
+    With `db_path`, conversations live in a SQLite file (shared by every
+    server process using it) instead of process memory.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 1000,
+        ttl: float = 86400,
+        max_turns: int = 10,
+        max_tokens: int = 0,
+        summarizer: Optional[Summarizer] = None,
+        summarize_every: int = 4,
+        db_path: Optional[str] = None,
+    ):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.summarizer = summarizer
+        self.summarize_every = max(1, summarize_every)
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._sessions: "OrderedDict[str, Dict]" = OrderedDict()  # memory backend
+        self._writes = 0
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path is not None:
+            self._db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " id TEXT PRIMARY KEY, summary TEXT NOT NULL, messages TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)"
+            )
+            self._db.commit()
+
+    def get_history(self, session_id: str) -> SessionHistory:
+        """RunnableWithMessageHistory factory: the history of one conversation."""
+        return SessionHistory(self, session_id)
+
+    # ------------------------------------------------------------------
+    # Storage backends (process memory / SQLite)
+    # ------------------------------------------------------------------
+
+    def _load(self, session_id: str) -> Optional[Dict]:
+        now = time.time()
+        if self._db is None:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if now - session["updated_at"] >= self.ttl:
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return session
+
+        row = self._db.execute(
+            "SELECT summary, messages, updated_at FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        if row is None or now - row[2] >= self.ttl:
+            return None
+        return {
+            "summary": row[0],
+            "messages": messages_from_dict(json.loads(row[1])),
+            "updated_at": row[2],
+        }
+
+    def _save(self, session_id: str, session: Dict):
+        session["updated_at"] = time.time()
+        if self._db is None:
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            # Least recently used first, so expired sessions sit at the front
+            while self._sessions:
+                oldest_id, oldest = next(iter(self._sessions.items()))
+                if session["updated_at"] - oldest["updated_at"] < self.ttl:
+                    break
+                del self._sessions[oldest_id]
+            return
+
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions (id, summary, messages, updated_at) VALUES (?, ?, ?, ?)",
+            (
+                session_id,
+                session["summary"],
+                json.dumps(messages_to_dict(session["messages"])),
+                session["updated_at"],
+            ),
+        )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._evict_db(session["updated_at"])
+        self._db.commit()
+
+    def _evict_db(self, now: float):
+        self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,))
+        self._db.execute(
+            "DELETE FROM sessions WHERE id NOT IN"
+            " (SELECT id FROM sessions ORDER BY updated_at DESC LIMIT ?)",
+            (self.max_sessions,),
+        )
+
+    # ------------------------------------------------------------------
+    # History operations
+    # ------------------------------------------------------------------
+
+    def window(self, session_id: str) -> List[BaseMessage]:
+        """Messages to put in the prompt: summary (if any) + recent turns within max_tokens."""
+        with self._lock:
+            session = self._load(session_id)
+        if session is None:
+            return []
+
+        prefix: List[BaseMessage] = []
+        if session["summary"]:
+            prefix = [
+                HumanMessage(content="Summarize our conversation so far."),
+                AIMessage(content=session["summary"]),
+            ]
+
+        turns = _split_turns(session["messages"])
+        if self.max_tokens > 0:
+            budget = self.max_tokens - sum(_message_tokens(m) for m in prefix)
+            kept = 0
+            for turn in reversed(turns):
+                budget -= sum(_message_tokens(m) for m in turn)
+                if budget < 0 and kept:
+                    break
+                kept += 1
+            turns = turns[len(turns) - kept:]
+        return prefix + [m for turn in turns for m in turn]
+
+    def append(self, session_id: str, messages: List[BaseMessage]):
+        with self._lock:
+            session = self._load(session_id) or {"summary": "", "messages": []}
+            session["messages"] = session["messages"] + messages
+            turns = _split_turns(session["messages"])
+            overflow = len(turns) - self.max_turns
+            if self.summarizer is None and overflow > 0:
+                session["messages"] = [m for turn in turns[overflow:] for m in turn]
+            self._save(session_id, session)
+            if self.summarizer is None or overflow < self.summarize_every:
+                return
+            summary = session["summary"]
+            dropped = [m for turn in turns[:overflow] for m in turn]
+
+        # Summarize outside the lock: it is an LLM call
+        try:
+            summary = self.summarizer(summary, dropped)
+        except Exception:
+            return  # keep the turns; retried on a later append
+
+        with self._lock:
+            session = self._load(session_id)
+            if session is None or session["messages"][:len(dropped)] != dropped:
+                return  # changed meanwhile; retried on a later append
+            session["summary"] = summary
+            session["messages"] = session["messages"][len(dropped):]
+            self._save(session_id, session)
+
+    def delete(self, session_id: str):
+        with self._lock:
+            if self._db is None:
+                self._sessions.pop(session_id, None)
+            else:
+                self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM sessions")
+                self._db.commit()
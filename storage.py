@@ -0,0 +1,331 @@
+import os
+import json
+import shutil
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+import faiss
+
+from coordination import file_stamp
+
+
+def _atomic_write_bytes(path: str, data: bytes):
+    """Write `data` to `path` via a temp file + rename so readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _atomic_write_json(path: str, obj: Any):
+    _atomic_write_bytes(path, json.dumps(obj).encode("utf-8"))
+
+
+def is_mapped(index: faiss.Index) -> bool:
+    """True for an IVF index whose inverted lists are memory-mapped (read-only, no add())."""
+    ivf = faiss.try_extract_index_ivf(index)
+    return ivf is not None and isinstance(
+        faiss.downcast_InvertedLists(ivf.invlists), faiss.OnDiskInvertedLists
+    )
+
+
+class IndexStorage:
+    """
+    On-disk home of a VectorStore.
+
+    Layout of `data_dir`:
+    - manifest.json   : {"dim": <embedding dim>, "trained_on": <corpus size the
+                        snapshot's IVF index was trained on>}
+    - vectors.f32     : append-only log of raw float32 embeddings (one row per vector)
+    - index.faiss     : last FAISS snapshot (written atomically with faiss.write_index)
+    - generation      : counter bumped by the writer after each change, so other
+                        processes sharing `data_dir` know when to catch up
+    - epoch           : counter bumped when files are rewritten rather than
+                        appended to (compaction, reset, index rebuild), so
+                        other processes know to reload instead of reading on
+    - vector metadata : metadata_store.MetadataStore files, which live alongside
+                        (as do the lexical_index.LexicalIndex files)
+
+    Every ingest appends to the logs (cheap, proportional to the new data);
+    the FAISS index is snapshotted every `snapshot_every` appended vectors. On
+    load, any vectors logged after the snapshot are replayed from the log, so
+    nothing is ever re-embedded. Read-only loads memory-map IVF snapshots
+    that need no replay (mapped inverted lists can't be added to); other
+    processes then extend() their index from the log until the next epoch.
+    """
+
+    MANIFEST_FILE = "manifest.json"
+    VECTORS_FILE = "vectors.f32"
+    LEGACY_METADATA_FILE = "metadata.jsonl"
+    INDEX_FILE = "index.faiss"
+    GENERATION_FILE = "generation"
+    EPOCH_FILE = "epoch"
+    _COUNTER_FILES = (GENERATION_FILE, EPOCH_FILE)
+    COMPACTION_DIR = "compact.tmp"
+
+    def __init__(self, data_dir: str, snapshot_every: int = 5000):
+        self.data_dir = data_dir
+        self.snapshot_every = snapshot_every
+        self.dim: Optional[int] = None
+        self.trained_on: Optional[int] = None
+        self._unsnapshotted = 0
+        os.makedirs(self.data_dir, exist_ok=True)
+        self._read_manifest()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.data_dir, name)
+
+    def _read_manifest(self):
+        manifest_path = self._path(self.MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            self.dim = manifest.get("dim")
+            self.trained_on = manifest.get("trained_on")
+        else:
+            self.dim = None
+            self.trained_on = None
+
+    def _write_manifest(self):
+        manifest = {"dim": self.dim}
+        if self.trained_on is not None:
+            manifest["trained_on"] = self.trained_on
+        _atomic_write_json(self._path(self.MANIFEST_FILE), manifest)
+
+    def refresh(self):
+        """Re-read the manifest (another process may have written the first vectors or retrained)."""
+        self._read_manifest()
+
+    def _read_counter(self, name: str) -> int:
+        try:
+            with open(self._path(name), "r", encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _bump_counter(self, name: str) -> int:
+        value = self._read_counter(name) + 1
+        _atomic_write_bytes(self._path(name), str(value).encode("utf-8"))
+        return value
+
+    def generation(self) -> int:
+        """Change counter of the persisted data (see bump_generation)."""
+        return self._read_counter(self.GENERATION_FILE)
+
+    def bump_generation(self) -> int:
+        """Record that the persisted data changed; returns the new generation."""
+        return self._bump_counter(self.GENERATION_FILE)
+
+    def epoch(self) -> int:
+        """Counter of rewrites of the persisted data (see bump_epoch)."""
+        return self._read_counter(self.EPOCH_FILE)
+
+    def bump_epoch(self) -> int:
+        """
+        Record that files were rewritten, not just appended to, so copies
+        loaded by other processes must be reloaded; returns the new epoch.
+        """
+        return self._bump_counter(self.EPOCH_FILE)
+
+    # ------------------------------------------------------------------
+    # Loading
+    # ------------------------------------------------------------------
+
+    def pop_legacy_metadata(self) -> Optional[List[dict]]:
+        """
+        Metadata dicts from the JSON-lines log used before MetadataStore, or None.
+
+        The file is removed once read; the caller imports it into a MetadataStore.
+        """
+        path = self._path(self.LEGACY_METADATA_FILE)
+        if not os.path.exists(path):
+            return None
+        metadata: List[dict] = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    metadata.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break  # torn last line from an interrupted append
+        os.remove(path)
+        return metadata
+
+    def logged_vector_count(self) -> int:
+        path = self._path(self.VECTORS_FILE)
+        if not self.dim or not os.path.exists(path):
+            return 0
+        return os.path.getsize(path) // (self.dim * 4)
+
+    def read_vectors(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """Memory-mapped view of logged embeddings [start, stop)."""
+        count = self.logged_vector_count()
+        stop = count if stop is None else min(stop, count)
+        if start >= stop:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        vectors = np.memmap(
+            self._path(self.VECTORS_FILE), dtype=np.float32, mode="r",
+            shape=(count, self.dim),
+        )
+        return vectors[start:stop]
+
+    def truncate_log(self, count: int):
+        """Drop logged vectors past `count` (left behind by an interrupted append)."""
+        if self.logged_vector_count() > count:
+            with open(self._path(self.VECTORS_FILE), "r+b") as f:
+                f.truncate(count * self.dim * 4)
+
+    def _read_index_snapshot(self, mmap: bool = False) -> Optional[faiss.Index]:
+        path = self._path(self.INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        if mmap:
+            try:
+                return faiss.read_index(path, faiss.IO_FLAG_MMAP)
+            except RuntimeError:
+                pass  # not every index type can be memory-mapped
+        return faiss.read_index(path)
+
+    def load(self, count: int, repair: bool = True) -> Optional[faiss.Index]:
+        """
+        Rebuild the FAISS index holding the first `count` logged vectors (the
+        number of vectors with persisted metadata).
+
+        With `repair`, logged vectors past `count` are truncated away; readers
+        sharing the directory with a writer pass False. Only readers get a
+        memory-mapped index (see is_mapped()), and only when the snapshot
+        holds all `count` vectors.
+        Returns None when nothing has been persisted yet.
+        """
+        self._read_manifest()  # another process may have written the first vectors
+        self._unsnapshotted = 0
+        count = min(count, self.logged_vector_count())
+        if count == 0:
+            return None
+        if repair:
+            self.truncate_log(count)
+
+        index = self._read_index_snapshot(mmap=not repair)
+        if index is not None and index.ntotal < count and is_mapped(index):
+            index = self._read_index_snapshot()  # vectors to replay: load it writable
+        if index is None or index.ntotal > count:
+            # No usable snapshot: rebuild a flat index straight from the log
+            index = faiss.IndexFlatL2(self.dim)
+
+        self.extend(index, count)
+        return index
+
+    def extend(self, index: faiss.Index, count: int):
+        """
+        Add logged vectors [index.ntotal, count) to an index loaded from this
+        storage (not a mapped one, see is_mapped()).
+        """
+        if index.ntotal < count:
+            self._unsnapshotted += count - index.ntotal
+            index.add(np.ascontiguousarray(self.read_vectors(index.ntotal, count)))
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+
+    def append(self, embeddings: np.ndarray):
+        """Append freshly indexed vectors to the log."""
+        if self.dim is None:
+            self.dim = int(embeddings.shape[1])
+            self._write_manifest()
+
+        with open(self._path(self.VECTORS_FILE), "ab") as f:
+            f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self._unsnapshotted += embeddings.shape[0]
+
+    def snapshot(self, index: faiss.Index, trained_on: Optional[int] = None):
+        """
+        Atomically replace the FAISS snapshot with the current index.
+
+        `trained_on` (the corpus size an IVF index was trained on) is kept in
+        the manifest, so retraining is counted from training, not from restarts.
+        """
+        tmp_path = self._path(self.INDEX_FILE) + ".tmp"
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, self._path(self.INDEX_FILE))
+        self._unsnapshotted = 0
+        if trained_on is not None and trained_on != self.trained_on:
+            self.trained_on = trained_on
+            self._write_manifest()
+
+    def maybe_snapshot(self, index: faiss.Index, trained_on: Optional[int] = None):
+        """Snapshot once enough vectors have been appended since the last one."""
+        if self._unsnapshotted >= self.snapshot_every:
+            self.snapshot(index, trained_on)
+
+    def compaction_dir(self) -> str:
+        """Empty scratch directory (inside data_dir) to write a compacted copy of the store into."""
+        path = self._path(self.COMPACTION_DIR)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+    def replace_with(self, src_dir: str):
+        """
+        Swap in the files of a compacted copy written to `src_dir` (each file
+        replaced atomically), drop data files it doesn't have, and remove
+        `src_dir`. The epoch is bumped; the generation file is kept, bump it
+        afterwards.
+        """
+        names = set(os.listdir(src_dir))
+        for name in names:
+            os.replace(os.path.join(src_dir, name), self._path(name))
+        for name in os.listdir(self.data_dir):
+            path = self._path(name)
+            if name not in names and name not in self._COUNTER_FILES and os.path.isfile(path):
+                os.remove(path)
+        shutil.rmtree(src_dir, ignore_errors=True)
+        self.bump_epoch()
+        self._read_manifest()
+        self._unsnapshotted = 0
+
+    def clear(self):
+        """Delete everything persisted in `data_dir` (the generation and epoch keep counting)."""
+        generation, epoch = self.generation(), self.epoch()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+        os.makedirs(self.data_dir, exist_ok=True)
+        _atomic_write_bytes(self._path(self.GENERATION_FILE), str(generation).encode("utf-8"))
+        _atomic_write_bytes(self._path(self.EPOCH_FILE), str(epoch).encode("utf-8"))
+        self.bump_generation()
+        self.bump_epoch()
+        self.dim = None
+        self.trained_on = None
+        self._unsnapshotted = 0
+
+
+class RegistryStorage:
+    """Persists the KB and document registries as one atomically-replaced JSON file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def stamp(self):
+        """Changes whenever the file is replaced (by this or another process)."""
+        return file_stamp(self.path)
+
+    def load(self) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        """Return (knowledge_bases, documents); both empty if nothing was saved."""
+        if not os.path.exists(self.path):
+            return {}, {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data.get("knowledge_bases", {}), data.get("documents", {})
+
+    def save(
+        self,
+        knowledge_bases: Dict[str, Dict[str, Any]],
+        documents: Dict[str, Dict[str, Any]],
+    ):
+        _atomic_write_json(
+            self.path,
+            {"knowledge_bases": knowledge_bases, "documents": documents},
+        )
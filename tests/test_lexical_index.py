@@ -0,0 +1,87 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexical_index import LexicalIndex, tokenize  # noqa: E402
+
+
+class TokenizeTest(unittest.TestCase):
+    def test_parenthesized_word(self):
+        self.assertEqual(tokenize("Leave Act (FMLA)"), ["leave", "act", "fmla"])
+        self.assertEqual(tokenize("(see section 3)"), ["see", "section", "3"])
+
+    def test_compounds(self):
+        self.assertEqual(tokenize("401(k)"), ["401k", "401"])
+        self.assertEqual(tokenize("I-9"), ["i9", "9"])
+
+    def test_search_matches_parenthesized_acronym(self):
+        index = LexicalIndex()
+        index.add(["Family and Medical Leave Act (FMLA) eligibility", "Dental plan"])
+        self.assertEqual([vec for vec, _ in index.search("FMLA", 5)], [0])
+        self.assertEqual([vec for vec, _ in index.search("fmla leave", 5)], [0])
+
+
+class LexicalIndexRepairTest(unittest.TestCase):
+    def test_load_drops_postings_of_torn_append(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            index = LexicalIndex(data_dir)
+            index.add(["alpha beta"])
+            index.add(["zeta zeta"])
+
+            # Crash after the postings append but before the lengths append
+            doclen_path = os.path.join(data_dir, LexicalIndex.DOCLEN_FILE)
+            with open(doclen_path, "r+b") as f:
+                f.truncate(4)
+
+            repaired = LexicalIndex(data_dir)
+            self.assertEqual(len(repaired), 1)
+            self.assertEqual(repaired.search("zeta", 5), [])
+
+            # The next chunk reuses vector id 1; the old postings must not come back
+            repaired.add(["omega"])
+            reloaded = LexicalIndex(data_dir)
+            for index in (repaired, reloaded):
+                self.assertEqual(index.search("zeta", 5), [])
+                self.assertEqual([vec for vec, _ in index.search("omega", 5)], [1])
+                self.assertEqual([vec for vec, _ in index.search("alpha", 5)], [0])
+
+    def test_load_repairs_term_ordered_postings_file(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            index = LexicalIndex(data_dir)
+            index.add(["zeta one", "alpha two", "zeta three"])
+            index.truncate(3)  # no-op
+            index.add(["extra"])
+            index.truncate(3)  # rewrites the postings file in term order
+            index.add(["zeta four"])
+
+            doclen_path = os.path.join(data_dir, LexicalIndex.DOCLEN_FILE)
+            with open(doclen_path, "r+b") as f:
+                f.truncate(2 * 4)
+
+            repaired = LexicalIndex(data_dir)
+            repaired.add(["omega"])
+            reloaded = LexicalIndex(data_dir)
+            self.assertEqual([vec for vec, _ in reloaded.search("zeta", 5)], [0])
+            self.assertEqual([vec for vec, _ in reloaded.search("omega", 5)], [2])
+            self.assertEqual(reloaded.search("three", 5), [])
+
+    def test_load_discards_files_of_older_tokenizer(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            LexicalIndex(data_dir).add(["Leave Act (FMLA)"])
+            os.remove(os.path.join(data_dir, LexicalIndex.VERSION_FILE))
+
+            reader = LexicalIndex(data_dir, read_only=True)
+            self.assertEqual(len(reader), 0)
+            self.assertTrue(os.path.exists(os.path.join(data_dir, LexicalIndex.VOCAB_FILE)))
+
+            writer = LexicalIndex(data_dir)
+            self.assertEqual(len(writer), 0)
+            writer.add(["Leave Act (FMLA)"])
+            self.assertEqual([vec for vec, _ in LexicalIndex(data_dir).search("FMLA", 5)], [0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from processing import INDEX_TYPES, VectorStore  # noqa: E402
+from storage import IndexStorage, is_mapped  # noqa: E402
+
+DIM = 16
+
+
+class HashEmbedding:
+    """Deterministic stand-in for the FastEmbed model: unit vectors seeded by the text."""
+
+    def embed(self, texts, batch_size=None):
+        for text in texts:
+            seed = int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:4], "little")
+            vec = np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+            yield vec / np.linalg.norm(vec)
+
+
+# Small enough for IVF indexes to train in a test
+INDEX_PARAMS = {"train_threshold": 200, "nlist": 8, "pq_bits": 4, "pq_m": 4}
+
+
+class VectorStoreRestartTest(unittest.TestCase):
+    def setUp(self):
+        VectorStore._model = HashEmbedding()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.data_dir = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _store(self, index_type, snapshot_every=5000):
+        return VectorStore(IndexStorage(self.data_dir, snapshot_every=snapshot_every),
+                           index_type=index_type, index_params=INDEX_PARAMS)
+
+    def _add(self, store, doc_id, count):
+        texts = [f"{doc_id} passage {i}" for i in range(count)]
+        metas = [{"doc_id": doc_id, "kb_id": "kb", "filename": f"{doc_id}.pdf", "page": 1}] * count
+        return store.add_documents(texts, metas)
+
+    def test_restart_then_add(self):
+        for index_type in INDEX_TYPES:
+            with self.subTest(index_type=index_type):
+                store = self._store(index_type)
+                self._add(store, f"{index_type}-a", 300)
+                store.save()
+                # Logged after the snapshot, so the next start has to replay it
+                self._add(store, f"{index_type}-b", 10)
+
+                restarted = self._store(index_type)
+                self.assertFalse(is_mapped(restarted.index))
+                self.assertEqual(self._add(restarted, f"{index_type}-c", 10), 10)
+                self.assertEqual(restarted.index.ntotal, 320)
+                hits = restarted.search(f"{index_type}-c passage 3", k=1, kb_ids=["kb"])
+                self.assertEqual(hits[0][0]["doc_id"], f"{index_type}-c")
+
+                restarted.reload(repair=True)
+                self.assertEqual(self._add(restarted, f"{index_type}-d", 5), 5)
+                restarted.storage.clear()
+
+    def test_readers_map_ivf_snapshots_and_writers_do_not(self):
+        store = self._store("ivf_flat")
+        self._add(store, "a", 300)
+        store.save()
+
+        reader = self._store("ivf_flat")
+        reader.reload()
+        self.assertTrue(is_mapped(reader.index))
+        reader.reload(repair=True)
+        self.assertFalse(is_mapped(reader.index))
+
+    def test_training_size_survives_restart(self):
+        store = self._store("ivf_flat")
+        self._add(store, "a", 250)
+        self.assertEqual(store._trained_on, 250)
+        self._add(store, "b", 100)
+
+        restarted = self._store("ivf_flat")
+        self.assertEqual(restarted._trained_on, 250)
+
+
+class VectorStoreSyncTest(unittest.TestCase):
+    def setUp(self):
+        VectorStore._model = HashEmbedding()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.data_dir = self._tmp.name
+        self.writer = self._store()
+        self.reader = self._store()
+        self.reader.reload()  # read-only, like a process without the writer lock
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _store(self):
+        return VectorStore(IndexStorage(self.data_dir), index_type="flat", index_params=INDEX_PARAMS)
+
+    def _add(self, store, doc_id, kb_id, count):
+        texts = [f"{doc_id} passage {i}" for i in range(count)]
+        metas = [{"doc_id": doc_id, "kb_id": kb_id, "filename": f"{doc_id}.pdf", "page": 1}] * count
+        return store.add_documents(texts, metas)
+
+    def test_reader_reads_on_from_appended_files(self):
+        self._add(self.writer, "a", "kb1", 20)
+        self.assertEqual(self.reader.sync(), {"kb1"})
+        index, metadata, lexical = self.reader.index, self.reader.metadata, self.reader.lexical
+
+        self._add(self.writer, "b", "kb2", 5)
+        self.writer.delete_document("a")
+        self.assertEqual(self.reader.sync(), {"kb1", "kb2"})
+        # Same objects, extended in place
+        self.assertIs(self.reader.index, index)
+        self.assertIs(self.reader.metadata, metadata)
+        self.assertIs(self.reader.lexical, lexical)
+        self.assertEqual(self.reader.index.ntotal, 25)
+        self.assertEqual(len(self.reader.lexical), 25)
+
+        hits = self.reader.search("b passage 2", k=1, kb_ids=["kb2"])
+        self.assertEqual(hits[0][0]["doc_id"], "b")
+        self.assertEqual(self.reader.search("a passage 2", k=3, kb_ids=["kb1"]), [])
+        self.assertEqual(self.reader.sync(), set())
+
+    def test_reader_skips_torn_append(self):
+        self._add(self.writer, "a", "kb1", 10)
+        # Vectors logged, metadata not yet written
+        self.writer.storage.append(np.ones((3, DIM), dtype=np.float32))
+        self.reader.sync()
+        self.assertEqual(self.reader.index.ntotal, 10)
+
+        self.writer.reload(repair=True)  # the next writer cuts the torn tail
+        self._add(self.writer, "b", "kb1", 4)
+        self.reader.sync()
+        self.assertEqual(self.reader.index.ntotal, 14)
+        self.assertEqual(self.reader.metadata[13]["doc_id"], "b")
+
+    def test_reader_reloads_after_compaction(self):
+        self._add(self.writer, "a", "kb1", 10)
+        self._add(self.writer, "b", "kb2", 10)
+        self.reader.sync()
+        index = self.reader.index
+
+        self.writer.delete_document("a")
+        self.assertTrue(self.writer.compact())
+        self.assertIsNone(self.reader.sync())
+        self.assertIsNot(self.reader.index, index)
+        self.assertEqual(self.reader.index.ntotal, 10)
+        self.assertEqual(self.reader.metadata[0]["doc_id"], "b")
+
+    def test_sync_with_repair_makes_reader_the_writer(self):
+        self._add(self.writer, "a", "kb1", 10)
+        self.reader.sync(repair=True)
+        self.assertFalse(self.reader.read_only)
+        self._add(self.reader, "b", "kb1", 5)
+
+        restarted = self._store()
+        self.assertEqual(restarted.index.ntotal, 15)
+        self.assertEqual([vec for vec, _ in restarted.lexical.search("b passage 4", 1)], [14])
+
+
+class VectorStoreConcurrencyTest(unittest.TestCase):
+    def setUp(self):
+        VectorStore._model = HashEmbedding()
+        self.store = VectorStore(index_type="flat")
+        texts = [f"passage {i}" for i in range(50)]
+        self.store.add_documents(texts, [{"doc_id": "a", "kb_id": "kb", "page": 1}] * len(texts))
+
+    def test_searches_run_in_parallel(self):
+        both_searching = threading.Barrier(2, timeout=5)
+        dense_search = self.store._dense_search
+
+        def meeting_dense_search(*args, **kwargs):
+            both_searching.wait()  # broken unless the other search is inside too
+            return dense_search(*args, **kwargs)
+
+        self.store._dense_search = meeting_dense_search
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.store.search("passage 7", k=1)))
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([hits[0][0]["doc_text"] for hits in results], ["passage 7"] * 2)
+
+    def test_search_does_not_wait_for_writer(self):
+        holding, release = threading.Event(), threading.Event()
+
+        def long_write():
+            with self.store._lock:  # e.g. retraining or writing a snapshot
+                holding.set()
+                release.wait(5)
+
+        writer = threading.Thread(target=long_write)
+        writer.start()
+        try:
+            holding.wait(5)
+            self.assertEqual(self.store.search("passage 3", k=1)[0][0]["doc_text"], "passage 3")
+        finally:
+            release.set()
+            writer.join()
+
+    def test_rebuild_swaps_in_a_new_index(self):
+        self.store.index_type = "hnsw"
+        flat = self.store.index
+        self.store.rebuild_index()
+        self.assertIsNot(self.store.index, flat)
+        self.assertEqual(flat.ntotal, 50)
+        self.assertEqual(self.store.search("passage 9", k=1)[0][0]["doc_text"], "passage 9")
+
+
+if __name__ == "__main__":
+    unittest.main()